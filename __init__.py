@@ -1,14 +1,14 @@
-__all__ = ['regions_for', 'generate']
+__all__ = ['regions_for', 'regions_for_stream', 'RegionFeed', 'generate']
 
 import os
 from .smpregs import get_assembly, parse_filters, sample_regions
 from .region_utils import AllowedSpace, RegionAcceptorNoNs, generate
+from .stream_api import SamplingStream, RegionFeed
 
-def regions_for(regions, include_file=None, ctrl_props=None):
+def _setup(include_file, ctrl_props):
     """
-    Standalone control region generator.
-
-    Simple interface to produce control regions from Python code without any disk access.
+    Return (allowed_space, acceptors, fasta) shared by regions_for and
+    regions_for_stream.
     """
     if ctrl_props is None:
         ctrl_props = []
@@ -17,7 +17,28 @@ def regions_for(regions, include_file=None, ctrl_props=None):
     acceptors = parse_filters(ctrl_props, genome_fasta, annotations_file)
     acceptors = [(RegionAcceptorNoNs, {})] + acceptors
     allowed_space = AllowedSpace(fasta=genome_fasta, include=include_file)
+    return allowed_space, acceptors, genome_fasta
+
+
+def regions_for(regions, include_file=None, ctrl_props=None):
+    """
+    Standalone control region generator.
+
+    Simple interface to produce control regions from Python code without any disk access.
+    """
+    allowed_space, acceptors, genome_fasta = _setup(include_file, ctrl_props)
     for _, ctrl in sample_regions(regions, allowed_space, acceptors, genome_fasta):
         yield ctrl
 
 
+def regions_for_stream(regions, include_file=None, ctrl_props=None, max_pending=100):
+    """
+    Non-blocking counterpart of regions_for.
+
+    Sampling runs in a background thread. Returns SamplingStream providing
+    (input_region, control_region) tuples as they are accepted. regions can
+    be a RegionFeed to provide the input regions incrementally.
+    """
+    allowed_space, acceptors, genome_fasta = _setup(include_file, ctrl_props)
+    return SamplingStream(regions, allowed_space, acceptors, genome_fasta,
+            max_pending=max_pending)
@@ -0,0 +1,471 @@
+"""
+Buffered BED output.
+
+Regions are collected into blocks and every block is formatted by a single
+string operation from its columns, then written through a large buffer.
+Output can be compressed in the BGZF (block gzip) format, readable by gzip
+and bgzip, and indexed by a tabix (.tbi) index built along the way, so that
+tabix and other htslib based tools can query it directly. The index is only
+written if the output is sorted. Random regions are not, unless the writer
+sorts them: rows are then spilled to temporary files per chromosome and
+written out sorted when the writer is closed.
+"""
+
+import itertools
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+import numpy as np
+from region_utils import get_log
+
+# maximum uncompressed size of a BGZF block
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00' \
+        '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+# tabix constants: 0-based half-open (UCSC) coordinates, 16kb linear index windows
+TBX_UCSC = 0x10000
+TBX_LINEAR_SHIFT = 14
+
+
+class BgzfWriter(object):
+    """
+    Writer of BGZF compressed files.
+
+    Keeps the offsets of written blocks to translate uncompressed positions
+    to BGZF virtual offsets (see virtual_offsets).
+    """
+
+    def __init__(self, fileobj, level=6):
+        self._file = fileobj
+        self.level = level
+        self._buffer = []
+        self._buffered = 0
+        # uncompressed start and compressed offset of each written block
+        self._ustarts = []
+        self._coffsets = []
+        self._upos = 0
+        self._cpos = 0
+
+    def write(self, data):
+        self._buffer += [data]
+        self._buffered += len(data)
+        if self._buffered >= BGZF_BLOCK_SIZE:
+            self._write_blocks(final=False)
+
+    def _write_blocks(self, final):
+        data = ''.join(self._buffer)
+        n = len(data) if final else len(data) - len(data) % BGZF_BLOCK_SIZE
+        for i in range(0, n, BGZF_BLOCK_SIZE):
+            self._write_block(data[i:i + BGZF_BLOCK_SIZE])
+        self._buffer = [data[n:]]
+        self._buffered = len(data) - n
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        block_size = 18 + len(deflated) + 8
+        self._ustarts += [self._upos]
+        self._coffsets += [self._cpos]
+        self._file.write(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255,
+            6, 66, 67, 2, block_size - 1))
+        self._file.write(deflated)
+        self._file.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+        self._upos += len(data)
+        self._cpos += block_size
+
+    def flush(self):
+        """
+        Write all buffered data (ends the current block).
+        """
+        if self._buffered > 0:
+            self._write_blocks(final=True)
+        self._file.flush()
+
+    def virtual_offsets(self, positions):
+        """
+        Return BGZF virtual offsets of written uncompressed positions.
+        """
+        ustarts = np.array(self._ustarts + [self._upos], dtype=np.uint64)
+        coffsets = np.array(self._coffsets + [self._cpos], dtype=np.uint64)
+        positions = np.asarray(positions, dtype=np.uint64)
+        block = np.searchsorted(ustarts, positions, side='right') - 1
+        return (coffsets[block] << np.uint64(16)) | (positions - ustarts[block])
+
+    def close(self):
+        self.flush()
+        self._file.write(BGZF_EOF)
+        self._file.close()
+
+
+def reg2bin(start, stop):
+    """
+    Return UCSC/tabix bins of [start, stop) intervals (arrays).
+    """
+    start = np.asarray(start, dtype=np.int64)
+    last = np.asarray(stop, dtype=np.int64) - 1
+    bins = np.zeros(np.shape(start), dtype=np.int64)
+    # from the largest level down, so that the smallest bin wins
+    for shift, offset in [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]:
+        same = (start >> shift) == (last >> shift)
+        bins[same] = offset + (start[same] >> shift)
+    return bins
+
+
+class TabixIndex(object):
+    """
+    Tabix index of a sorted BED file built block by block.
+
+    Positions are kept uncompressed until the index is written.
+    """
+
+    def __init__(self):
+        self.chroms = []
+        self.sorted = True
+        self._bins = {}
+        self._linear = {}
+        self._last_start = -1
+
+    def add(self, chroms, starts, stops, ustarts, uends):
+        """
+        Add records of a block, ustarts/uends are uncompressed positions of
+        the lines.
+        """
+        if not self.sorted:
+            return
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        # split the block to runs of the same chromosome
+        breaks = [0] + [i for i in range(1, len(chroms)) if chroms[i] != chroms[i - 1]] + \
+                [len(chroms)]
+        for lo, hi in zip(breaks[:-1], breaks[1:]):
+            chrom = chroms[lo]
+            if not self.chroms or self.chroms[-1] != chrom:
+                if chrom in self._bins:
+                    self.sorted = False
+                    return
+                self.chroms += [chrom]
+                self._bins[chrom] = {}
+                self._linear[chrom] = {}
+                self._last_start = -1
+            s, e = starts[lo:hi], stops[lo:hi]
+            if s[0] < self._last_start or (np.diff(s) < 0).any():
+                self.sorted = False
+                return
+            self._last_start = s[-1]
+            self._add_chrom(chrom, s, e, ustarts[lo:hi], uends[lo:hi])
+
+    def _add_chrom(self, chrom, starts, stops, ustarts, uends):
+        bins = self._bins[chrom]
+        record_bins = reg2bin(starts, stops)
+        for b in np.unique(record_bins):
+            in_bin = record_bins == b
+            chunks = bins.setdefault(int(b), [])
+            for ustart, uend in zip(ustarts[in_bin], uends[in_bin]):
+                if chunks and chunks[-1][1] == ustart:
+                    chunks[-1][1] = uend
+                else:
+                    chunks += [[ustart, uend]]
+        linear = self._linear[chrom]
+        first_window = starts >> TBX_LINEAR_SHIFT
+        last_window = (np.maximum(stops, starts + 1) - 1) >> TBX_LINEAR_SHIFT
+        for i in np.flatnonzero((first_window != np.roll(first_window, 1)) |
+                (last_window != first_window) | (np.arange(len(starts)) == 0)):
+            for w in range(first_window[i], last_window[i] + 1):
+                if w not in linear:
+                    linear[w] = ustarts[i]
+
+    def write(self, filename, bgzf):
+        """
+        Write the index, bgzf is the BgzfWriter of the indexed file.
+        """
+        fw = BgzfWriter(open(filename, 'wb'))
+        names = ''.join(chrom + '\0' for chrom in self.chroms)
+        fw.write('TBI\1')
+        fw.write(struct.pack('<8i', len(self.chroms), TBX_UCSC, 1, 2, 3, ord('#'), 0,
+            len(names)))
+        fw.write(names)
+        for chrom in self.chroms:
+            bins = self._bins[chrom]
+            fw.write(struct.pack('<i', len(bins)))
+            for b in sorted(bins):
+                chunks = np.array(bins[b], dtype=np.uint64)
+                offsets = bgzf.virtual_offsets(chunks.ravel())
+                fw.write(struct.pack('<Ii', b, len(chunks)))
+                fw.write(offsets.astype('<u8').tostring())
+            linear = self._linear[chrom]
+            n = max(linear) + 1 if linear else 0
+            ioffsets = np.zeros(n, dtype=np.uint64)
+            for w, ustart in linear.items():
+                ioffsets[w] = bgzf.virtual_offsets([ustart])[0]
+            # windows without records point to the previous one
+            for w in range(1, n):
+                if w not in linear:
+                    ioffsets[w] = ioffsets[w - 1]
+            fw.write(struct.pack('<i', n))
+            fw.write(ioffsets.astype('<u8').tostring())
+        fw.close()
+
+
+class SortSpill(object):
+    """
+    Rows partitioned by chromosome into temporary files, to be read back
+    sorted by chromosome and position.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = tempfile.mkdtemp(prefix='smpregs-sort-', dir=directory)
+        self._files = {}
+
+    def add(self, rows):
+        """
+        Add rows (tuples of chrom, start, stop and other columns).
+        """
+        by_chrom = {}
+        for row in rows:
+            by_chrom.setdefault(row[0], []).append('\t'.join(map(str, row)) + '\n')
+        for chrom, lines in by_chrom.items():
+            if chrom not in self._files:
+                self._files[chrom] = os.path.join(self.directory, '%d.bed' % len(self._files))
+            with open(self._files[chrom], 'a') as fw:
+                fw.writelines(lines)
+
+    def sorted_rows(self):
+        """
+        Return generator of the rows sorted by chromosome (names ordered as
+        by sort -k1,1), start and stop. Chromosomes are read one at a time.
+        """
+        for chrom in sorted(self._files):
+            rows = []
+            with open(self._files[chrom]) as f:
+                for line in f:
+                    columns = line.rstrip('\n').split('\t')
+                    rows += [(chrom, int(columns[1]), int(columns[2])) + tuple(columns[3:])]
+            rows.sort(key=lambda row: (row[1], row[2]))
+            for row in rows:
+                yield row
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class BedWriter(object):
+    """
+    Buffered writer of regions in the BED format.
+
+    Lines are formatted as by smpregs.output_region: three columns if the
+    region has no name and there are no extra columns, name ('.' if
+    missing) and extra columns otherwise.
+    """
+
+    def __init__(self, fileobj, bgzip=False, index_filename=None, block_size=10000,
+            sort=False, temp_dir=None):
+        """
+        fileobj: file
+            Opened output file (binary mode for bgzip).
+        bgzip: bool
+            Compress the output in the BGZF format.
+        index_filename: string
+            Write tabix index of the bgzip-ed output there when closed, if
+            the output is sorted.
+        block_size: int
+            Number of regions formatted and written at once.
+        sort: bool
+            Write the regions sorted by chromosome and position (see
+            SortSpill), only once finished.
+        temp_dir: string
+            Where to spill the regions to sort [Default: system temp dir]
+        """
+        self._file = fileobj
+        self._bgzf = BgzfWriter(fileobj) if bgzip else None
+        self._out = self._bgzf if bgzip else fileobj
+        self.index_filename = index_filename
+        self._index = None
+        if bgzip and index_filename is not None:
+            self._index = TabixIndex()
+        self._upos = 0
+        self.block_size = block_size
+        self._rows = []
+        self._width = None
+        self._sort_spill = SortSpill(temp_dir) if sort else None
+
+    def write_region(self, region, extra=None):
+        """
+        Add region (and optional extra columns, eg. SamplingStats).
+        """
+        if extra:
+            if region.name is None:
+                region = region._replace(name='.')
+            row = region + tuple(extra)
+        elif region.name is None:
+            row = region[:3]
+        else:
+            row = region
+        self._add_row(row)
+
+    def _add_row(self, row):
+        # rows of a block have the same number of columns
+        if len(row) != self._width:
+            self._flush_rows()
+            self._width = len(row)
+        self._rows.append(row)
+        if len(self._rows) >= self.block_size:
+            self._flush_rows()
+
+    def _flush_rows(self):
+        if self._rows:
+            rows, self._rows = self._rows, []
+            if self._sort_spill is not None:
+                self._sort_spill.add(rows)
+            else:
+                self._write_rows(rows)
+
+    def _write_rows(self, rows):
+        fmt = '\t'.join(['%s'] * len(rows[0])) + '\n'
+        if self._index is None:
+            data = (fmt * len(rows)) % tuple(itertools.chain.from_iterable(rows))
+        else:
+            lines = map(fmt.__mod__, rows)
+            lengths = np.array(map(len, lines))
+            uends = self._upos + np.cumsum(lengths)
+            chroms, starts, stops = zip(*rows)[:3]
+            self._index.add(chroms, starts, stops, uends - lengths, uends)
+            data = ''.join(lines)
+        self._out.write(data)
+        self._upos += len(data)
+
+    def write_columns(self, chroms, starts, stops, names=None, extra_columns=()):
+        """
+        Write a block of regions given as columns (lists or arrays).
+        """
+        columns = [chroms, np.asarray(starts).tolist(), np.asarray(stops).tolist()]
+        if names is not None:
+            columns += [names]
+        columns += [np.asarray(c).tolist() for c in extra_columns]
+        self._flush_rows()
+        if len(chroms) > 0:
+            if self._sort_spill is not None:
+                self._sort_spill.add(zip(*columns))
+            else:
+                self._write_rows(zip(*columns))
+
+    def flush(self):
+        self._flush_rows()
+        self._out.flush()
+
+    def tell(self):
+        """
+        Return position in the (uncompressed) output.
+        """
+        self.flush()
+        if self._bgzf is not None:
+            return self._upos
+        return self._file.tell()
+
+    def finish(self):
+        """
+        Write out the sorted regions (if sorting) and flush the output.
+        """
+        self._flush_rows()
+        if self._sort_spill is not None:
+            sort_spill, self._sort_spill = self._sort_spill, None
+            try:
+                for row in sort_spill.sorted_rows():
+                    self._add_row(row)
+            finally:
+                sort_spill.close()
+        self.flush()
+
+    def close(self):
+        """
+        Finish and close the output, write the index.
+        """
+        logger = get_log('bed_writer')
+        self.finish()
+        if self._bgzf is not None:
+            self._bgzf.close()
+        else:
+            self._file.close()
+        if self._index is not None:
+            if self._index.sorted:
+                self._index.write(self.index_filename, self._bgzf)
+            else:
+                logger.warning('Output is not sorted, index %s NOT written '
+                        '(sort the output to get it).', self.index_filename)
+
+
+def test_bed_writer():
+    import gzip
+    import os
+    import shutil
+    import tempfile
+    from StringIO import StringIO
+    from region_utils import Region
+    from smpregs import output_region, SamplingStats
+    regions = [Region('chr%d' % c, i * 7000, i * 7000 + 300 + i, 'r%d' % i)
+            for c in [1, 2] for i in range(500)]
+    regions[3] = regions[3]._replace(name=None)
+    stats = [SamplingStats(i, i % 3) for i in range(len(regions))]
+    expected = StringIO()
+    for region, s in zip(regions, stats):
+        output_region(expected, region)
+        output_region(expected, region, extra=s)
+    result = StringIO()
+    writer = BedWriter(result, block_size=77)
+    for region, s in zip(regions, stats):
+        writer.write_region(region)
+        writer.write_region(region, extra=s)
+    writer.flush()
+    assert result.getvalue() == expected.getvalue()
+    result = StringIO()
+    writer = BedWriter(result)
+    writer.write_columns([r.chrom for r in regions], np.array([r.start for r in regions]),
+            np.array([r.stop for r in regions]), ['.' if r.name is None else r.name
+                for r in regions], zip(*stats))
+    writer.flush()
+    assert result.getvalue() == ''.join(expected.getvalue().splitlines(True)[1::2])
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'out.bed.gz')
+        writer = BedWriter(open(filename, 'wb'), bgzip=True,
+                index_filename=filename + '.tbi', block_size=77)
+        for region in regions:
+            writer.write_region(region)
+        writer.close()
+        expected = StringIO()
+        for region in regions:
+            output_region(expected, region)
+        assert gzip.open(filename).read() == expected.getvalue()
+        assert open(filename, 'rb').read().endswith(BGZF_EOF)
+        index = gzip.open(filename + '.tbi').read()
+        assert index[:4] == 'TBI\1'
+        assert struct.unpack('<8i', index[4:36])[:2] == (2, TBX_UCSC)
+        assert index[36:46] == 'chr1\0chr2\0'
+        writer = BedWriter(open(filename, 'wb'), bgzip=True,
+                index_filename=filename + '.unsorted.tbi')
+        for region in reversed(regions):
+            writer.write_region(region)
+        writer.close()
+        assert not os.path.exists(filename + '.unsorted.tbi')
+        writer = BedWriter(open(filename, 'wb'), bgzip=True, sort=True, temp_dir=directory,
+                index_filename=filename + '.sorted.tbi', block_size=77)
+        for region in reversed(regions):
+            writer.write_region(region)
+        writer.close()
+        assert gzip.open(filename).read() == expected.getvalue()
+        assert open(filename + '.sorted.tbi', 'rb').read() == \
+                open(filename + '.tbi', 'rb').read()
+        assert not [f for f in os.listdir(directory) if f.startswith('smpregs-sort-')]
+        result = StringIO()
+        writer = BedWriter(result, sort=True)
+        for region, s in reversed(zip(regions, stats)):
+            writer.write_region(region, extra=s)
+        writer.finish()
+        expected = StringIO()
+        for region, s in zip(regions, stats):
+            output_region(expected, region, extra=s)
+        assert result.getvalue() == expected.getvalue()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+#
+# Cost of sampling a region from a RunBitmap (select) and removing it,
+# depending on the number of runs of the bitmap.
+#
+# The time per region should not grow with the number of runs.
+#
+
+import time
+import numpy as np
+from run_bitmap import RunBitmap
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark RunBitmap removals.')
+    parser.add_argument('-n', '--runs', dest='runs', type=int, action='append',
+            default=[], help='Number of runs (can be given multiple times) \
+            [Default: 1000, 10000, 100000, 1000000]')
+    parser.add_argument('-r', '--regions', dest='regions', type=int, default=2000,
+            help='Number of regions sampled and removed [Default: 2000]')
+    parser.add_argument('-l', '--length', dest='length', type=int, default=301,
+            help='Region length [Default: 301]')
+    opts = parser.parse_args()
+
+    prng = np.random.RandomState(0)
+    print 'runs\tus per region'
+    for runs in opts.runs or [1000, 10000, 100000, 1000000]:
+        starts = np.arange(runs, dtype=np.int64) * 2000
+        bitmap = RunBitmap(_runs=(starts, starts + 1000))
+        bitmap.placements(opts.length)
+        start = time.time()
+        for _ in range(opts.regions):
+            pos = bitmap.select(prng.randint(bitmap.placements(opts.length)), opts.length)
+            bitmap = bitmap.removed((pos, pos + opts.length))
+        print '%d\t%.1f' % (runs, (time.time() - start) / opts.regions * 1e6)
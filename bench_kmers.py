@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+#
+# Compare k-mer counting of the compiled kmers module with kmers_np.
+#
+
+import timeit
+import numpy as np
+import kmers_np
+
+
+def random_sequence(length, prng):
+    return ''.join(prng.choice(list('ACGT'), length))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark k-mer counting.')
+    parser.add_argument('-l', '--length', dest='length', type=int, default=301,
+            help='Window length [Default: 301]')
+    parser.add_argument('-b', '--batch', dest='batch', type=int, default=1000,
+            help='Number of windows [Default: 1000]')
+    parser.add_argument('-k', dest='kmer_k', type=int, action='append', default=[],
+            help='Size of k-mers (can be given multiple times) [Default: 2, 4, 10]')
+    opts = parser.parse_args()
+
+    try:
+        import kmers
+    except ImportError:
+        kmers = None
+        print 'Compiled kmers module not available, build it with setup_kmers.py.'
+    prng = np.random.RandomState(0)
+    seq = random_sequence(opts.length * 10 + opts.batch, prng)
+    starts = prng.randint(0, len(seq) - opts.length, opts.batch)
+    windows = [seq[s:s + opts.length] for s in starts]
+    print 'k\tmethod\tus/window'
+    for k in opts.kmer_k or [2, 4, 10]:
+        methods = [('numpy', lambda: [kmers_np.count_kmers(k, w) for w in windows])]
+        if kmers is not None:
+            methods += [('cython', lambda: [kmers.count_kmers(k, w) for w in windows])]
+        methods += [('batch', lambda: kmers_np.count_kmers_batch(k, seq, starts, opts.length))]
+        for name, f in methods:
+            t = min(timeit.repeat(f, number=1, repeat=3))
+            print '%d\t%s\t%.1f' % (k, name, 1e6 * t / opts.batch)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# Scaling of threaded sampling (threaded.py) with the number of threads.
+#
+# Samples the same random input regions on a random genome with each thread
+# count and checks that the output does not depend on it.
+#
+
+import time
+import numpy as np
+from region_utils import AllowedSpace, Region, RegionAcceptorGCProfile, \
+        RegionAcceptorApproxHistogram, KmerHistogram
+from smpregs import sample_regions
+from threaded import sample_regions_threaded
+
+
+def random_genome(chroms, length, prng):
+    return dict(('chr%d' % i, ''.join(prng.choice(list('ACGT'), length)))
+            for i in range(chroms))
+
+
+def random_regions(genome, count, length, prng):
+    chroms = sorted(genome.keys())
+    return [Region(chroms[prng.randint(len(chroms))], start, start + length, 'r%d' % i)
+            for i, start in enumerate(prng.randint(0, len(genome['chr0']) - length, count))]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark threaded sampling.')
+    parser.add_argument('-c', '--chroms', dest='chroms', type=int, default=4,
+            help='Number of chromosomes [Default: 4]')
+    parser.add_argument('-L', '--chrom-length', dest='chrom_length', type=int,
+            default=1000000, help='Chromosome length [Default: 1000000]')
+    parser.add_argument('-r', '--regions', dest='regions', type=int, default=2000,
+            help='Number of input regions [Default: 2000]')
+    parser.add_argument('-l', '--length', dest='length', type=int, default=301,
+            help='Region length [Default: 301]')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, action='append',
+            default=[], help='Thread count (can be given multiple times) \
+            [Default: 1, 2, 4, 8]')
+    parser.add_argument('-b', '--block-size', dest='block_size', type=int, default=256,
+            help='Block size [Default: 256]')
+    opts = parser.parse_args()
+
+    prng = np.random.RandomState(0)
+    genome = random_genome(opts.chroms, opts.chrom_length, prng)
+    regions = random_regions(genome, opts.regions, opts.length, prng)
+    acceptors = [(RegionAcceptorGCProfile, dict(bins=3, threshold=6)),
+            (RegionAcceptorApproxHistogram, dict(threshold=60, features_per_nt=2,
+                histogram=KmerHistogram(fasta=genome, k=2)))]
+
+    def serial():
+        allowed_space = AllowedSpace(genome, exclude=regions, persistent=True)
+        return list(sample_regions(regions, allowed_space, acceptors, genome,
+            prng=np.random.RandomState(1)))
+
+    def threaded(threads):
+        allowed_space = AllowedSpace(genome, exclude=regions, persistent=True)
+        return list(sample_regions_threaded(regions, allowed_space, acceptors, genome,
+            seed=1, threads=threads, block_size=opts.block_size))
+
+    print 'threads\tseconds\tspeedup\tsame output'
+    start = time.time()
+    serial()
+    base = time.time() - start
+    print 'serial\t%.2f\t1.00\t-' % base
+    expected = None
+    for threads in opts.threads or [1, 2, 4, 8]:
+        start = time.time()
+        result = threaded(threads)
+        elapsed = time.time() - start
+        if expected is None:
+            expected = result
+        print '%d\t%.2f\t%.2f\t%s' % (threads, elapsed, base / elapsed, result == expected)
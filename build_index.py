@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+#
+# Build the index bundle of a genome assembly used by smpregs.py --index,
+# or the shared genome store used by smpregs.py --store. Also available as
+# smpregs.py index build.
+#
+
+import logging
+import os
+from genome_index import build_index
+from genome_store import create_store
+from smpregs import assembly_filename, _setup_log
+
+
+def main(argv=None, prog=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog=prog,
+            description='Build index bundle (N runs, GC, k-mer and genomic annotation tables) of a genome.')
+    parser.add_argument('assembly', action='store', help='Genome assembly \
+            (eg. dm3) or FASTA file.')
+    parser.add_argument('-k', '--kmer', dest='kmer_k', required=False,
+            action='append', type=int, default=[], help='Size of k-mers to \
+            index for KMer filters (can be given multiple times).')
+    parser.add_argument('-n', '--genomic-annotations', dest='genomic_annotations',
+            required=False, action='store', default=None, help='Genomic \
+            annotations FASTA file to index for GAPos and GAHist filters.')
+    parser.add_argument('-s', '--store', dest='store', required=False,
+            action='store', default=None, help='Create shared genome store \
+            of this name (in /dev/shm, including the sequences) instead of \
+            the bundle next to the FASTA file.')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    opts = parser.parse_args(argv)
+
+    _setup_log(level=max(logging.DEBUG, logging.WARNING - opts.verbose*10))
+    if os.path.exists(opts.assembly):
+        fasta_filename = opts.assembly
+    else:
+        fasta_filename = assembly_filename(opts.assembly)
+    if opts.store is not None:
+        print create_store(fasta_filename, opts.store, kmer_k=opts.kmer_k,
+                genomic_annotations=opts.genomic_annotations)
+    else:
+        print build_index(fasta_filename, kmer_k=opts.kmer_k,
+                genomic_annotations=opts.genomic_annotations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+Append-only checkpoints of long sampling runs.
+
+The state of a run consists of the allowed space, the state of the PRNG, the
+candidate pool and the outputs written so far. The allowed space is not
+written as a whole - it is rebuilt from the inputs on resume and the accepted
+regions recorded in the checkpoint are replayed as removals. Each checkpoint
+record therefore only holds the regions accepted since the previous record.
+Likewise, the candidate pool is written as a whole only every pool_every
+records, the other records hold the changes of the pool since the previous
+one (see CandidatePool.take_journal).
+"""
+
+import cPickle as pickle
+import os
+from region_utils import get_log
+
+
+class Checkpoint(object):
+    """
+    Writer of checkpoint records.
+    """
+
+    def __init__(self, filename, every=1000, resume_at=None, pool_every=100):
+        """
+        filename: string
+            Checkpoint file.
+        every: int
+            Number of input regions between two records.
+        pool_every: int
+            Number of records between two records of the whole candidate
+            pool.
+        resume_at: int
+            Position in an existing checkpoint file to continue from (see
+            load_checkpoint), the file is overwritten if None.
+        """
+        self.filename = filename
+        self.every = every
+        self.pool_every = pool_every
+        self._accepted = []
+        # the first record (also after resume) holds the whole pool
+        self._records = 0
+        if resume_at is None:
+            self._file = open(filename, 'wb')
+        else:
+            self._file = open(filename, 'r+b')
+            self._file.seek(resume_at)
+            self._file.truncate()
+
+    def step(self, index, region, prng, pool=None, streams=()):
+        """
+        Record the outcome of the index-th input region (1-based).
+
+        A record is written every self.every input regions.
+
+        region: Region or None
+            Accepted random region (None if the input region was skipped).
+        prng: NumPy RandomState object
+        pool: CandidatePool object
+        streams: list of files
+            Output files, their sizes are stored to be able to truncate them
+            on resume.
+        """
+        if region is not None:
+            self._accepted += [region]
+        if index % self.every == 0:
+            self.save(index, prng, pool, streams)
+
+    def save(self, index, prng, pool=None, streams=()):
+        """
+        Write a record for the first index input regions.
+        """
+        logger = get_log('checkpoint')
+        offsets = []
+        for stream in streams:
+            stream.flush()
+            offsets += [stream.tell()]
+        record = dict(
+                index=index,
+                accepted=self._accepted,
+                prng_state=prng.get_state(),
+                offsets=offsets)
+        if pool is None or self._records % self.pool_every == 0:
+            if pool is not None:
+                pool.start_journal()
+            record['pool'] = pool
+        else:
+            record['pool_changes'] = pool.take_journal()
+        pickle.dump(record, self._file, pickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._accepted = []
+        self._records += 1
+        logger.debug('Checkpoint at input region %d', index)
+
+    def close(self):
+        self._file.close()
+
+
+def load_checkpoint(filename):
+    """
+    Read all complete records of a checkpoint file.
+
+    A truncated last record (e.g. killed while writing) is ignored.
+
+    Returns:
+    ========
+    None if there is no complete record, dict otherwise:
+        index - number of input regions processed
+        accepted - list of all accepted regions
+        prng_state - state of the PRNG
+        pool - CandidatePool object (or None)
+        offsets - sizes of the output files
+        position - end of the last complete record in the checkpoint file
+    """
+    logger = get_log('checkpoint')
+    state = None
+    accepted = []
+    pool = None
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                break
+            except (pickle.UnpicklingError, ValueError, AttributeError, IndexError) as e:
+                logger.warning('Ignoring truncated checkpoint record (%s).', str(e))
+                break
+            accepted += record['accepted']
+            if 'pool' in record:
+                pool = record['pool']
+            else:
+                pool.replay(record['pool_changes'])
+            record['pool'] = pool
+            state = record
+            state['position'] = f.tell()
+    if state is None:
+        return None
+    state['accepted'] = accepted
+    return state
+
+
+def restore(state, allowed_space, prng):
+    """
+    Bring allowed space and PRNG to the state recorded in a checkpoint.
+
+    allowed_space has to be built the same way as in the checkpointed run.
+
+    Returns:
+    ========
+    Number of input regions processed.
+    """
+    for region in state['accepted']:
+        allowed_space.remove(region)
+    prng.set_state(state['prng_state'])
+    return state['index']
+
+
+def test_checkpoint():
+    import numpy as np
+    import tempfile
+    from region_utils import Region
+    prng = np.random.RandomState(1)
+    filename = tempfile.mktemp()
+    try:
+        checkpoint = Checkpoint(filename, every=2)
+        for i in range(1, 6):
+            prng.randint(10)
+            checkpoint.step(i, Region('chr1', i, i + 1, None), prng)
+        checkpoint.close()
+        with open(filename, 'ab') as f:
+            f.write('garbage')
+        state = load_checkpoint(filename)
+        assert state['index'] == 4
+        assert [r.start for r in state['accepted']] == [1, 2, 3, 4]
+        next_value = prng.randint(10)
+        prng = np.random.RandomState(2)
+        prng.set_state(state['prng_state'])
+        prng.randint(10)
+        assert prng.randint(10) == next_value
+        checkpoint = Checkpoint(filename, every=2, resume_at=state['position'])
+        checkpoint.step(5, Region('chr1', 5, 6, None), prng)
+        checkpoint.step(6, None, prng)
+        checkpoint.close()
+        state = load_checkpoint(filename)
+        assert state['index'] == 6
+        assert [r.start for r in state['accepted']] == [1, 2, 3, 4, 5]
+    finally:
+        os.unlink(filename)
+
+
+def test_checkpoint_pool():
+    import numpy as np
+    import tempfile
+    from region_utils import Region, CandidatePool
+    prng = np.random.RandomState(1)
+    pool = CandidatePool(max_size=20)
+    filename = tempfile.mktemp()
+    def pool_state(pool):
+        return [(r, f) for key in sorted(pool._candidates)
+                for r, f in pool.candidates(*key)], list(pool._order)
+    try:
+        checkpoint = Checkpoint(filename, every=1, pool_every=3)
+        sizes = []
+        for i in range(1, 11):
+            for _ in range(10):
+                start = prng.randint(50)
+                region = Region('chr1', start, start + 10, None)
+                if prng.rand() < 0.7:
+                    pool.add(region, {'GC': start})
+                else:
+                    pool.discard(region)
+            checkpoint.step(i, None, prng, pool)
+            sizes += [os.path.getsize(filename)]
+        checkpoint.close()
+        state = load_checkpoint(filename)
+        assert state['index'] == 10
+        assert pool_state(state['pool']) == pool_state(pool)
+        # records between the snapshots hold only the changes
+        record_sizes = np.diff([0] + sizes)
+        assert record_sizes[1] < record_sizes[0] and record_sizes[3] > record_sizes[2]
+    finally:
+        os.unlink(filename)
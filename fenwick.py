@@ -0,0 +1,93 @@
+"""
+Fenwick tree (binary indexed tree) of non-negative integer weights.
+
+Updates of a single weight, prefix sums and weighted sampling of an index
+all take O(log n).
+"""
+
+
+class FenwickTree(object):
+
+    def __init__(self, weights=()):
+        """
+        weights: iterable of int
+            Initial weights of indexes 0..n-1.
+        """
+        self._tree = [0] + list(weights)
+        n = len(self._tree)
+        # build in O(n): push each partial sum to its parent
+        for i in range(1, n):
+            parent = i + (i & -i)
+            if parent < n:
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self):
+        return len(self._tree) - 1
+
+    def add(self, index, delta):
+        """
+        Add delta to the weight of the index.
+        """
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, index):
+        """
+        Return the sum of weights of indexes 0..index-1.
+        """
+        total = 0
+        i = index
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def total(self):
+        return self.prefix_sum(len(self))
+
+    def __getitem__(self, index):
+        return self.prefix_sum(index + 1) - self.prefix_sum(index)
+
+    def find(self, value):
+        """
+        Return the index i with prefix_sum(i) <= value < prefix_sum(i + 1).
+
+        For value drawn uniformly from [0, total()), index i is returned with
+        probability proportional to its weight.
+        """
+        i = 0
+        step = 1
+        while step * 2 < len(self._tree):
+            step *= 2
+        while step > 0:
+            if i + step < len(self._tree) and self._tree[i + step] <= value:
+                i += step
+                value -= self._tree[i]
+            step //= 2
+        return i
+
+    def copy(self):
+        other = FenwickTree.__new__(FenwickTree)
+        other._tree = list(self._tree)
+        return other
+
+
+def test_fenwick_tree():
+    weights = [3, 0, 5, 1, 0, 0, 7, 2, 4]
+    tree = FenwickTree(weights)
+    assert len(tree) == len(weights)
+    assert [tree[i] for i in range(len(weights))] == weights
+    for i in range(len(weights) + 1):
+        assert tree.prefix_sum(i) == sum(weights[:i])
+    found = [tree.find(v) for v in range(tree.total())]
+    assert found == [i for i, w in enumerate(weights) for _ in range(w)]
+    other = tree.copy()
+    tree.add(2, -5)
+    tree.add(4, 2)
+    weights[2] -= 5
+    weights[4] += 2
+    found = [tree.find(v) for v in range(tree.total())]
+    assert found == [i for i, w in enumerate(weights) for _ in range(w)]
+    assert other[2] == 5 and other[4] == 0
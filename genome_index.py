@@ -0,0 +1,228 @@
+"""
+Prebuilt, versioned index bundle of a genome.
+
+The bundle is a directory next to the genome FASTA (<fasta>.smpidx) with:
+    meta.json              - version, source FASTA (size, mtime), chromosomes
+    <chrom>.nruns.npy      - (n, 2) array of runs of N's
+    <chrom>.gc.npy         - prefix sums of G/C nucleotides
+    <chrom>.kmer<k>.npy    - k-mer code at each position (4**k if invalid)
+    <chrom>.ga.npy         - genomic annotation code at each position
+    <chrom>.seq.npy        - the sequence itself (optional, see genome_store.py)
+Arrays are memory-mapped lazily on first use of a chromosome, the FASTA
+itself is only opened when a sequence is really needed and not stored.
+
+Use smpregs.py index build (build_index.py) to create the bundle.
+"""
+
+import json
+import os
+import numpy as np
+from region_utils import get_log, open_fasta, gc_prefix_sums
+from kmers_np import kmer_codes, reverse_complement_codes
+
+INDEX_VERSION = 1
+
+_N_LUT = np.zeros(256, dtype=np.bool_)
+_N_LUT[[ord(c) for c in 'Nn']] = True
+
+
+def index_path(fasta_filename):
+    return fasta_filename + '.smpidx'
+
+
+def _source_stamp(fasta_filename):
+    st = os.stat(fasta_filename)
+    return dict(size=st.st_size, mtime=int(st.st_mtime))
+
+
+def build_index(fasta_filename, kmer_k=(), genomic_annotations=None, path=None,
+        sequence=False):
+    """
+    Build the index bundle of a genome.
+
+    Parameters:
+    ===========
+    fasta_filename: string
+        Genome FASTA file.
+    kmer_k: list of int
+        Sizes of k-mers to store k-mer codes for.
+    genomic_annotations: filename
+        FASTA file with encoded genomic annotations (see encode_annotations.py).
+    path: string
+        Bundle directory [Default: <fasta_filename>.smpidx]
+    sequence: bool
+        Store the sequences as well, the FASTA is not needed then.
+    """
+    logger = get_log('genome_index')
+    if path is None:
+        path = index_path(fasta_filename)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    fasta = open_fasta(fasta_filename)
+    annotations = None
+    annotation_codes = []
+    if genomic_annotations is not None:
+        annotations = open_fasta(genomic_annotations)
+    chroms = []
+    for chrom in sorted(fasta.keys()):
+        logger.info('Indexing %s', chrom)
+        seq = str(fasta[chrom][:])
+        chroms += [(chrom, len(seq))]
+        chars = np.frombuffer(seq, dtype=np.uint8)
+        is_n = np.concatenate([[0], _N_LUT[chars].view(np.int8), [0]])
+        boundaries = np.flatnonzero(np.diff(is_n))
+        np.save(os.path.join(path, chrom + '.nruns.npy'),
+                boundaries.reshape(-1, 2).astype(np.int64))
+        np.save(os.path.join(path, chrom + '.gc.npy'), gc_prefix_sums(chars))
+        if sequence:
+            np.save(os.path.join(path, chrom + '.seq.npy'), chars)
+        for k in kmer_k:
+            np.save(os.path.join(path, '%s.kmer%d.npy' % (chrom, k)), kmer_codes(seq, k))
+        if annotations is not None:
+            ga = np.frombuffer(str(annotations[chrom][:]), dtype=np.uint8)
+            for c in np.unique(ga):
+                if chr(c) not in annotation_codes:
+                    annotation_codes += [chr(c)]
+            np.save(os.path.join(path, chrom + '.ga.npy'), ga)
+    meta = dict(
+            version=INDEX_VERSION,
+            source=os.path.abspath(fasta_filename),
+            stamp=_source_stamp(fasta_filename),
+            chroms=chroms,
+            kmer_k=list(kmer_k),
+            sequence=sequence,
+            annotations=sorted(annotation_codes) if annotations is not None else None)
+    with open(os.path.join(path, 'meta.json'), 'w') as fw:
+        json.dump(meta, fw, indent=1)
+    return path
+
+
+class IndexedSequence(object):
+    """
+    Sequence of a chromosome, the FASTA is opened on first slicing.
+    """
+
+    def __init__(self, index, chrom, length):
+        self.index = index
+        self.chrom = chrom
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if self.index.has_sequence:
+            seq = self.index._array(self.chrom, 'seq')[key]
+            return seq.tostring() if isinstance(key, slice) else chr(seq)
+        return self.index.fasta[self.chrom][key]
+
+
+class GenomeIndex(object):
+    """
+    Lazily loaded index bundle of a genome.
+
+    Behaves as a pyfasta.Fasta object (keys, chromosome lengths, sequence
+    slicing) and provides fast lookups used by the acceptors.
+    """
+
+    def __init__(self, fasta_filename=None, path=None, check=True):
+        """
+        fasta_filename: string
+            Genome FASTA file the index was built from. [Default: the source
+            recorded in the bundle]
+        path: string
+            Bundle directory [Default: <fasta_filename>.smpidx]
+        check: bool
+            Verify that the bundle matches the version and the FASTA file.
+            Bundles with sequences are not checked against a missing FASTA.
+        """
+        if path is None:
+            path = index_path(fasta_filename)
+        self.path = path
+        meta_filename = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_filename):
+            raise ValueError('No index found in %s, use smpregs.py index build to create it.' % path)
+        with open(meta_filename) as f:
+            self.meta = json.load(f)
+        if fasta_filename is None:
+            fasta_filename = str(self.meta['source'])
+        self.fasta_filename = fasta_filename
+        self.has_sequence = self.meta.get('sequence', False)
+        if check:
+            if self.meta['version'] != INDEX_VERSION:
+                raise ValueError('Index %s has version %d, %d expected. Rebuild it.' %
+                        (path, self.meta['version'], INDEX_VERSION))
+            # bundles with sequences can be used without the FASTA
+            if (os.path.exists(fasta_filename) or not self.has_sequence) and \
+                    self.meta['stamp'] != _source_stamp(fasta_filename):
+                raise ValueError('Index %s is out of date with %s. Rebuild it.' %
+                        (path, fasta_filename))
+        self.sizes = dict((str(c), l) for c, l in self.meta['chroms'])
+        self.kmer_k = self.meta['kmer_k']
+        self.has_annotations = self.meta['annotations'] is not None
+        self._arrays = {}
+        self._fasta = None
+
+    @property
+    def fasta(self):
+        if self._fasta is None:
+            self._fasta = open_fasta(self.fasta_filename)
+        return self._fasta
+
+    def keys(self):
+        return self.sizes.keys()
+
+    def __getitem__(self, chrom):
+        return IndexedSequence(self, chrom, self.sizes[chrom])
+
+    def _array(self, chrom, name):
+        key = (chrom, name)
+        if key not in self._arrays:
+            self._arrays[key] = np.load(
+                    os.path.join(self.path, '%s.%s.npy' % (chrom, name)), mmap_mode='r')
+        return self._arrays[key]
+
+    def has_n(self, chrom, start, stop):
+        """
+        Check whether there is any N in [start, stop).
+        """
+        runs = self._array(chrom, 'nruns')
+        # first run ending after start has to start at or after stop
+        i = np.searchsorted(runs[:, 1], start, side='right')
+        return i < len(runs) and runs[i, 0] < stop
+
+    def gc_count(self, chrom, start, stop):
+        gc = self._array(chrom, 'gc')
+        return int(gc[stop]) - int(gc[start])
+
+    def gc_counts(self, chrom, edges):
+        """
+        Return numbers of G/C between consecutive edges (last axis).
+        """
+        gc = self._array(chrom, 'gc')[edges].astype(np.int64)
+        return np.diff(gc, axis=-1)
+
+    def kmer_counts(self, k, chrom, start, stop):
+        """
+        Count k-mers on both strands of [start, stop).
+
+        Returns:
+        ========
+        Array of counts ordered as all_kmers(k), None if there is other
+        letter than ACGT in the region.
+        """
+        codes = self._array(chrom, 'kmer%d' % k)[start:stop - k + 1]
+        counts = np.bincount(codes, minlength=4 ** k + 1)
+        if counts[4 ** k] > 0:
+            return None
+        counts = counts[:4 ** k]
+        return counts + counts[reverse_complement_codes(k)]
+
+    def annotation_at(self, chrom, position):
+        return chr(self._array(chrom, 'ga')[position])
+
+    def annotation_histogram(self, region):
+        ga = self._array(region.chrom, 'ga')[region.start:region.stop]
+        counts = np.bincount(ga, minlength=256)
+        return dict((chr(c), int(counts[c])) for c in np.flatnonzero(counts))
+
@@ -0,0 +1,107 @@
+"""
+Genome store shared by worker processes.
+
+A store is an index bundle (see genome_index.py) including the sequences,
+placed in shared memory (/dev/shm) under a name. It is created once,
+worker processes attach to it by name and memory-map its arrays read-only,
+so the genome, N runs and prefix sums are shared by all of them through
+the page cache instead of being loaded once per process.
+
+The attached store behaves as a pyfasta.Fasta object and can be passed to
+AllowedSpace, the acceptors and sample_regions in place of the genome.
+"""
+
+import os
+import shutil
+import tempfile
+from genome_index import build_index, GenomeIndex
+from region_utils import get_log
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def store_path(name):
+    """
+    Return directory of the store, names containing '/' are taken as paths.
+    """
+    if '/' in name:
+        return name
+    return os.path.join(SHM_DIR, 'smpregs-' + name)
+
+
+def create_store(fasta_filename, name, kmer_k=(), genomic_annotations=None):
+    """
+    Create the store from a genome FASTA file (replaces an existing one).
+
+    Parameters:
+    ===========
+    fasta_filename: string
+        Genome FASTA file.
+    name: string
+        Name of the store workers attach to.
+    kmer_k: list of int
+        Sizes of k-mers to store k-mer codes for.
+    genomic_annotations: filename
+        FASTA file with encoded genomic annotations.
+
+    Returns:
+    ========
+    Directory of the store.
+    """
+    logger = get_log('genome_store')
+    path = store_path(name)
+    if os.path.exists(path):
+        logger.info('Replacing store %s', path)
+        shutil.rmtree(path)
+    return build_index(fasta_filename, kmer_k=kmer_k,
+            genomic_annotations=genomic_annotations, path=path, sequence=True)
+
+
+_attached = {}
+
+def attach_store(name):
+    """
+    Return the store (GenomeIndex with sequences), attached once per process.
+    """
+    path = store_path(name)
+    if path not in _attached:
+        index = GenomeIndex(path=path)
+        if not index.has_sequence:
+            raise ValueError('%s is not a genome store (no sequences).' % path)
+        _attached[path] = index
+    return _attached[path]
+
+
+def remove_store(name):
+    """
+    Remove the store, processes attached to it keep their mappings.
+    """
+    _attached.pop(store_path(name), None)
+    shutil.rmtree(store_path(name))
+
+
+def test_store():
+    from region_utils import Region, RegionAcceptorApproxGC, count_g_and_c
+    directory = tempfile.mkdtemp()
+    try:
+        fasta_filename = os.path.join(directory, 'genome.fa')
+        with open(fasta_filename, 'w') as fw:
+            fw.write('>chr1\nACGTNNNNGGCCATAT\n>chr2\nGGGGAAAA\n')
+        path = create_store(fasta_filename, os.path.join(directory, 'store'), kmer_k=[2])
+        os.unlink(fasta_filename)
+        store = attach_store(path)
+        assert attach_store(path) is store
+        assert sorted(store.keys()) == ['chr1', 'chr2']
+        assert len(store['chr1']) == 16
+        assert store['chr1'][8:12] == 'GGCC'
+        assert store['chr2'][0] == 'G'
+        assert store.has_n('chr1', 2, 5) and not store.has_n('chr1', 8, 16)
+        template = Region('chr1', 8, 12, 't')
+        acceptor = RegionAcceptorApproxGC(threshold=2, template=template, fasta=store)
+        assert acceptor.gc == count_g_and_c('GGCC')
+        assert acceptor.accept(Region('chr2', 2, 6, None))
+        assert not acceptor.accept(Region('chr2', 4, 8, None))
+        remove_store(path)
+        assert not os.path.exists(path)
+    finally:
+        shutil.rmtree(directory)
@@ -22,6 +22,15 @@ class IntervalLinkedList(LinkedList):
         super(IntervalLinkedList, self).__init__(iterable=iterable, data=data, next=next)
 
 
+    def copy(self):
+        """
+        Return a shallow copy of the list.
+        """
+        other = IntervalLinkedList()
+        other.extend(self)
+        return other
+
+
     def __contains__(self, data):
         """
         Check whether the interval data is completely inside one of the intervals.
@@ -92,6 +101,14 @@ def test_in():
     assert (20, 31) not in x
 
 
+def test_copy():
+    x = IntervalLinkedList([(1, 10), (20, 30)])
+    y = x.copy()
+    y.remove((5, 25))
+    assert str(x) == '(1, 10)->(20, 30)', str(x)
+    assert str(y) == '(1, 5)->(25, 30)', str(y)
+
+
 def test_remove():
     x = IntervalLinkedList([(1, 1000)])
     assert str(x) == '(1, 1000)', str(x)
@@ -0,0 +1,216 @@
+"""
+Pure NumPy k-mer counting.
+
+Drop-in replacement of the Cython kmers module (all_kmers, count_kmers) and
+batch counting over many windows of the same sequence at once. Counts
+include both strands, as in kmers._count_kmers.
+
+K-mer codes: the code of k-mer s is sum(ACGT.index(s[j]) * 4**j), ie. the
+index of s in all_kmers(k). For k > SPARSE_K, batch counts are returned as
+dicts {code: count} instead of dense 4**k arrays.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+SPARSE_K = 8
+
+_BASE_LUT = np.empty(256, dtype=np.uint8)
+_BASE_LUT.fill(255)
+for _i, _c in enumerate('ACGT'):
+    _BASE_LUT[ord(_c)] = _BASE_LUT[ord(_c.lower())] = _i
+
+
+def all_kmers(k, i=None):
+    """
+    Return list of all k-mers ordered by their codes.
+    """
+    if i is None:
+        i = k-1
+    letters = 'ACGT'
+    if i > 0:
+        kmers = []
+        for c in letters:
+            kmers += [s + c for s in all_kmers(k, i-1)]
+        return kmers
+    else:
+        return [c for c in letters]
+
+
+def _as_bytes(seq):
+    if isinstance(seq, np.ndarray):
+        return seq.view(np.uint8)
+    return np.frombuffer(str(seq), dtype=np.uint8)
+
+
+def kmer_code_dtype(k):
+    """
+    Return the smallest unsigned integer type holding k-mer codes (up to
+    4**k, see kmer_codes).
+    """
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if 4 ** k <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def kmer_codes(seq, k):
+    """
+    Return codes of k-mers starting at each position of the sequence.
+
+    K-mers with other letters than ACGT get 4**k. The codes are of
+    kmer_code_dtype(k).
+    """
+    dtype = kmer_code_dtype(k)
+    bases = _BASE_LUT[_as_bytes(seq)]
+    n = len(bases) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=dtype)
+    # k shifted views of the sequence, one per position in the k-mer
+    windows = as_strided(bases, shape=(k, n), strides=(bases.strides[0], bases.strides[0]))
+    codes = np.zeros(n, dtype=dtype)
+    invalid = np.zeros(n, dtype=np.bool_)
+    for j in range(k):
+        invalid |= windows[j] == 255
+        codes += windows[j].astype(dtype) << dtype(2 * j)
+    codes[invalid] = 4 ** k
+    return codes
+
+
+_rc_codes = {}
+
+def reverse_complement_codes(k):
+    """
+    Return array mapping k-mer codes to codes of their reverse complements.
+    """
+    if k not in _rc_codes:
+        codes = np.arange(4 ** k, dtype=np.uint32)
+        rc = np.zeros(4 ** k, dtype=np.uint32)
+        for j in range(k):
+            rc += (3 - ((codes >> (2 * j)) & 3)) << (2 * (k - 1 - j))
+        _rc_codes[k] = rc
+    return _rc_codes[k]
+
+
+def count_kmers(k, seq=None):
+    """
+    Count k-mers on both strands of the sequence.
+
+    Same interface as kmers.count_kmers.
+    """
+    if seq is None:
+        return all_kmers(k)
+    codes = kmer_codes(seq, k)
+    if (codes == 4 ** k).any():
+        raise ValueError('Only ACGT allowed in the sequence.')
+    both = np.concatenate([codes, reverse_complement_codes(k)[codes]])
+    return np.bincount(both, minlength=4 ** k).astype(np.uint32)
+
+
+def count_kmers_batch(k, seq, starts, length, sparse=None):
+    """
+    Count k-mers on both strands of many windows of the same length.
+
+    Parameters:
+    ===========
+    seq: string or uint8 array
+        Sequence containing all the windows.
+    starts: array of int
+        Starts of the windows in seq.
+    length: int
+        Length of the windows.
+    sparse: bool
+        Return dicts instead of dense arrays [Default: k > SPARSE_K]
+
+    Returns:
+    ========
+    Tuple (counts, valid):
+        counts - (len(starts), 4**k) array or list of dicts {code: count}
+        valid - bool array, False for windows with other letters than ACGT
+          (their counts are meaningless).
+    """
+    if sparse is None:
+        sparse = k > SPARSE_K
+    starts = np.asarray(starts, dtype=np.intp)
+    codes = kmer_codes(seq, k)
+    width = length - k + 1
+    # one row of k-mer codes per window
+    rows = as_strided(codes, shape=(len(codes) - width + 1, width),
+            strides=(codes.strides[0], codes.strides[0]))[starts]
+    invalid_code = 4 ** k
+    valid = ~(rows == invalid_code).any(axis=1)
+    rc = reverse_complement_codes(k)
+    if not sparse:
+        offsets = (np.arange(len(starts)) * (invalid_code + 1))[:, None]
+        counts = np.bincount((rows + offsets).ravel(),
+                minlength=len(starts) * (invalid_code + 1))
+        counts = counts.reshape(len(starts), invalid_code + 1)[:, :invalid_code]
+        return (counts + counts[:, rc]).astype(np.uint32), valid
+    rows = np.where(rows == invalid_code, 0, rows)
+    both = np.hstack([rows, rc[rows]]).astype(np.uint64)
+    keys = (np.arange(len(starts), dtype=np.uint64)[:, None] << np.uint64(2 * k + 1)) + both
+    keys, counts = np.unique(keys.ravel(), return_counts=True)
+    row_of_key = (keys >> np.uint64(2 * k + 1)).astype(np.intp)
+    code_of_key = keys & np.uint64((1 << (2 * k + 1)) - 1)
+    bounds = np.searchsorted(row_of_key, np.arange(len(starts) + 1))
+    result = []
+    for i in range(len(starts)):
+        result += [dict(zip(code_of_key[bounds[i]:bounds[i + 1]].tolist(),
+            counts[bounds[i]:bounds[i + 1]].tolist()))]
+    return result, valid
+
+
+def test_count_kmers():
+    prng = np.random.RandomState(0)
+    seq = ''.join(prng.choice(list('ACGT'), 200))
+    comp = dict(zip('ACGT', 'TGCA'))
+    rc_seq = ''.join(comp[c] for c in reversed(seq))
+    for k in [1, 2, 3]:
+        keys = all_kmers(k)
+        expected = [sum(s[i:i + k] == key for s in [seq, rc_seq] for i in range(len(s) - k + 1))
+                for key in keys]
+        assert list(count_kmers(k, seq)) == expected
+        assert list(count_kmers(k, seq.lower())) == expected
+
+
+def test_count_kmers_batch():
+    prng = np.random.RandomState(0)
+    seq = ''.join(prng.choice(list('ACGT'), 500))
+    seq = seq[:100] + 'N' + seq[101:]
+    starts = np.array([0, 50, 120, 300, 399])
+    for k in [2, 3]:
+        counts, valid = count_kmers_batch(k, seq, starts, 101)
+        assert list(valid) == [False, False, True, True, True]
+        for i in range(2, len(starts)):
+            assert (counts[i] == count_kmers(k, seq[starts[i]:starts[i] + 101])).all()
+        sparse_counts, sparse_valid = count_kmers_batch(k, seq, starts, 101, sparse=True)
+        assert (sparse_valid == valid).all()
+        for i in range(2, len(starts)):
+            assert sparse_counts[i] == dict((c, n) for c, n in enumerate(counts[i]) if n > 0)
+
+
+def test_kmer_codes():
+    from itertools import product
+    k = 2
+    keys = [''.join(reversed(p)) for p in product('ACGT', repeat=k)]
+    seq = 'ACGTTGCAN'
+    codes = kmer_codes(seq, k)
+    assert [keys[c] for c in codes[:-1]] == [seq[i:i + k] for i in range(len(seq) - k)]
+    assert codes[-1] == 4 ** k
+    rc = reverse_complement_codes(k)
+    comp = dict(zip('ACGT', 'TGCA'))
+    for code, key in enumerate(keys):
+        assert keys[rc[code]] == ''.join(comp[c] for c in reversed(key))
+
+
+def test_kmer_code_dtype():
+    prng = np.random.RandomState(0)
+    seq = ''.join(prng.choice(list('ACGT'), 100)) + 'N'
+    assert [kmer_code_dtype(k) for k in [1, 3, 4, 7, 8]] == \
+            [np.uint8, np.uint8, np.uint16, np.uint16, np.uint32]
+    for k in [3, 4, 8]:
+        codes = kmer_codes(seq, k)
+        assert codes.dtype == kmer_code_dtype(k)
+        expected = [sum('ACGT'.index(c) << (2 * j) for j, c in enumerate(seq[i:i + k]))
+                if 'N' not in seq[i:i + k] else 4 ** k for i in range(len(seq) - k + 1)]
+        assert list(codes) == expected
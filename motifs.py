@@ -0,0 +1,229 @@
+"""
+Genome-wide motif hit index.
+
+Motifs (IUPAC consensus strings or position weight matrices) are scanned on
+both strands of a chromosome the first time it is queried, all registered
+motifs sharing a single pass over the sequence. Hit positions are stored as
+sorted arrays, so the number of hits in any window costs two binary
+searches.
+"""
+
+import os
+import threading
+import numpy as np
+from kmers_np import _BASE_LUT
+from region_utils import get_log
+
+IUPAC = dict(
+        A='A', C='C', G='G', T='T',
+        R='AG', Y='CT', S='CG', W='AT', K='GT', M='AC',
+        B='CGT', D='AGT', H='ACT', V='ACG', N='ACGT')
+
+# number of positions scanned at once
+_CHUNK = 1 << 20
+
+
+def consensus_to_pwm(consensus):
+    """
+    Return (len, 4) score matrix scoring 1 for each matching position.
+    """
+    pwm = np.zeros((len(consensus), 4))
+    for i, c in enumerate(consensus.upper()):
+        if c not in IUPAC:
+            raise ValueError('Unknown IUPAC code %s in motif %s.' % (c, consensus))
+        for b in IUPAC[c]:
+            pwm[i, 'ACGT'.index(b)] = 1
+    return pwm
+
+
+def read_pwm(filename, pseudocount=0.01):
+    """
+    Read PWM from a text file with one row (A C G T columns) per position.
+
+    Counts or frequencies (all entries non-negative) are converted to log2
+    odds against a uniform background, otherwise the entries are taken as
+    scores.
+    """
+    pwm = np.loadtxt(filename, ndmin=2)
+    if pwm.shape[1] != 4:
+        raise ValueError('PWM %s has to have 4 columns (A, C, G, T).' % filename)
+    if (pwm >= 0).all():
+        freqs = (pwm + pseudocount) / (pwm + pseudocount).sum(axis=1)[:, None]
+        pwm = np.log2(freqs / 0.25)
+    return pwm
+
+
+def parse_motif(motif):
+    """
+    Return score matrix of a motif given as a PWM file or consensus string.
+    """
+    if os.path.exists(motif):
+        return read_pwm(motif)
+    return consensus_to_pwm(motif)
+
+
+class MotifIndex(object):
+    """
+    Sorted hit positions of motifs, computed lazily per chromosome.
+
+    The index is thread-safe: motifs can be added while hits are looked up,
+    each chromosome is scanned by one thread at a time.
+    """
+
+    def __init__(self, fasta):
+        """
+        fasta: Fasta or GenomeIndex object
+        """
+        self.fasta = fasta
+        self._motifs = {}
+        self._hits = {}
+        # guards _motifs and _chrom_locks
+        self._lock = threading.Lock()
+        self._chrom_locks = {}
+
+    def add(self, motif, score=None, abs_score=None):
+        """
+        Register a motif.
+
+        Parameters:
+        ===========
+        motif: string
+            PWM file or IUPAC consensus.
+        score: float
+            Minimum score of a hit relative to the range of scores of the
+            motif, in [0, 1]. [Default: 1 for consensus (exact match), 0.8
+            for PWM]
+        abs_score: float
+            Minimum score of a hit in the units of the score matrix, instead
+            of score.
+
+        Returns:
+        ========
+        Key of the motif for count.
+        """
+        pwm = parse_motif(motif)
+        if abs_score is not None:
+            if score is not None:
+                raise ValueError('Only one of score and abs_score can be given for motif %s.' %
+                        motif)
+            score = abs_score
+        else:
+            if score is None:
+                score = 0.8 if os.path.exists(motif) else 1.
+            if not 0 <= score <= 1:
+                raise ValueError('Relative score of motif %s has to be in [0, 1], not %s '
+                        '(use abs_score for absolute scores).' % (motif, score))
+            lo, hi = pwm.min(axis=1).sum(), pwm.max(axis=1).sum()
+            score = lo + score * (hi - lo)
+        key = (motif, score)
+        with self._lock:
+            self._motifs[key] = (pwm, score)
+        return key
+
+    def length(self, key):
+        return len(self._motifs[key][0])
+
+    def _scan(self, chrom, keys):
+        logger = get_log('motifs')
+        logger.info('Scanning %s for %d motif(s)', chrom, len(keys))
+        seq = self.fasta[chrom]
+        n = len(seq)
+        hits = dict((key, []) for key in keys)
+        scorers = []
+        for key in keys:
+            pwm, score = self._motifs[key]
+            # 5th column scores non-ACGT letters
+            fwd = np.hstack([pwm, np.empty((len(pwm), 1))])
+            fwd[:, 4] = -np.inf
+            rev = fwd[::-1, [3, 2, 1, 0, 4]]
+            scorers += [(key, fwd, rev, score)]
+        max_len = max(len(fwd) for _, fwd, _, _ in scorers)
+        for chunk_start in range(0, n, _CHUNK):
+            chunk_stop = min(n, chunk_start + _CHUNK + max_len - 1)
+            bases = _BASE_LUT[np.frombuffer(str(seq[chunk_start:chunk_stop]), dtype=np.uint8)]
+            bases = np.minimum(bases, 4)
+            for key, fwd, rev, score in scorers:
+                m = len(bases) - len(fwd) + 1
+                if m <= 0:
+                    continue
+                m = min(m, _CHUNK)
+                fwd_score = np.zeros(m)
+                rev_score = np.zeros(m)
+                for j in range(len(fwd)):
+                    fwd_score += fwd[j][bases[j:j + m]]
+                    rev_score += rev[j][bases[j:j + m]]
+                hit = (fwd_score >= score) | (rev_score >= score)
+                hits[key] += [chunk_start + np.flatnonzero(hit)]
+        for key in keys:
+            self._hits[(chrom, key)] = np.concatenate(hits[key]).astype(np.int64) \
+                    if hits[key] else np.zeros(0, dtype=np.int64)
+
+    def hits(self, key, chrom):
+        """
+        Return sorted starts of hits of the motif on the chromosome.
+        """
+        if (chrom, key) not in self._hits:
+            with self._lock:
+                chrom_lock = self._chrom_locks.setdefault(chrom, threading.Lock())
+            with chrom_lock:
+                # another thread may have scanned the chromosome meanwhile
+                if (chrom, key) not in self._hits:
+                    # scan all motifs not yet scanned on the chromosome in one pass
+                    with self._lock:
+                        keys = [k for k in self._motifs if (chrom, k) not in self._hits]
+                    self._scan(chrom, keys)
+        return self._hits[(chrom, key)]
+
+    def count(self, key, chrom, start, stop):
+        """
+        Count hits of the motif fully inside [start, stop).
+        """
+        hits = self.hits(key, chrom)
+        last_start = stop - self.length(key) + 1
+        return int(np.searchsorted(hits, last_start) - np.searchsorted(hits, start))
+
+
+def test_motif_index():
+    fasta = {'chr1': 'TTGACTCATTTTTGAGTCAANNTGAGTCACCC'}
+    index = MotifIndex(fasta)
+    exact = index.add('TGASTCA')
+    loose = index.add('TGACTCA', abs_score=6)
+    assert list(index.hits(exact, 'chr1')) == [1, 12, 22]
+    assert list(index.hits(loose, 'chr1')) == [1, 12, 22]
+    # integer scores are relative as well
+    assert index.add('TGASTCA', score=1) == exact
+    assert list(index.hits(index.add('TGASTCA', score=0), 'chr1')) == \
+            [p for p in range(26) if 'N' not in fasta['chr1'][p:p + 7]]
+    assert index.count(exact, 'chr1', 0, 8) == 1
+    assert index.count(exact, 'chr1', 0, 7) == 0
+    assert index.count(exact, 'chr1', 1, 32) == 3
+    assert index.count(exact, 'chr1', 2, 32) == 2
+
+
+def test_motif_index_threads():
+    import threading
+    fasta = dict(('chr%d' % i, 'TTGACTCATTTTTGAGTCAANNTGAGTCACCC' * 50) for i in range(4))
+    index = MotifIndex(fasta)
+    scanned = []
+    scan = index._scan
+    def counting_scan(chrom, keys):
+        scanned.extend((chrom, key) for key in keys)
+        scan(chrom, keys)
+    index._scan = counting_scan
+    errors = []
+    def work(i):
+        try:
+            for j in range(20):
+                key = index.add('TGASTCA', abs_score=7 - (i + j) % 3)
+                for chrom in sorted(fasta):
+                    assert index.count(key, chrom, 0, len(fasta[chrom])) == 150
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    # every motif is scanned once per chromosome
+    assert len(scanned) == len(set(scanned))
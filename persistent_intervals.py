@@ -0,0 +1,235 @@
+"""
+Persistent (immutable) set of non-overlapping intervals.
+
+The intervals are kept in a treap ordered by start. Removing an interval
+returns a new set sharing all untouched nodes with the old one (path
+copying), so only O(log n) nodes are created and any number of versions
+can coexist. Copies are free, the set itself is never modified.
+"""
+
+import random
+
+_priorities = random.Random()
+
+
+class _Node(object):
+    __slots__ = ['start', 'stop', 'priority', 'left', 'right']
+
+    def __init__(self, start, stop, priority, left=None, right=None):
+        self.start = start
+        self.stop = stop
+        self.priority = priority
+        self.left = left
+        self.right = right
+
+
+def _with_children(node, left, right):
+    return _Node(node.start, node.stop, node.priority, left, right)
+
+
+def _split(node, key):
+    """
+    Split the treap to nodes with start < key and the others.
+    """
+    if node is None:
+        return None, None
+    if node.start < key:
+        left, right = _split(node.right, key)
+        return _with_children(node, node.left, left), right
+    left, right = _split(node.left, key)
+    return left, _with_children(node, right, node.right)
+
+
+def _merge(a, b):
+    """
+    Merge treaps, all starts in a are before the starts in b.
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.priority > b.priority:
+        return _with_children(a, a.left, _merge(a.right, b))
+    return _with_children(b, _merge(a, b.left), b.right)
+
+
+def _last(node):
+    if node is None:
+        return None
+    while node.right is not None:
+        node = node.right
+    return node
+
+
+def _without_last(node):
+    if node.right is None:
+        return node.left
+    return _with_children(node, node.left, _without_last(node.right))
+
+
+def _build(intervals):
+    """
+    Build treap of sorted intervals in O(n) (Cartesian tree on random
+    priorities).
+    """
+    stack = []
+    for start, stop in intervals:
+        node = _Node(start, stop, _priorities.random())
+        last = None
+        while stack and stack[-1].priority < node.priority:
+            last = stack.pop()
+        node.left = last
+        if stack:
+            stack[-1].right = node
+        stack.append(node)
+    return stack[0] if stack else None
+
+
+class PersistentIntervalSet(object):
+    """
+    Immutable sorted set of non-overlapping intervals [start, stop).
+    """
+    persistent = True
+
+    def __init__(self, intervals=(), _root=None):
+        """
+        intervals: iterable of (start, stop) tuples, sorted and
+            non-overlapping.
+        """
+        if _root is None:
+            intervals = list(intervals)
+            for (_, stop), (start, _) in zip(intervals[:-1], intervals[1:]):
+                if start < stop:
+                    raise ValueError('Intervals have to be sorted and non-overlapping.')
+            _root = _build(intervals)
+        self._root = _root
+
+    def removed(self, data):
+        """
+        Return new set without the interval data (it does not have to
+        explicitly appear in the set).
+        """
+        start, stop = data[0], data[1]
+        if start >= stop:
+            return self
+        before, rest = _split(self._root, start)
+        inside, after = _split(rest, stop)
+        pieces = []
+        last = _last(before)
+        if last is not None and last.stop > start:
+            # the last interval starting before overlaps
+            before = _without_last(before)
+            pieces += [(last.start, start)]
+            if last.stop > stop:
+                pieces += [(stop, last.stop)]
+        last = _last(inside)
+        if last is not None and last.stop > stop:
+            pieces += [(stop, last.stop)]
+        root = before
+        for piece in pieces:
+            root = _merge(root, _Node(piece[0], piece[1], _priorities.random()))
+        return PersistentIntervalSet(_root=_merge(root, after))
+
+    def copy(self):
+        return self
+
+    def __contains__(self, data):
+        """
+        Check whether the interval data is completely inside one of the intervals.
+        """
+        start, stop = data[0], data[1]
+        node = self._root
+        candidate = None
+        # find the last interval starting at or before start
+        while node is not None:
+            if node.start <= start:
+                candidate = node
+                node = node.right
+            else:
+                node = node.left
+        return candidate is not None and start < candidate.stop and stop <= candidate.stop \
+                and start < stop
+
+    def overlapping(self, start, stop):
+        """
+        Return list of intervals overlapping [start, stop), in order.
+        """
+        result = []
+        def visit(node):
+            if node is None:
+                return
+            if node.start > start:
+                visit(node.left)
+            if node.start < stop and node.stop > start:
+                result.append((node.start, node.stop))
+            if node.start < stop:
+                visit(node.right)
+        visit(self._root)
+        return result
+
+    def bounds(self):
+        """
+        Return (start of the first, stop of the last interval), None if empty.
+        """
+        if self._root is None:
+            return None
+        node = self._root
+        while node.left is not None:
+            node = node.left
+        return node.start, _last(self._root).stop
+
+    def __iter__(self):
+        stack = []
+        node = self._root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield (node.start, node.stop)
+            node = node.right
+
+    def __str__(self):
+        return '->'.join(str(i) for i in self)
+
+    def __getstate__(self):
+        return list(self)
+
+    def __setstate__(self, intervals):
+        self._root = _build(intervals)
+
+
+def test_removed():
+    from interval_linked_list import IntervalLinkedList
+    prng = random.Random(0)
+    base = PersistentIntervalSet([(0, 1000), (1500, 3000), (3100, 5000)])
+    reference = IntervalLinkedList([(0, 1000), (1500, 3000), (3100, 5000)])
+    versions = [(base, str(reference))]
+    current = base
+    for i in range(300):
+        start = prng.randint(-100, 5100)
+        data = (start, start + prng.randint(1, 400))
+        current = current.removed(data)
+        reference.remove(data)
+        # the linked list may keep empty intervals
+        assert list(current) == [i for i in reference if i[0] < i[1]]
+        versions += [(current, str(current))]
+        for _ in range(5):
+            start = prng.randint(-100, 5100)
+            data = (start, start + prng.randint(1, 300))
+            assert (data in current) == (data in reference)
+            assert current.overlapping(*data) == \
+                    [i for i in current if i[0] < data[1] and i[1] > data[0]]
+    # older versions are untouched
+    for version, s in versions:
+        assert str(version) == s
+    assert str(base) == '(0, 1000)->(1500, 3000)->(3100, 5000)'
+    assert base.bounds() == (0, 5000)
+
+
+def test_pickle():
+    import pickle
+    x = PersistentIntervalSet([(1, 10), (20, 30)]).removed((5, 25))
+    y = pickle.loads(pickle.dumps(x, pickle.HIGHEST_PROTOCOL))
+    assert list(y) == [(1, 5), (25, 30)]
+    assert (2, 4) in y and (4, 6) not in y
@@ -1,9 +1,13 @@
 import numpy as np
-from collections import namedtuple, Counter
+from collections import namedtuple, Counter, OrderedDict
 from interval_linked_list import IntervalLinkedList
-from pyfasta import Fasta
+from persistent_intervals import PersistentIntervalSet
+from run_bitmap import RunBitmap
+from fenwick import FenwickTree
+import cPickle as pickle
 import logging
-from kmers import all_kmers, count_kmers
+import os
+import threading
 
 Region = namedtuple('Region', ['chrom', 'start', 'stop', 'name'])
 
@@ -21,25 +25,88 @@ def regions_reader(*args):
     """
     for filename in args:
         with open(filename, 'r') as f:
-            for line in f:
-                line = line.rstrip('\r\n')
-                toks = line.split('\t', 4)
-                if len(toks) < 3:
-                    RuntimeError('At least 3 columns expected in input %s. Only %d found on line %s.' % \
-                            (filename, len(toks), line))
-                if len(toks) == 3:
-                    yield Region(chrom=toks[0], start=int(toks[1]), stop=int(toks[2]), name=None)
-                else:
-                    yield Region(chrom=toks[0], start=int(toks[1]), stop=int(toks[2]), name=toks[3])
+            for region in regions_parser(f, filename):
+                yield region
+
+
+def regions_parser(lines, filename='<input>'):
+    """
+    Provide generator access to regions in an iterable of BED lines.
+    """
+    for line in lines:
+        line = line.rstrip('\r\n')
+        toks = line.split('\t', 4)
+        if len(toks) < 3:
+            RuntimeError('At least 3 columns expected in input %s. Only %d found on line %s.' % \
+                    (filename, len(toks), line))
+        if len(toks) == 3:
+            yield Region(chrom=toks[0], start=int(toks[1]), stop=int(toks[2]), name=None)
+        else:
+            yield Region(chrom=toks[0], start=int(toks[1]), stop=int(toks[2]), name=toks[3])
+
+
+_fasta_cache = {}
+
+def open_fasta(filename):
+    """
+    Return Fasta object for the file, opened only once per process.
+
+    Fasta-like objects (eg. an attached genome store) are returned as they are.
+    """
+    if not isinstance(filename, basestring):
+        return filename
+    from pyfasta import Fasta
+    filename = os.path.abspath(filename)
+    if filename not in _fasta_cache:
+        _fasta_cache[filename] = Fasta(filename)
+    return _fasta_cache[filename]
 
 
 class RegionAcceptor(object):
+    """
+    Base class of acceptors deciding whether a candidate matches a template.
+
+    Subclasses either implement accept directly, or split the decision into
+    a template-independent feature of the candidate (feature) and its
+    comparison to the template (accept_feature). The latter allows features
+    to be cached (keyed by feature_key) and reused across templates.
+    """
+    feature_key = None
+    # False if the decision does not depend on the template at all
+    depends_on_template = True
+
     def __init__(self, template=None, fasta=None, **kwargs):
         self.template = template
         self.fasta = fasta
 
+    def feature(self, region):
+        raise NotImplementedError('Subclasses of RegionAcceptor have to implement this method.')
+
+    def accept_feature(self, value):
+        raise NotImplementedError('Subclasses of RegionAcceptor have to implement this method.')
+
     def accept(self, region):
-        raise NotImplemented('Subclasses of RegionAcceptor have to implement this method.')
+        return self.accept_feature(self.feature(region))
+
+    def accept_batch(self, chrom, starts, stops):
+        """
+        Return bool array, whether each of the regions on the chromosome is
+        accepted. Acceptors backed by sorted indexes evaluate all regions at
+        once.
+        """
+        return np.array([self.accept(Region(chrom, start, stop, None))
+            for start, stop in zip(starts, stops)], dtype=np.bool_)
+
+    def accept_cached(self, region, features):
+        """
+        Accept/reject region using (and filling) the dict of cached features.
+        """
+        key = self.feature_key
+        if key is None:
+            return self.accept(region)
+        if key not in features:
+            features[key] = self.feature(region)
+        return self.accept_feature(features[key])
 
     @property
     def reason(self):
@@ -57,24 +124,60 @@ def count_g_and_c(seq):
     return (np.in1d(list(seq), ['c', 'g', 'C', 'G'])).sum()
 
 
+_GC_LUT = np.zeros(256, dtype=np.bool_)
+_GC_LUT[[ord(c) for c in 'GCgc']] = True
+
+def gc_prefix_sums(seq):
+    """
+    Return array of numbers of C/G in seq[:i] for i in 0..len(seq).
+
+    seq: string or uint8 array
+    """
+    if not isinstance(seq, np.ndarray):
+        seq = np.frombuffer(str(seq), dtype=np.uint8)
+    gc = np.zeros(len(seq) + 1, dtype=np.uint32)
+    np.cumsum(_GC_LUT[seq], out=gc[1:])
+    return gc
+
+
+def relative_threshold(threshold, reference):
+    """
+    Return the threshold of an acceptor, relative to the reference (length,
+    count or distance of the template) if it is at most 1.
+
+    The rule is the same for all the acceptors and number types, eg. both
+    threshold=1 and threshold=1.0 allow differences up to the reference
+    itself.
+    """
+    if threshold == 0:
+        # also for infinite references
+        return 0
+    if threshold <= 1.:
+        return threshold * reference
+    return threshold
+
+
 class RegionAcceptorApproxGC(RegionAcceptor):
     """
     Acceptor of regions depending on the GC-content.
+
+    Uses GC prefix sums if fasta is a GenomeIndex.
     """
+    feature_key = ('GC', )
 
     def __init__(self, threshold=10, **kwargs):
         assert threshold >= 0
         super(RegionAcceptorApproxGC, self).__init__(**kwargs)
-        seq = self.fasta[self.template.chrom][self.template.start:self.template.stop]
-        self.gc = count_g_and_c(seq)
-        if threshold <= 1.:
-            self.threshold = threshold * len(seq)
-        else:
-            self.threshold = threshold
+        self.gc = self.feature(self.template)
+        self.threshold = relative_threshold(threshold, self.template.stop - self.template.start)
 
-    def accept(self, region):
+    def feature(self, region):
+        if hasattr(self.fasta, 'gc_count'):
+            return self.fasta.gc_count(region.chrom, region.start, region.stop)
         seq = self.fasta[region.chrom][region.start:region.stop]
-        gc = count_g_and_c(seq)
+        return count_g_and_c(seq)
+
+    def accept_feature(self, gc):
         diff = abs(self.gc - gc)
         if diff <= self.threshold:
             self._reason_args = True
@@ -83,17 +186,78 @@ class RegionAcceptorApproxGC(RegionAcceptor):
             self._reason_args = ('difference %d', diff)
             return False
 
+class RegionAcceptorGCProfile(RegionAcceptor):
+    """
+    Acceptor of regions depending on the GC-content in bins along the region.
+
+    Bin counts are differences of GC prefix sums at the bin edges, taken
+    from the GenomeIndex (if fasta is one) for any number of regions at
+    once, or computed from the sequence of the region otherwise.
+    """
+
+    def __init__(self, bins=10, threshold=5, **kwargs):
+        """
+        bins: int
+            Number of bins of (nearly) equal length.
+        threshold: number
+            Allowed difference of GC counts in each bin. Thresholds up to 1
+            are relative to the bin length (see relative_threshold).
+        """
+        assert bins > 0 and threshold >= 0
+        super(RegionAcceptorGCProfile, self).__init__(**kwargs)
+        length = self.template.stop - self.template.start
+        if bins > length:
+            raise ValueError('More bins (%d) than nucleotides (%d).' % (bins, length))
+        self.edges = np.linspace(0, length, bins + 1).astype(np.int64)
+        self.feature_key = ('GCProfile', bins)
+        self.profile = self.feature(self.template)
+        self.threshold = relative_threshold(threshold, np.diff(self.edges))
+
+    def _profiles(self, chrom, starts):
+        edges = np.asarray(starts, dtype=np.int64)[:, None] + self.edges[None, :]
+        if hasattr(self.fasta, 'gc_counts'):
+            return self.fasta.gc_counts(chrom, edges)
+        length = self.edges[-1]
+        return np.array([np.diff(gc_prefix_sums(
+            self.fasta[chrom][start:start + length])[self.edges].astype(np.int64))
+            for start in starts]).reshape(len(starts), len(self.edges) - 1)
+
+    def feature(self, region):
+        return self._profiles(region.chrom, [region.start])[0]
+
+    def accept_feature(self, profile):
+        diff = np.abs(profile - self.profile)
+        if (diff <= self.threshold).all():
+            self._reason_args = True
+            return True
+        else:
+            worst = diff.argmax()
+            self._reason_args = ('bin %d differs by %d', worst, diff[worst])
+            return False
+
+    def accept_batch(self, chrom, starts, stops):
+        diff = np.abs(self._profiles(chrom, starts) - self.profile)
+        return (diff <= self.threshold).all(axis=1)
+
+
 class RegionAcceptorNoNs(RegionAcceptor):
     """
     Acceptor of regions requiring no unknown (N) nucleotides.
     """
+    feature_key = ('NoNs', )
+    depends_on_template = False
 
     def __init__(self, **kwargs):
         super(RegionAcceptorNoNs, self).__init__(**kwargs)
 
-    def accept(self, region):
+    def feature(self, region):
+        if hasattr(self.fasta, 'has_n'):
+            return not self.fasta.has_n(region.chrom, region.start, region.stop)
         seq = self.fasta[region.chrom][region.start:region.stop]
-        if not 'N' in seq and 'n' not in seq:
+        return not 'N' in seq and 'n' not in seq
+
+    def accept_feature(self, no_ns):
+        if no_ns:
             self._reason_args = True
             return True
         else:
@@ -131,9 +295,9 @@ class GenomicAnnotationsHistogram(object):
         Parameters:
         ===========
         filename: string
-            FASTA file with genomic annotations.
+            FASTA file with genomic annotations (or a Fasta-like object).
         """
-        self.regions_fa = Fasta(filename)
+        self.regions_fa = open_fasta(filename)
 
     def __call__(self, region):
         """
@@ -169,13 +333,17 @@ class RegionAcceptorApproxHistogram(RegionAcceptor):
         self.histogram = histogram
         self.dissimilarity = dissimilarity
         self.threshold = threshold
+        self.feature_key = ('histogram', id(self.histogram))
         self.template_hist = self.histogram(self.template)
         if self.template_hist is None:
-            raise ValueError, 'Cannot generate a matching region for %s' % self.template
+            raise ValueError('Cannot generate a matching region for %s' % self.template)
 
-    def accept(self, region):
-        hist = self.histogram(region)
+    def feature(self, region):
+        return self.histogram(region)
+
+    def accept_feature(self, hist):
         if hist is None:
+            self._reason_args = ('no histogram', )
             return False
         dis = self.dissimilarity(self.template_hist, hist)
         if dis < self.threshold:
@@ -188,7 +356,7 @@ class RegionAcceptorApproxHistogram(RegionAcceptor):
 
 class GenomicAnnotationsAtPosition(object):
     def __init__(self, filename):
-        self.regions_fa = Fasta(filename)
+        self.regions_fa = open_fasta(filename)
 
     def __call__(self, chrom, position):
         return self.regions_fa[chrom][position]
@@ -199,21 +367,30 @@ class RegionAcceptorGenomicAnnotation(RegionAcceptor):
         """
         filename: string
             File with genomic annotations for the whole genome encoded in fasta format.
-            (Use encode_annotations.py to create it.)
+            (Use encode_annotations.py to create it.) Fasta-like objects are
+            accepted as well.
         pos: int
             Take into account only a single position (eg. peak summit, 0 == 1st bp)
 
         Exactly one option of either position or dissimilarity-and-threshold has to be specified.
+
+        If filename is None, annotations are taken from fasta (GenomeIndex).
         """
         super(RegionAcceptorGenomicAnnotation, self).__init__(**kwargs)
-        self.ga = GenomicAnnotationsAtPosition(filename)
+        if filename is None:
+            self.ga = self.fasta.annotation_at
+        else:
+            self.ga = GenomicAnnotationsAtPosition(filename)
         self.position = int(pos)
+        self.feature_key = ('GAPos', filename, self.position)
         self.template_ga = self.ga(
                 self.template.chrom, self.template.start + self.position)
         assert pos >= 0 and pos < (self.template.stop - self.template.start)
 
-    def accept(self, region):
-        ga = self.ga(region.chrom, region.start + self.position)
+    def feature(self, region):
+        return self.ga(region.chrom, region.start + self.position)
+
+    def accept_feature(self, ga):
         if self.template_ga == ga:
             self._reason_args = True
             return True
@@ -222,39 +399,316 @@ class RegionAcceptorGenomicAnnotation(RegionAcceptor):
             return False
 
 
+def kmers_module():
+    """
+    Return the compiled kmers module if available, kmers_np otherwise.
+    """
+    try:
+        import kmers
+    except ImportError:
+        import kmers_np as kmers
+    return kmers
+
+
 class KmerHistogram(object):
     """
     Wraps computation of histograms of k-mers.
+
+    Uses k-mer codes if fasta is a GenomeIndex built for k.
     """
     def __init__(self, fasta, k=2):
         self.fasta = fasta
         self.k = k
-        self.keys = all_kmers(self.k)
+        self.indexed = k in getattr(fasta, 'kmer_k', ())
+        self.kmers = kmers_module()
+        self.keys = self.kmers.all_kmers(self.k)
 
     def __call__(self, region):
         """
         Compute the k-mer histogram for a given region.
         """
+        if self.indexed:
+            counts = self.fasta.kmer_counts(self.k, region.chrom, region.start, region.stop)
+            if counts is None:
+                return None
+            return dict(zip(self.keys, counts))
         seq = self.fasta[region.chrom][region.start:region.stop]
         if not np.in1d(list(str(seq).upper()), list('ACGT')).all():
             return None
-        return dict(zip(self.keys, count_kmers(self.k, str(seq).upper())))
+        return dict(zip(self.keys, self.kmers.count_kmers(self.k, str(seq).upper())))
+
+
+class RegionAcceptorMotifCount(RegionAcceptor):
+    """
+    Acceptor of regions depending on the number of motif hits (both strands).
+
+    Hits are looked up in a motifs.MotifIndex shared by all acceptors.
+    """
+
+    def __init__(self, index=None, key=None, threshold=0, **kwargs):
+        """
+        index: motifs.MotifIndex
+        key: motif key returned by index.add
+        threshold: number
+            Allowed difference of motif counts. Thresholds up to 1 are
+            relative to the template count (see relative_threshold).
+        """
+        assert threshold >= 0
+        super(RegionAcceptorMotifCount, self).__init__(**kwargs)
+        self.index = index
+        self.key = key
+        self.feature_key = ('Motif', id(index), key)
+        self.count = self.feature(self.template)
+        self.threshold = relative_threshold(threshold, self.count)
+
+    def feature(self, region):
+        return self.index.count(self.key, region.chrom, region.start, region.stop)
+
+    def accept_feature(self, count):
+        diff = abs(self.count - count)
+        if diff <= self.threshold:
+            self._reason_args = True
+            return True
+        else:
+            self._reason_args = ('%d motifs instead of %d', count, self.count)
+            return False
+
+
+class FeatureIndex(object):
+    """
+    Features (eg. BED regions) as per-chromosome sorted arrays.
+
+    Starts and stops are sorted independently, so the number of features
+    overlapping a window costs two binary searches. Sorted midpoints give
+    the distance to the nearest feature with a single binary search.
+    """
+
+    def __init__(self, regions):
+        by_chrom = {}
+        for r in regions:
+            by_chrom.setdefault(r.chrom, []).append((r.start, r.stop))
+        self._starts = {}
+        self._stops = {}
+        self._midpoints = {}
+        for chrom, intervals in by_chrom.items():
+            intervals = np.array(intervals, dtype=np.int64)
+            self._starts[chrom] = np.sort(intervals[:, 0])
+            self._stops[chrom] = np.sort(intervals[:, 1])
+            self._midpoints[chrom] = np.sort(intervals.sum(axis=1) / 2.)
+
+    def __len__(self):
+        return sum(len(starts) for starts in self._starts.values())
+
+    def count(self, chrom, start, stop):
+        """
+        Count features overlapping [start, stop).
+
+        start and stop can be arrays (counts of many windows at once).
+        """
+        if chrom not in self._starts:
+            return np.zeros(np.shape(start), dtype=np.int64) if np.ndim(start) else 0
+        # features starting before the stop, less those ending before the start
+        count = np.searchsorted(self._starts[chrom], stop, side='left') - \
+                np.searchsorted(self._stops[chrom], start, side='right')
+        return count if np.ndim(count) else int(count)
+
+    def distance(self, chrom, start, stop):
+        """
+        Distance of the midpoint of [start, stop) to the nearest feature
+        midpoint, inf if there is no feature on the chromosome.
+
+        start and stop can be arrays (distances of many windows at once).
+        """
+        midpoint = (np.asarray(start) + np.asarray(stop)) / 2.
+        if chrom not in self._midpoints:
+            return np.full(np.shape(midpoint), np.inf) if np.ndim(midpoint) else np.inf
+        features = self._midpoints[chrom]
+        i = np.searchsorted(features, midpoint)
+        # nearest feature is either the last one before or the first one after
+        before = midpoint - features[np.maximum(i - 1, 0)]
+        after = features[np.minimum(i, len(features) - 1)] - midpoint
+        distance = np.minimum(np.abs(before), np.abs(after))
+        return distance if np.ndim(distance) else float(distance)
+
+
+_feature_index_cache = {}
+
+def open_features(filename):
+    """
+    Return FeatureIndex of a BED file, loaded only once per process.
+    """
+    filename = os.path.abspath(filename)
+    if filename not in _feature_index_cache:
+        get_log('features').info('Loading features from %s', filename)
+        _feature_index_cache[filename] = FeatureIndex(regions_reader(filename))
+    return _feature_index_cache[filename]
 
 
 class RegionAcceptorFeatureCount(RegionAcceptor):
-    def __init__(self, filename=None, threshold=None, **kwargs):
-        raise NotImplemented
-        #super(RegionAcceptorFeatureCount, self).__init__(**kwargs)
-        #assert threshold > 0
-        #self.threshold = threshold
-        #cnt = self.template
-        #self.lb = None
-        #self.ub = None
+    """
+    Acceptor of regions depending on the number of overlapping features.
+    """
 
-    def accept(self, region):
-        #cnt = ...
-        #return (cnt > self.lb) and (cnt < self.ub)
-        raise NotImplemented
+    def __init__(self, filename=None, threshold=0, **kwargs):
+        """
+        filename: string
+            BED file with the features (enhancers, TSSs, repeats, ...).
+        threshold: number
+            Allowed difference of feature counts. Thresholds up to 1 are
+            relative to the template count (see relative_threshold).
+        """
+        assert threshold >= 0
+        super(RegionAcceptorFeatureCount, self).__init__(**kwargs)
+        self.features = open_features(filename)
+        self.feature_key = ('FeatCount', os.path.abspath(filename))
+        self.count = self.feature(self.template)
+        self.threshold = relative_threshold(threshold, self.count)
+
+    def feature(self, region):
+        return self.features.count(region.chrom, region.start, region.stop)
+
+    def accept_feature(self, count):
+        diff = abs(self.count - count)
+        if diff <= self.threshold:
+            self._reason_args = True
+            return True
+        else:
+            self._reason_args = ('%d features instead of %d', count, self.count)
+            return False
+
+    def accept_batch(self, chrom, starts, stops):
+        counts = self.features.count(chrom, np.asarray(starts), np.asarray(stops))
+        return np.abs(counts - self.count) <= self.threshold
+
+
+class RegionAcceptorFeatureDistance(RegionAcceptor):
+    """
+    Acceptor of regions depending on the distance to the nearest feature
+    (eg. TSS), measured between midpoints.
+    """
+
+    def __init__(self, filename=None, threshold=0, **kwargs):
+        """
+        filename: string
+            BED file with the features.
+        threshold: number
+            Allowed difference of distances (bp). Thresholds up to 1 are
+            relative to the template distance (see relative_threshold).
+        """
+        assert threshold >= 0
+        super(RegionAcceptorFeatureDistance, self).__init__(**kwargs)
+        self.features = open_features(filename)
+        self.feature_key = ('Dist', os.path.abspath(filename))
+        self.distance = self.feature(self.template)
+        self.threshold = relative_threshold(threshold, self.distance)
+
+    def feature(self, region):
+        return self.features.distance(region.chrom, region.start, region.stop)
+
+    def _accept(self, distance):
+        # inf == inf if there are no features on the chromosome at all
+        with np.errstate(invalid='ignore'):
+            return (distance == self.distance) | \
+                    (np.abs(distance - self.distance) <= self.threshold)
+
+    def accept_feature(self, distance):
+        if self._accept(distance):
+            self._reason_args = True
+            return True
+        else:
+            self._reason_args = ('distance %g instead of %g', distance, self.distance)
+            return False
+
+    def accept_batch(self, chrom, starts, stops):
+        return self._accept(self.features.distance(chrom, starts, stops))
+
+
+class CandidatePool(object):
+    """
+    Bounded pool of scored candidates rejected for previous templates.
+
+    Candidates are kept per (chrom, length) together with their cached
+    features (see RegionAcceptor.accept_cached). When the pool is full, the
+    oldest candidate is evicted.
+
+    Changes can be journaled (see start_journal), replaying the journal on a
+    copy of the pool brings it to the same state.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._candidates = {}
+        self._order = OrderedDict()
+        self._journal = None
+
+    def start_journal(self):
+        """
+        Start journaling the changes (drops the changes journaled so far).
+        """
+        self._journal = []
+
+    def take_journal(self):
+        """
+        Return the changes journaled since the last call, start a new journal.
+        """
+        journal, self._journal = self._journal, []
+        return journal or []
+
+    def replay(self, journal):
+        """
+        Apply changes returned by take_journal.
+        """
+        for change in journal:
+            if change[0] == 'add':
+                self.add(change[1], change[2])
+            else:
+                self.discard(change[1])
+
+    def __len__(self):
+        return len(self._order)
+
+    def add(self, region, features):
+        """
+        Add a candidate region with its dict of cached features.
+        """
+        if self.max_size <= 0:
+            return
+        if self._journal is not None:
+            self._journal.append(('add', region, features))
+        key = (region.chrom, region.stop - region.start)
+        if key not in self._candidates:
+            self._candidates[key] = OrderedDict()
+        self._candidates[key][region.start] = (region, features)
+        self._order[(key, region.start)] = None
+        while len(self._order) > self.max_size:
+            (key, start), _ = self._order.popitem(last=False)
+            self._discard(key, start)
+
+    def candidates(self, chrom, length):
+        """
+        Return list of (region, features) pooled for the chromosome and length.
+        """
+        if (chrom, length) not in self._candidates:
+            return []
+        return self._candidates[(chrom, length)].values()
+
+    def discard(self, region):
+        """
+        Remove the candidate region from the pool.
+        """
+        if self._journal is not None:
+            self._journal.append(('discard', region))
+        key = (region.chrom, region.stop - region.start)
+        if self._discard(key, region.start):
+            del self._order[(key, region.start)]
+
+    def _discard(self, key, start):
+        if key not in self._candidates or start not in self._candidates[key]:
+            return False
+        del self._candidates[key][start]
+        if len(self._candidates[key]) == 0:
+            del self._candidates[key]
+        return True
 
 
 class AllowedSpace(object):
@@ -262,56 +716,310 @@ class AllowedSpace(object):
     Represent remaining available space where new regions are allowed.
     """
 
-    def __init__(self, fasta=None, include=None, exclude=None):
+    def __init__(self, fasta=None, include=None, exclude=None, chroms=None,
+            persistent=False, bitmap=False):
         """
         fasta - pyfasta.Fasta object
         include - iterable of Region-s
         exclude - iterable of Region-s
+        chroms - restrict the space to these chromosomes (regions on other
+          chromosomes are ignored)
+        persistent - keep the intervals in immutable PersistentIntervalSet-s
+          instead of linked lists: forks take O(1) per chromosome and removals
+          never touch the intervals shared with other forks
+        bitmap - keep the intervals in RunBitmap-s (immutable as well): bulk
+          set algebra with tracks (intersect, union, subtract) and sampling
+          of valid starts without rejections
         """
-        logger = get_log('AllowedSpace')
         if include is None and fasta is None:
             raise ValueError('Either include or fasta have to be specified.')
-        self._range = {}
-        self._space = {}
+        self._intervals_type = _intervals_type(persistent, bitmap)
+        self._fasta = fasta
+        self._range = _ForkableDict()
+        self._space = _ForkableDict()
+        # chromosomes not built yet: chrom -> _PendingChrom
+        self._pending = _ForkableDict()
+        # chromosomes whose interval lists are shared with a fork (besides
+        # those inherited from the space this one was forked from)
+        self._shared = set()
+        if chroms is not None:
+            chroms = set(chroms)
+            if include is not None:
+                include = (r for r in include if r.chrom in chroms)
+            if exclude is not None:
+                exclude = (r for r in exclude if r.chrom in chroms)
         if include is None:
             for k in fasta.keys():
-                self._space[k] = IntervalLinkedList([(0, len(fasta[k]))])
+                if chroms is None or k in chroms:
+                    self._pending[k] = _PendingChrom(self._intervals_type, len(fasta[k]))
         else:
-            intervals = {}
             for region in include:
                 if region.start >= region.stop:
                     raise ValueError('Region %r is invalid (start >= stop).' % region)
-                if region.chrom not in intervals:
-                    intervals[region.chrom] = []
-                intervals[region.chrom] += [(region.start, region.stop)]
-            for k, v in intervals.items():
-                pos = v[0][0]
-                is_sorted = True
-                for start, stop in v:
-                    is_sorted = is_sorted and start >= pos
-                    pos = stop
-                if is_sorted:
-                    self._space[k] = IntervalLinkedList(v)
-                else:
-                    logger.warn('Sorting %d include regions for chromosome %s.' % (len(intervals), k))
-                    self._space[k] = IntervalLinkedList(sorted(v))
+                if region.chrom not in self._pending:
+                    self._pending[region.chrom] = _PendingChrom(self._intervals_type)
+                self._pending[region.chrom].include.append((region.start, region.stop))
         if exclude is not None:
             for region in exclude:
-                self._space[region.chrom].remove((region.start, region.stop))
-        for k in self._space.keys():
-            self._update_range(k)
+                self._pending[region.chrom].excluded.append((region.start, region.stop))
+        self._init_weights()
+
+
+    def _chrom_space(self, chrom):
+        """
+        Return intervals of the chromosome, built on the first use.
+        """
+        if chrom in self._pending:
+            pending = self._pending.pop(chrom)
+            self._space[chrom] = pending.build(chrom)
+            if pending.shared:
+                # built once for all the forks sharing it
+                self._shared.add(chrom)
+            self._update_range(chrom)
+        return self._space[chrom]
+
+
+    def _init_weights(self):
+        self._chroms = sorted(set(self._space.keys()) | set(self._pending.keys()))
+        self._chrom_index = dict((chrom, i) for i, chrom in enumerate(self._chroms))
+        # length -> FenwickTree of numbers of placements per chromosome
+        self._weights = OrderedDict()
+        # lengths whose trees are not shared with a fork, None if the whole
+        # dictionary is shared
+        self._owned_weights = set()
+
+
+    def _own_weights(self, length=None):
+        """
+        Copy the placement weights shared with a fork before modifying them,
+        return the tree of the length (if given).
+        """
+        if self._owned_weights is None:
+            self._weights = OrderedDict(self._weights)
+            self._owned_weights = set()
+        if length is None:
+            return None
+        if length not in self._owned_weights:
+            self._weights[length] = self._weights[length].copy()
+            self._owned_weights.add(length)
+        return self._weights[length]
 
 
     def remove(self, region):
         """
         Remove region from the allowed space.
         """
-        self._space[region.chrom].remove((region.start, region.stop))
+        space = self._chrom_space(region.chrom)
+        if self._weights:
+            overlapping = _overlapping(space, region.start, region.stop)
+        self._remove_interval(region.chrom, (region.start, region.stop))
         self._update_range(region.chrom)
+        if self._weights and overlapping:
+            # only the overlapping intervals change, to at most two pieces
+            remaining = []
+            if overlapping[0][0] < region.start:
+                remaining += [(overlapping[0][0], region.start)]
+            if overlapping[-1][1] > region.stop:
+                remaining += [(region.stop, overlapping[-1][1])]
+            i = self._chrom_index[region.chrom]
+            for length in list(self._weights):
+                self._own_weights(length).add(i,
+                        _placements(remaining, length) - _placements(overlapping, length))
+
+
+    def _remove_interval(self, chrom, interval):
+        space = self._space[chrom]
+        if getattr(space, 'persistent', False):
+            self._space[chrom] = space.removed(interval)
+            return
+        if chrom in self._shared or not self._space.owns(chrom):
+            space = self._space[chrom] = space.copy()
+            self._shared.discard(chrom)
+        space.remove(interval)
+
+
+    MAX_WEIGHTED_LENGTHS = 64
+
+    def placement_weights(self, length):
+        """
+        Return FenwickTree of numbers of placements of a region of the length
+        per chromosome (ordered as self.chromosomes()).
+
+        Trees of the recently used lengths are kept updated by remove.
+        """
+        self._own_weights()
+        if length in self._weights:
+            weights = self._weights.pop(length)
+        else:
+            weights = FenwickTree([_placements(self._chrom_space(chrom), length)
+                for chrom in self._chroms])
+            self._owned_weights.add(length)
+            if len(self._weights) >= self.MAX_WEIGHTED_LENGTHS:
+                self._owned_weights.discard(self._weights.popitem(last=False)[0])
+        self._weights[length] = weights
+        return weights
+
+
+    def chromosomes(self):
+        return self._chroms
+
+
+    def intersect(self, regions):
+        """
+        Keep only the space covered by the regions (eg. a mappability track).
+        """
+        self._apply_track(regions, RunBitmap.intersection)
+
+
+    def union(self, regions):
+        """
+        Add the space covered by the regions.
+        """
+        self._apply_track(regions, RunBitmap.union)
+
+
+    def subtract(self, regions):
+        """
+        Remove the space covered by the regions (eg. a blacklist track), in
+        bulk unlike remove.
+        """
+        self._apply_track(regions, RunBitmap.difference)
+
+
+    def _apply_track(self, regions, operation):
+        track = {}
+        for region in regions:
+            track.setdefault(region.chrom, []).append((region.start, region.stop))
+        empty = RunBitmap()
+        for chrom in set(self._chroms) | set(track):
+            if chrom in self._chroms:
+                space = self._chrom_space(chrom)
+                if not isinstance(space, RunBitmap):
+                    space = RunBitmap(self.intervals(chrom))
+            else:
+                space = empty
+            result = operation(space, RunBitmap(track[chrom]) if chrom in track else empty)
+            if chrom not in self._chroms and not len(result):
+                continue
+            if self._intervals_type is not RunBitmap:
+                result = self._intervals_type(list(result))
+            self._space[chrom] = result
+            self._shared.discard(chrom)
+            self._update_range(chrom)
+        self._init_weights()
+
+
+    def random_start(self, chrom, length, prng):
+        """
+        Return start of a region of the length drawn uniformly from all its
+        placements on the chromosome, None if the intervals do not support
+        select (only RunBitmap-s do).
+        """
+        space = self._chrom_space(chrom)
+        if not isinstance(space, RunBitmap):
+            return None
+        placements = space.placements(length)
+        if placements <= 0:
+            raise RuntimeError('No space left on %s for a region of length %d.' % (chrom, length))
+        return space.select(prng.randint(placements), length)
+
+
+    def intervals(self, chrom):
+        """
+        Return list of the remaining (start, stop) intervals of the chromosome.
+        """
+        return [i for i in self._chrom_space(chrom) if i[0] < i[1]]
+
+
+    def random_chrom(self, length, prng):
+        """
+        Return chromosome chosen with probability proportional to its number
+        of placements of a region of the length.
+        """
+        weights = self.placement_weights(length)
+        total = weights.total()
+        if total <= 0:
+            raise RuntimeError('No space left for a region of length %d.' % length)
+        return self._chroms[weights.find(prng.randint(total))]
+
+
+    def fork(self):
+        """
+        Return a copy of the space, in O(1) (amortized).
+
+        Interval lists are shared by both spaces and copied only once one of
+        them removes a region from the given chromosome. Persistent interval
+        sets are never copied (see PersistentIntervalSet). Chromosomes not
+        built yet stay pending in both spaces, the first one using a
+        chromosome builds it for both. Placement weights are copied per
+        length on the first removal.
+        """
+        # the pending builders forked before were marked shared then
+        for pending in self._pending.own_values():
+            pending.shared = True
+        other = AllowedSpace.__new__(AllowedSpace)
+        other._intervals_type = self._intervals_type
+        other._fasta = self._fasta
+        other._range = self._range.fork()
+        other._space = self._space.fork()
+        other._pending = self._pending.fork()
+        # the forked entries are shared now, no own ones are left
+        other._shared = set()
+        self._shared = set()
+        other._chroms = self._chroms
+        other._chrom_index = self._chrom_index
+        other._weights = self._weights
+        other._owned_weights = self._owned_weights = None
+        return other
+
+
+    def save(self, filename):
+        """
+        Save the intervals of the space to a file (see AllowedSpace.load).
+
+        The file is replaced atomically, concurrent jobs never load a partial
+        space.
+        """
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as fw:
+            pickle.dump(dict((chrom, self.intervals(chrom)) for chrom in self._chroms),
+                    fw, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, filename)
+
+
+    @staticmethod
+    def load(filename, persistent=True, bitmap=False):
+        """
+        Return the space saved by AllowedSpace.save.
+
+        The space is persistent by default, so that it can be used as a base
+        space forked cheaply per job.
+        """
+        with open(filename, 'rb') as f:
+            intervals = pickle.load(f)
+        space = AllowedSpace.__new__(AllowedSpace)
+        space._intervals_type = _intervals_type(persistent, bitmap)
+        space._fasta = None
+        space._range = _ForkableDict()
+        space._space = _ForkableDict()
+        space._pending = _ForkableDict()
+        space._shared = set()
+        for chrom, v in intervals.items():
+            space._space[chrom] = space._intervals_type(v)
+            space._update_range(chrom)
+        space._init_weights()
+        return space
 
 
     def _update_range(self, chrom):
+        if getattr(self._space[chrom], 'persistent', False):
+            self._range[chrom] = self._space[chrom].bounds() or (0, 0)
+            return
         current = self._space[chrom].next
+        if current is None:
+            # no space left on the chromosome
+            self._range[chrom] = (0, 0)
+            return
         start = current.data[0]
         while current is not None:
             stop = current.data[1]
@@ -323,13 +1031,183 @@ class AllowedSpace(object):
         """
         Check whether the given region is fully inside this space.
         """
-        return region.chrom in self._space and (region.start, region.stop) in self._space[region.chrom]
+        return (region.chrom in self._space or region.chrom in self._pending) and \
+                (region.start, region.stop) in self._chrom_space(region.chrom)
 
 
     def range(self, chrom):
+        self._chrom_space(chrom)
         return self._range[chrom]
 
 
+class _ForkableDict(object):
+    """
+    Dictionary forked in O(1) (amortized).
+
+    Entries set before a fork are frozen into layers shared by both
+    dictionaries, later changes go to a layer of their own. A new frozen
+    layer is merged with the older ones while it is not smaller, so lookups
+    check O(log n) layers and each entry is merged O(log n) times.
+    """
+    _DELETED = object()
+
+    def __init__(self, items=(), _layers=()):
+        self._own = dict(items)
+        # frozen dictionaries shared with forks, newest first
+        self._layers = _layers
+
+    def _lookup(self, key):
+        if key in self._own:
+            return self._own[key]
+        for layer in self._layers:
+            if key in layer:
+                return layer[key]
+        return self._DELETED
+
+    def owns(self, key):
+        """
+        Check whether the entry was set after the last fork.
+        """
+        return self._own.get(key, self._DELETED) is not self._DELETED
+
+    def __contains__(self, key):
+        return self._lookup(key) is not self._DELETED
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is self._DELETED:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is self._DELETED else value
+
+    def __setitem__(self, key, value):
+        self._own[key] = value
+
+    def pop(self, key):
+        value = self[key]
+        if self._layers:
+            self._own[key] = self._DELETED
+        else:
+            del self._own[key]
+        return value
+
+    def _merged(self):
+        merged = {}
+        for layer in reversed((self._own,) + self._layers):
+            merged.update(layer)
+        return merged
+
+    def keys(self):
+        return [k for k, v in self._merged().iteritems() if v is not self._DELETED]
+
+    def own_values(self):
+        return [v for v in self._own.itervalues() if v is not self._DELETED]
+
+    def __len__(self):
+        return len(self.keys())
+
+    def fork(self):
+        if self._own:
+            layers = (self._own,) + self._layers
+            while len(layers) > 1 and len(layers[0]) >= len(layers[1]):
+                merged = dict(layers[1])
+                merged.update(layers[0])
+                if len(layers) == 2:
+                    merged = dict((k, v) for k, v in merged.iteritems()
+                            if v is not self._DELETED)
+                layers = (merged,) + layers[2:]
+            self._layers = layers
+            self._own = {}
+        return _ForkableDict(_layers=self._layers)
+
+
+class _PendingChrom(object):
+    """
+    Intervals of a chromosome of AllowedSpace built on the first use.
+
+    Shared by the forks of the space, built only once for all of them.
+    """
+
+    def __init__(self, intervals_type, length=None):
+        """
+        length: int
+            Chromosome length, the whole chromosome is included if given,
+            otherwise the intervals in include.
+        """
+        self.intervals_type = intervals_type
+        self.include = None if length is not None else []
+        self.length = length
+        self.excluded = []
+        # True once forks share it, the built intervals must not be modified then
+        self.shared = False
+        self._built = None
+        self._lock = threading.Lock()
+
+    def build(self, chrom):
+        with self._lock:
+            if self._built is None:
+                self._built = self._build(chrom)
+                self.include = self.excluded = None
+            return self._built
+
+    def _build(self, chrom):
+        intervals = self.include
+        if intervals is None:
+            intervals = [(0, self.length)]
+        elif intervals:
+            pos = intervals[0][0]
+            is_sorted = True
+            for start, stop in intervals:
+                is_sorted = is_sorted and start >= pos
+                pos = stop
+            if not is_sorted:
+                get_log('AllowedSpace').warn('Sorting %d include regions for chromosome %s.' % \
+                        (len(intervals), chrom))
+                intervals = sorted(intervals)
+        space = self.intervals_type(intervals)
+        if self.excluded and self.intervals_type is RunBitmap:
+            return space.difference(RunBitmap(self.excluded))
+        for interval in self.excluded:
+            if getattr(space, 'persistent', False):
+                space = space.removed(interval)
+            else:
+                space.remove(interval)
+        return space
+
+
+def _intervals_type(persistent, bitmap):
+    if bitmap:
+        return RunBitmap
+    return PersistentIntervalSet if persistent else IntervalLinkedList
+
+
+def _overlapping(intervals, start, stop):
+    """
+    Return list of the intervals overlapping [start, stop).
+    """
+    if getattr(intervals, 'persistent', False):
+        return intervals.overlapping(start, stop)
+    overlapping = []
+    for i_start, i_stop in intervals:
+        if i_start >= stop:
+            break
+        if i_stop > start:
+            overlapping += [(i_start, i_stop)]
+    return overlapping
+
+
+def _placements(intervals, length):
+    """
+    Number of placements of a region of the length inside the intervals.
+    """
+    if isinstance(intervals, RunBitmap):
+        return intervals.placements(length)
+    return sum(max(0, stop - start - length + 1) for start, stop in intervals)
+
+
 def the_random_regions_lair(region, lo, hi, prng=None):
     """
     Infinite generator of a random regions in the interval [lo, hi).
@@ -344,13 +1222,30 @@ def the_random_regions_lair(region, lo, hi, prng=None):
         yield Region(chrom=region.chrom, start=start, stop=stop, name='rnd_' + region.name)
 
 
-def generate(input_region, allowed_space, max_generate_iter=10000, prng=None):
+def generate(input_region, allowed_space, max_generate_iter=10000, prng=None,
+        cross_chrom=False):
     """
     Generate a random region for the given region and in the allowed space.
+
+    If cross_chrom is True, the region is placed on any chromosome, chosen
+    with probability proportional to its remaining placements.
     """
     logger = get_log('generate')
     i = 0
+    if cross_chrom:
+        chrom = allowed_space.random_chrom(input_region.stop - input_region.start, prng)
+        input_region = input_region._replace(chrom=chrom)
     lo, hi = allowed_space.range(input_region.chrom)
+    if lo >= hi:
+        raise RuntimeError('No space left on %s.' % input_region.chrom)
+    length = input_region.stop - input_region.start
+    start = allowed_space.random_start(input_region.chrom, length, prng)
+    if start is not None:
+        # no rejections, the start is drawn from the valid ones only
+        region = Region(chrom=input_region.chrom, start=start, stop=start + length,
+                name='rnd_' + input_region.name)
+        logger.debug('GEN %s', region)
+        return region
     for region in the_random_regions_lair(input_region, lo, hi, prng=prng):
         if allowed_space.contains(region):
             logger.debug('GEN %s', region)
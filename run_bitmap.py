@@ -0,0 +1,372 @@
+"""
+Run-container bitmap of positions on a chromosome.
+
+The set bits are kept as sorted arrays of run starts and stops (like the
+run containers of roaring bitmaps), so set algebra with whole tracks
+(union, intersection, difference) is a single vectorized sweep over the
+run boundaries. Membership of a window is a binary search, uniform sampling
+of valid starts of a window is select over the cumulative numbers of
+placements per run.
+
+The runs are split into chunks of at most 2 * CHUNK_SIZE runs. Removing an
+interval copies only the chunks it touches (the others are shared with the
+original bitmap) and updates the cached numbers of placements per chunk,
+so sampling and removing a region does not copy or rescan all the runs.
+
+RunBitmap is immutable, operations return new bitmaps.
+"""
+
+from collections import OrderedDict
+import numpy as np
+
+CHUNK_SIZE = 512
+
+
+class RunBitmap(object):
+    """
+    Immutable set of positions stored as runs [start, stop).
+    """
+    persistent = True
+    # number of window lengths whose placements per chunk are kept updated
+    MAX_CACHED_LENGTHS = 16
+
+    def __init__(self, intervals=(), _runs=None, _chunks=None):
+        """
+        intervals: iterable of (start, stop) tuples, in any order and
+            possibly overlapping.
+        """
+        if _chunks is None:
+            if _runs is None:
+                intervals = list(intervals)
+                if intervals:
+                    starts, stops = np.array(intervals, dtype=np.int64).reshape(-1, 2).T
+                else:
+                    starts, stops = np.zeros(0, np.int64), np.zeros(0, np.int64)
+                keep = starts < stops
+                _runs = _normalize(starts[keep], stops[keep])
+            _chunks = _split(*_runs)
+        # list of (starts, stops) arrays, first starts and last stops of them
+        self._chunks, self._firsts, self._lasts = _chunks
+        self._runs = None
+        # length -> numbers of placements per chunk (recently used first)
+        self._placements = OrderedDict()
+        # length -> cumulative numbers of placements per chunk
+        self._cumulative = {}
+
+    @property
+    def starts(self):
+        return self._flat()[0]
+
+    @property
+    def stops(self):
+        return self._flat()[1]
+
+    def _flat(self):
+        if self._runs is None:
+            if self._chunks:
+                self._runs = (np.concatenate([c[0] for c in self._chunks]),
+                        np.concatenate([c[1] for c in self._chunks]))
+            else:
+                self._runs = (np.zeros(0, np.int64), np.zeros(0, np.int64))
+        return self._runs
+
+    def __len__(self):
+        """
+        Number of runs.
+        """
+        return sum(len(starts) for starts, _ in self._chunks)
+
+    def __iter__(self):
+        for starts, stops in self._chunks:
+            for start, stop in zip(starts.tolist(), stops.tolist()):
+                yield (start, stop)
+
+    def __str__(self):
+        return '->'.join(str(i) for i in self)
+
+    def copy(self):
+        return self
+
+    def size(self):
+        """
+        Number of set positions.
+        """
+        return sum(int((stops - starts).sum()) for starts, stops in self._chunks)
+
+    def bounds(self):
+        """
+        Return (start of the first, stop of the last run), None if empty.
+        """
+        if not self._chunks:
+            return None
+        return int(self._firsts[0]), int(self._lasts[-1])
+
+    def union(self, other):
+        return _combine(self, other, lambda a, b: a | b)
+
+    def intersection(self, other):
+        return _combine(self, other, lambda a, b: a & b)
+
+    def difference(self, other):
+        return _combine(self, other, lambda a, b: a & ~b)
+
+    def _touched_chunks(self, start, stop):
+        """
+        Return range (lo, hi) of the chunks with runs overlapping [start, stop).
+        """
+        lo = np.searchsorted(self._lasts, start, 'right')
+        hi = np.searchsorted(self._firsts, stop, 'left')
+        return int(lo), int(hi)
+
+    def removed(self, data):
+        """
+        Return new bitmap without the interval data.
+
+        Only the chunks overlapping the interval are copied.
+        """
+        start, stop = data[0], data[1]
+        lo, hi = self._touched_chunks(start, stop)
+        if lo >= hi or start >= stop:
+            return self
+        if hi - lo == 1:
+            starts, stops = self._chunks[lo]
+        else:
+            starts = np.concatenate([c[0] for c in self._chunks[lo:hi]])
+            stops = np.concatenate([c[1] for c in self._chunks[lo:hi]])
+        i = np.searchsorted(stops, start, 'right')
+        j = np.searchsorted(starts, stop, 'left')
+        if i >= j:
+            return self
+        piece_starts, piece_stops = [], []
+        if starts[i] < start:
+            piece_starts += [starts[i]]
+            piece_stops += [start]
+        if stops[j - 1] > stop:
+            piece_starts += [stop]
+            piece_stops += [stops[j - 1]]
+        starts = np.concatenate([starts[:i], np.array(piece_starts, np.int64), starts[j:]])
+        stops = np.concatenate([stops[:i], np.array(piece_stops, np.int64), stops[j:]])
+        chunks, firsts, lasts = _split(starts, stops)
+        other = RunBitmap(_chunks=(self._chunks[:lo] + chunks + self._chunks[hi:],
+            np.concatenate([self._firsts[:lo], firsts, self._firsts[hi:]]),
+            np.concatenate([self._lasts[:lo], lasts, self._lasts[hi:]])))
+        for length, counts in self._placements.items():
+            other._placements[length] = np.concatenate([counts[:lo],
+                np.array([_placements(c, length) for c in chunks], np.int64), counts[hi:]])
+        return other
+
+    def __contains__(self, data):
+        """
+        Check whether the interval data is completely inside one of the runs.
+        """
+        start, stop = data[0], data[1]
+        c = np.searchsorted(self._firsts, start, 'right') - 1
+        if c < 0 or start >= stop:
+            return False
+        starts, stops = self._chunks[c]
+        i = np.searchsorted(starts, start, 'right') - 1
+        return stop <= stops[i]
+
+    def contains_batch(self, starts, stops):
+        """
+        Vectorized __contains__ for arrays of starts and stops.
+        """
+        i = np.searchsorted(self.starts, starts, 'right') - 1
+        inside = i >= 0
+        i = np.maximum(i, 0)
+        if not len(self.stops):
+            return np.zeros(len(i), bool)
+        return inside & (starts < stops) & (stops <= self.stops[i])
+
+    def overlapping(self, start, stop):
+        """
+        Return list of runs overlapping [start, stop), in order.
+        """
+        lo, hi = self._touched_chunks(start, stop)
+        result = []
+        for starts, stops in self._chunks[lo:hi]:
+            i = np.searchsorted(stops, start, 'right')
+            j = np.searchsorted(starts, stop, 'left')
+            result += zip(starts[i:j].tolist(), stops[i:j].tolist())
+        return result
+
+    def _chunk_placements(self, length):
+        """
+        Return cumulative numbers of placements of a window of the length
+        per chunk.
+        """
+        if length in self._placements:
+            counts = self._placements.pop(length)
+        else:
+            counts = np.array([_placements(c, length) for c in self._chunks], np.int64)
+            if len(self._placements) >= self.MAX_CACHED_LENGTHS:
+                self._placements.popitem(last=False)
+        self._placements[length] = counts
+        if length not in self._cumulative:
+            self._cumulative[length] = np.cumsum(counts)
+        return self._cumulative[length]
+
+    def placements(self, length):
+        """
+        Number of valid starts of a window of the length.
+        """
+        cumulative = self._chunk_placements(length)
+        return int(cumulative[-1]) if len(cumulative) else 0
+
+    def rank(self, pos, length):
+        """
+        Number of valid starts of a window of the length before pos.
+        """
+        cumulative = self._chunk_placements(length)
+        c = np.searchsorted(self._firsts, pos, 'right') - 1
+        if c < 0:
+            return 0
+        before = int(cumulative[c - 1]) if c > 0 else 0
+        starts, stops = self._chunks[c]
+        run_cumulative = np.cumsum(np.maximum(stops - starts - length + 1, 0))
+        i = np.searchsorted(starts, pos, 'right') - 1
+        before += int(run_cumulative[i - 1]) if i > 0 else 0
+        return before + int(min(pos - starts[i], run_cumulative[i] - (
+            run_cumulative[i - 1] if i > 0 else 0)))
+
+    def select(self, k, length):
+        """
+        Return k-th (from 0) valid start of a window of the length.
+        """
+        cumulative = self._chunk_placements(length)
+        c = np.searchsorted(cumulative, k, 'right')
+        if c >= len(cumulative):
+            raise IndexError('Only %d placements of length %d.' % (self.placements(length), length))
+        k -= int(cumulative[c - 1]) if c > 0 else 0
+        starts, stops = self._chunks[c]
+        run_cumulative = np.cumsum(np.maximum(stops - starts - length + 1, 0))
+        i = np.searchsorted(run_cumulative, k, 'right')
+        before = int(run_cumulative[i - 1]) if i > 0 else 0
+        return int(starts[i]) + k - before
+
+    def __getstate__(self):
+        return self.starts, self.stops
+
+    def __setstate__(self, state):
+        self.__init__(_runs=state)
+
+
+def _placements(chunk, length):
+    starts, stops = chunk
+    return int(np.maximum(stops - starts - length + 1, 0).sum())
+
+
+def _split(starts, stops):
+    """
+    Return chunks of the runs, first starts and last stops of the chunks.
+    """
+    n = len(starts)
+    if n == 0:
+        return [], np.zeros(0, np.int64), np.zeros(0, np.int64)
+    if n <= 2 * CHUNK_SIZE:
+        bounds = [0, n]
+    else:
+        bounds = range(0, n, CHUNK_SIZE) + [n]
+    chunks = [(starts[lo:hi], stops[lo:hi]) for lo, hi in zip(bounds[:-1], bounds[1:])]
+    return chunks, starts[bounds[:-1]], stops[np.array(bounds[1:]) - 1]
+
+
+def _normalize(starts, stops):
+    """
+    Return sorted and merged runs of possibly overlapping intervals.
+    """
+    if not len(starts):
+        return starts.astype(np.int64), stops.astype(np.int64)
+    order = np.argsort(starts, kind='mergesort')
+    starts, stops = starts[order], stops[order]
+    # a run starts where no earlier interval reaches
+    reach = np.maximum.accumulate(stops)
+    new_run = np.concatenate([[True], starts[1:] > reach[:-1]])
+    run_starts = starts[new_run]
+    run_stops = reach[np.concatenate([new_run[1:], [True]])]
+    return run_starts.astype(np.int64), run_stops.astype(np.int64)
+
+
+def _combine(a, b, keep):
+    """
+    Sweep over the run boundaries of both bitmaps, keep the segments for
+    which keep(in_a, in_b) is true.
+    """
+    positions = np.concatenate([a.starts, a.stops, b.starts, b.stops])
+    deltas = np.concatenate([np.ones(len(a), np.int8), -np.ones(len(a), np.int8),
+        2 * np.ones(len(b), np.int8), -2 * np.ones(len(b), np.int8)])
+    if not len(positions):
+        return RunBitmap()
+    order = np.argsort(positions, kind='mergesort')
+    positions, deltas = positions[order], deltas[order]
+    boundaries = np.concatenate([[True], positions[1:] != positions[:-1]])
+    index = np.flatnonzero(boundaries)
+    positions = positions[index]
+    # value of the segment [positions[i], positions[i + 1]): 1 - in a, 2 - in b
+    values = np.cumsum(np.add.reduceat(deltas.astype(np.int64), index))
+    selected = keep((values & 1) > 0, (values & 2) > 0).astype(np.int8)
+    change = np.diff(np.concatenate([[0], selected]))
+    return RunBitmap(_runs=(positions[change == 1], positions[change == -1]))
+
+
+def test_set_algebra():
+    prng = np.random.RandomState(0)
+    def random_bitmap():
+        starts = prng.randint(0, 1000, 30)
+        return RunBitmap(zip(starts, starts + prng.randint(1, 60, 30)))
+    def positions(bitmap):
+        return set(p for start, stop in bitmap for p in range(start, stop))
+    for _ in range(20):
+        a, b = random_bitmap(), random_bitmap()
+        assert all(s1 < s2 for (_, s1), (s2, _) in zip(list(a)[:-1], list(a)[1:]))
+        assert positions(a.union(b)) == positions(a) | positions(b)
+        assert positions(a.intersection(b)) == positions(a) & positions(b)
+        assert positions(a.difference(b)) == positions(a) - positions(b)
+        assert positions(a.removed((300, 500))) == positions(a) - set(range(300, 500))
+        assert a.size() == len(positions(a))
+
+
+def test_rank_select():
+    bitmap = RunBitmap([(10, 20), (0, 5), (30, 31), (50, 60)])
+    assert list(bitmap) == [(0, 5), (10, 20), (30, 31), (50, 60)]
+    valid = [s for s in range(70) if (s, s + 3) in bitmap]
+    assert bitmap.placements(3) == len(valid)
+    assert [bitmap.select(k, 3) for k in range(len(valid))] == valid
+    assert [bitmap.rank(s, 3) for s in valid] == range(len(valid))
+    assert list(bitmap.contains_batch(np.arange(70), np.arange(70) + 3)) == \
+            [s in valid for s in range(70)]
+    assert bitmap.overlapping(4, 30) == [(0, 5), (10, 20)]
+
+
+def test_removed_chunks():
+    global CHUNK_SIZE
+    chunk_size, CHUNK_SIZE = CHUNK_SIZE, 4
+    try:
+        prng = np.random.RandomState(0)
+        starts = np.arange(0, 2000, 20)
+        bitmap = RunBitmap(zip(starts, starts + 15))
+        positions = set(p for s in starts for p in range(s, s + 15))
+        assert len(bitmap._chunks) == 25
+        bitmap.placements(5)
+        for _ in range(60):
+            start = prng.randint(2000)
+            stop = start + prng.randint(1, 60)
+            removed = bitmap.removed((start, stop))
+            # untouched chunks are shared
+            assert sum(c1 is c2 for c1 in bitmap._chunks for c2 in removed._chunks) >= \
+                    len(bitmap._chunks) - 2
+            bitmap = removed
+            positions -= set(range(start, stop))
+            assert bitmap.size() == len(positions)
+            assert positions == set(p for a, b in bitmap for p in range(a, b))
+            for length in [1, 5]:
+                valid = [s for s in range(2000) if (s, s + length) in bitmap]
+                assert valid == [s for s in range(2000)
+                        if all(p in positions for p in range(s, s + length))]
+                assert bitmap.placements(length) == len(valid)
+            assert [bitmap.select(k, 5) for k in range(0, len(valid), 7)] == valid[::7]
+            assert [bitmap.rank(s, 5) for s in valid[::7]] == range(0, len(valid), 7)
+            a, b = sorted(prng.randint(2000, size=2))
+            assert bitmap.overlapping(a, b) == [(s, e) for s, e in bitmap if s < b and e > a]
+    finally:
+        CHUNK_SIZE = chunk_size
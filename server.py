@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+#
+# Long-lived sampling server.
+#
+# Genomes, annotation tracks and allowed spaces are loaded once and kept
+# resident between requests. Each request works on a fork of the persistent
+# allowed space and the matching random regions are streamed back as BED
+# lines as soon as they are accepted. Requests are served concurrently (one
+# thread per request) over localhost HTTP or HTTP over a Unix socket.
+#
+# The response body uses chunked transfer encoding and is complete only if it
+# ends with the terminating zero-length chunk. If sampling fails after the
+# response has started (eg. a budget runs out with on_exhausted "raise"), the
+# connection is closed without it, so HTTP clients report an incomplete read
+# (httplib.IncompleteRead, curl exit code 18) instead of a truncated BED file.
+#
+# Request (POST /sample, JSON body):
+#   regions     - BED lines with the input regions (required)
+#   include     - BED lines, allowed space (whole genome if missing)
+#   exclude     - BED lines excluded in addition to the input regions
+#   filters     - list of filter specifications as for smpregs.py
+#   assembly    - genome assembly, one of those given by -g if any
+#                 [Default: dm3]
+#   seed        - seed of the pseudo-random number generator
+#   max_attempts, max_time - budgets per input region (see smpregs.py)
+#   relaxations - list of lists of filters used when the budgets run out
+#                 (see --relax of smpregs.py)
+#   on_exhausted - "raise" (fail the response) or "skip" (leave out the
+#                  input regions) when all levels are exhausted
+#                  [Default: raise]
+#   cross_chrom - place random regions on any chromosome (see smpregs.py)
+#
+# Example:
+#   ./server.py --port 8765 -n data/genomic-annotations-dm3.fa &
+#   curl -s --data-binary @request.json http://localhost:8765/sample > out
+#
+
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import os
+import re
+import threading
+import numpy as np
+from StringIO import StringIO
+from collections import OrderedDict
+from region_utils import regions_parser, AllowedSpace, RegionAcceptorNoNs, get_log
+from smpregs import get_assembly, parse_filters, sample_regions, output_region, _setup_log
+
+
+class SamplingService(object):
+    """
+    Resident state of the server and sampling of single requests.
+    """
+
+    def __init__(self, genomic_annotations=None, max_spaces=8, assemblies=None):
+        """
+        genomic_annotations: filename
+            Fasta file with encoded genomic annotations.
+        max_spaces: int
+            Maximum number of base allowed spaces (one per assembly and
+            include set) kept resident.
+        assemblies: list of str
+            Assemblies requests may use [Default: any plain name of a genome
+            file, see check_assembly]
+        """
+        self.genomic_annotations = genomic_annotations
+        self.max_spaces = max_spaces
+        self.assemblies = None if assemblies is None else set(assemblies)
+        self._spaces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def base_space(self, assembly, include=None):
+        """
+        Return the resident allowed space for the assembly and include lines.
+
+        The returned space must not be modified, use its fork instead. It is
+        persistent, so forks are cheap and share its intervals.
+        """
+        logger = get_log('server')
+        key = (assembly, include)
+        with self._lock:
+            if key in self._spaces:
+                space = self._spaces.pop(key)
+                self._spaces[key] = space
+                return space
+        logger.info('Building allowed space for %s', assembly)
+        genome_fasta = get_assembly(assembly)
+        if include is None:
+            space = AllowedSpace(fasta=genome_fasta, persistent=True)
+        else:
+            space = AllowedSpace(fasta=genome_fasta, persistent=True,
+                    include=regions_parser(include.splitlines(), '<include>'))
+        with self._lock:
+            self._spaces[key] = space
+            while len(self._spaces) > self.max_spaces:
+                self._spaces.popitem(last=False)
+        return space
+
+    def check_assembly(self, assembly):
+        """
+        Raise ValueError unless requests may use the assembly.
+
+        Without a list of assemblies, only names of files in the genome
+        directory are allowed (no path separators, no leading dot).
+        """
+        if self.assemblies is not None:
+            if assembly not in self.assemblies:
+                raise ValueError('Unknown assembly %s.' % assembly)
+        elif not isinstance(assembly, basestring) or not re.match(r'^\w[\w.-]*$', assembly):
+            raise ValueError('Invalid assembly name %r.' % assembly)
+
+    def sample(self, request):
+        """
+        Prepare sampling for a request.
+
+        All request errors are raised (as ValueError) before any region is
+        sampled.
+
+        Returns:
+        ========
+        Generator of (input_region, random_region) tuples, random_region is
+        None for skipped input regions.
+        """
+        if 'regions' not in request:
+            raise ValueError('Input regions are required.')
+        assembly = request.get('assembly', 'dm3')
+        self.check_assembly(assembly)
+        regions = list(regions_parser(request['regions'].splitlines(), '<regions>'))
+        genome_fasta = get_assembly(assembly)
+        acceptors = parse_filters(request.get('filters', []), genome_fasta,
+                self.genomic_annotations)
+        acceptors = [(RegionAcceptorNoNs, {})] + acceptors
+        relaxations = [[(RegionAcceptorNoNs, {})] + parse_filters(filters, genome_fasta,
+            self.genomic_annotations) for filters in request.get('relaxations', [])]
+        on_exhausted = request.get('on_exhausted', 'raise')
+        if on_exhausted not in ('raise', 'skip'):
+            raise ValueError('Unknown on_exhausted value %s.' % on_exhausted)
+        allowed_space = self.base_space(assembly, request.get('include')).fork()
+        for region in regions:
+            allowed_space.remove(region)
+        if request.get('exclude') is not None:
+            for region in regions_parser(request['exclude'].splitlines(), '<exclude>'):
+                allowed_space.remove(region)
+        prng = np.random.RandomState(request.get('seed'))
+        return sample_regions(regions, allowed_space, acceptors, genome_fasta,
+                prng=prng, max_attempts=request.get('max_attempts'),
+                max_time=request.get('max_time'), relaxations=relaxations,
+                on_exhausted=on_exhausted, cross_chrom=request.get('cross_chrom', False))
+
+
+class SamplingRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handle POST /sample requests, stream the sampled regions back as BED in
+    chunked encoding.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        logger = get_log('server')
+        if self.path != '/sample':
+            self.send_error(404, 'Unknown path %s' % self.path)
+            return
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            request = json.loads(self.rfile.read(length))
+            samples = self.server.service.sample(request)
+        except Exception as e:
+            logger.exception('Invalid request')
+            self.send_error(400, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        chunk = StringIO()
+        try:
+            for _, region in samples:
+                if region is None:
+                    continue
+                output_region(chunk, region)
+                self._write_chunk(chunk.getvalue())
+                chunk.seek(0)
+                chunk.truncate()
+        except Exception:
+            # no terminating chunk, the client sees an incomplete response
+            logger.exception('Sampling failed')
+            self.close_connection = 1
+            return
+        self._write_chunk('')
+
+    def _write_chunk(self, data):
+        self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        get_log('server').info('%s %s', self.address_string(), format % args)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(service, port=None, socket_path=None):
+    """
+    Create server on localhost port or Unix socket serving the service.
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, SamplingRequestHandler)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), SamplingRequestHandler)
+    server.service = service
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description='Serve sampling requests keeping genomes and indexes resident.')
+    parser.add_argument('-p', '--port', dest='port', required=False,
+            action='store', type=int, default=8765, help='Localhost port \
+            [Default: 8765]')
+    parser.add_argument('-u', '--socket', dest='socket', required=False,
+            action='store', default=None, help='Unix socket to listen on \
+            instead of the port.')
+    parser.add_argument('-g', '--genome-assembly', dest='genome_assembly',
+            required=False, action='append', default=[], help='Assembly to \
+            preload (can be given multiple times). If given, requests may use \
+            only these assemblies.')
+    parser.add_argument('-n', '--genomic-annotations', dest='genomic_annotations',
+            required=False, action='store', default=None, help='Genomic \
+            annotations FASTA file.')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    opts = parser.parse_args()
+
+    loglevel = max(logging.DEBUG, logging.WARNING - opts.verbose*10)
+    _setup_log(level=loglevel)
+    logger = get_log('main')
+
+    service = SamplingService(genomic_annotations=opts.genomic_annotations,
+            assemblies=opts.genome_assembly or None)
+    for assembly in opts.genome_assembly:
+        service.base_space(assembly)
+    server = create_server(service, port=opts.port, socket_path=opts.socket)
+    logger.warning('Serving on %s', opts.socket or 'localhost:%d' % opts.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -8,7 +8,8 @@
 #  - according to motif count
 #
 # Any output matched region is placed on the same chromosome as input region
-# and has to be inside the given allowed space.
+# (or any chromosome with --cross-chrom) and has to be inside the given
+# allowed space.
 #
 # Exclude overlaps of the generated regions. Exclude input regions.
 #
@@ -23,11 +24,18 @@
 import numpy as np
 import logging
 import os
+import signal
 import sys
-from pyfasta import Fasta
+import threading
+import time
+from collections import namedtuple
 from region_utils import regions_reader, AllowedSpace, generate, \
-    RegionAcceptorApproxGC, RegionAcceptorGenomicAnnotation, RegionAcceptorApproxHistogram, GenomicAnnotationsHistogram, KmerHistogram, RegionAcceptorNoNs
-from region_utils import get_log
+    RegionAcceptorApproxGC, RegionAcceptorGCProfile, RegionAcceptorGenomicAnnotation, RegionAcceptorApproxHistogram, GenomicAnnotationsHistogram, KmerHistogram, RegionAcceptorNoNs, \
+    RegionAcceptorMotifCount, RegionAcceptorFeatureCount, \
+    RegionAcceptorFeatureDistance, CandidatePool
+from region_utils import get_log, open_fasta
+from bed_writer import BedWriter
+from checkpoint import Checkpoint, load_checkpoint, restore
 
 
 def _setup_log(level=logging.INFO):
@@ -47,15 +55,66 @@ def _setup_log(level=logging.INFO):
     log.setLevel(level)
 
 
-def get_assembly(assembly):
+def assembly_filename(assembly):
     """
-    Return Fasta object with the required genome.
+    Return FASTA filename of the required genome.
     """
     # TODO: use tempdir
+    return os.path.expanduser('~kazmar/data/genomes/%s.fa' % assembly)
+
+
+_indexes = {}
+
+def get_assembly(assembly, index=False, store=None):
+    """
+    Return Fasta object with the required genome.
+
+    If index is True, the prebuilt index bundle (see smpregs.py index build) is
+    returned instead, it can be used in place of the Fasta object. If store
+    is given, the shared genome store of that name (see genome_store.py) is
+    attached instead.
+
+    The genome is opened only once per process.
+    """
     logger = get_log('generate')
-    fasta_filename = os.path.expanduser('~kazmar/data/genomes/%s.fa' % assembly)
+    if store is not None:
+        logger.debug('Attaching genome store %s', store)
+        from genome_store import attach_store
+        return attach_store(store)
+    fasta_filename = assembly_filename(assembly)
+    if index:
+        logger.debug('Getting genome index for %s', fasta_filename)
+        if fasta_filename not in _indexes:
+            from genome_index import GenomeIndex
+            _indexes[fasta_filename] = GenomeIndex(fasta_filename)
+        return _indexes[fasta_filename]
     logger.debug('Getting genome from %s', fasta_filename)
-    return Fasta(fasta_filename)
+    return open_fasta(fasta_filename)
+
+
+def _parse_value(v):
+    for parse in [int, float]:
+        try:
+            return parse(v)
+        except ValueError:
+            pass
+    return v
+
+
+_motif_indexes = {}
+_motif_indexes_lock = threading.Lock()
+
+def motif_index(genome_fasta):
+    """
+    Return the motif index of the genome shared by all Motif filters.
+    """
+    from motifs import MotifIndex
+    key = id(genome_fasta)
+    with _motif_indexes_lock:
+        if key not in _motif_indexes:
+            # keep the genome referenced so that its id is not reused
+            _motif_indexes[key] = (genome_fasta, MotifIndex(genome_fasta))
+        return _motif_indexes[key][1]
 
 
 def parse_filters(filters, genome_fasta, genomic_annotations=None):
@@ -67,7 +126,8 @@ def parse_filters(filters, genome_fasta, genomic_annotations=None):
     filters: list of str
         - string specifications of acceptors
     genomic_annotations: filename
-        - Fasta file with encoded genomic annotations.
+        - Fasta file with encoded genomic annotations. If None, annotations
+          stored in the genome index (if any) are used.
 
     Return:
     =======
@@ -76,9 +136,13 @@ def parse_filters(filters, genome_fasta, genomic_annotations=None):
     logger = get_log('generate')
     all_acceptor_classes = dict(
             GC=RegionAcceptorApproxGC,
+            GCProfile=RegionAcceptorGCProfile,
             GAPos=RegionAcceptorGenomicAnnotation,
             GAHist=RegionAcceptorApproxHistogram,
-            KMer=RegionAcceptorApproxHistogram)
+            KMer=RegionAcceptorApproxHistogram,
+            Motif=RegionAcceptorMotifCount,
+            FeatCount=RegionAcceptorFeatureCount,
+            Dist=RegionAcceptorFeatureDistance)
     acceptors = []
     logger.debug('Parsing filters: %s', str(filters))
     for f in filters:
@@ -93,22 +157,39 @@ def parse_filters(filters, genome_fasta, genomic_annotations=None):
                 if filter_name == 'KMer' and k == 'k':
                     kmer_k = int(v)
                 else:
-                    filter_opts += [(k, float(v) if '.' in v else int(v))]
+                    filter_opts += [(k, _parse_value(v))]
+            if filter_name == 'Motif':
+                filter_opts = dict(filter_opts)
+                if 'motif' not in filter_opts:
+                    raise ValueError('Motif (consensus or PWM file) required for filter Motif')
+                index = motif_index(genome_fasta)
+                key = index.add(str(filter_opts.pop('motif')), filter_opts.pop('score', None),
+                        filter_opts.pop('abs_score', None))
+                filter_opts = filter_opts.items() + [('index', index), ('key', key)]
+            if filter_name in ['FeatCount', 'Dist']:
+                filter_opts = [('filename' if k == 'file' else k, v) for k, v in filter_opts]
+                if 'filename' not in dict(filter_opts):
+                    raise ValueError('BED file required for filter %s' % filter_name)
             if filter_name == 'KMer':
                 filter_opts += [('histogram', KmerHistogram(fasta=genome_fasta, k=kmer_k))]
                 filter_opts += [('features_per_nt', 2)]
             if filter_name.startswith('GA'):
-                if genomic_annotations is None:
+                indexed = genomic_annotations is None and \
+                        getattr(genome_fasta, 'has_annotations', False)
+                if genomic_annotations is None and not indexed:
                     raise ValueError('Genomic annotations required for filter %s' % filter_name)
                 if filter_name == 'GAPos':
                     filter_opts += [('filename', genomic_annotations)]
-                elif filter_name == 'GaHist':
-                    filter_opts += [('histogram',
-                        GenomicAnnotationsHistogram(genomic_annotations))]
+                elif filter_name == 'GAHist':
+                    if indexed:
+                        filter_opts += [('histogram', genome_fasta.annotation_histogram)]
+                    else:
+                        filter_opts += [('histogram',
+                            GenomicAnnotationsHistogram(genomic_annotations))]
                     filter_opts += [('features_per_nt', 1)]
                 else:
                     assert False
-        except Exception, e:
+        except Exception as e:
             logger.exception('Error parsing filter %s' , f)
             raise ValueError('Error parsing filter %s (%s)\n' % (f, str(e)))
         acceptors += [(all_acceptor_classes[filter_name], dict(filter_opts))]
@@ -116,31 +197,216 @@ def parse_filters(filters, genome_fasta, genomic_annotations=None):
 
 
 import contextlib
+import itertools
+
+
+def base_space(filename, genome_fasta, include=None, bitmap=False):
+    """
+    Return persistent allowed space saved in the file, build and save it
+    from the include regions (or the whole genome) if the file does not
+    exist. With bitmap, the space is kept in RunBitmap-s.
+    """
+    logger = get_log('base_space')
+    if os.path.exists(filename):
+        if include is not None:
+            logger.warning('Using base space %s, include regions ignored.', filename)
+        return AllowedSpace.load(filename, bitmap=bitmap)
+    logger.info('Saving base space to %s', filename)
+    space = AllowedSpace(fasta=genome_fasta, include=include, persistent=True, bitmap=bitmap)
+    space.save(filename)
+    return space
+
+
 @contextlib.contextmanager
-def output_file_wrapper(filename=None):
+def output_file_wrapper(filename=None, resume_at=None, block_size=10000, sort=False,
+        temp_dir=None):
     """
-    Context manager for either output file or stdout.
+    Context manager for BedWriter to either output file or stdout.
+
+    The buffered rows are written out (and a compressed file is properly
+    terminated) even if sampling fails.
     """
     if filename is None:
-        yield sys.stdout
+        writer = BedWriter(sys.stdout, block_size=block_size, sort=sort, temp_dir=temp_dir)
+        try:
+            yield writer
+        finally:
+            writer.finish()
     else:
-        writer = open(filename, 'w')
-        yield writer
-        writer.close()
+        writer = open_output(filename, resume_at, block_size, sort, temp_dir)
+        try:
+            yield writer
+        finally:
+            writer.close()
+
+
+OUTPUT_BUFFER_SIZE = 1 << 20
 
+def open_output(filename, resume_at=None, block_size=10000, sort=False, temp_dir=None):
+    """
+    Open BedWriter for output file.
 
-def output_region(stream, region):
+    Files ending with .gz are compressed by BGZF and indexed by tabix (if
+    sorted). If resume_at is given, the existing (uncompressed) file is
+    truncated to this size and appended to. At most block_size rows are
+    buffered (see BedWriter). If sort is True, the regions are written out
+    sorted when the writer is closed.
+    """
+    if filename.endswith('.gz'):
+        if resume_at is not None:
+            raise ValueError('Compressed output %s cannot be resumed.' % filename)
+        return BedWriter(open(filename, 'wb', OUTPUT_BUFFER_SIZE), bgzip=True,
+                index_filename=filename + '.tbi', block_size=block_size, sort=sort,
+                temp_dir=temp_dir)
+    if resume_at is None:
+        return BedWriter(open(filename, 'w', OUTPUT_BUFFER_SIZE), block_size=block_size,
+                sort=sort, temp_dir=temp_dir)
+    writer = open(filename, 'r+', OUTPUT_BUFFER_SIZE)
+    writer.seek(resume_at)
+    writer.truncate()
+    return BedWriter(writer, block_size=block_size)
+
+
+def output_region(stream, region, extra=None):
     """
     Output region to stream.
+
+    Optional extra columns are appended after the name column.
     """
-    if region.name is None:
+    if region.name is None and not extra:
         s = '\t'.join([region.chrom, str(region.start), str(region.stop)])
     else:
-        s = '\t'.join([region.chrom, str(region.start), str(region.stop), region.name])
+        name = '.' if region.name is None else region.name
+        s = '\t'.join([region.chrom, str(region.start), str(region.stop), name])
+        if extra:
+            s += '\t' + '\t'.join(str(e) for e in extra)
     stream.write(s + '\n')
 
 
-def sample_regions(regions, allowed_space, acceptors, fasta, prng=None):
+SamplingStats = namedtuple('SamplingStats', ['attempts', 'level'])
+
+
+def _instantiate_acceptors(acceptors, template, fasta):
+    """
+    Create acceptor instances for the given template region.
+    """
+    acceptor_instances = []
+    for acceptor in acceptors:
+        acceptor_instances += [acceptor[0](
+                template=template,
+                fasta=fasta,
+                **acceptor[1])]
+    return acceptor_instances
+
+
+def _accept_candidate(candidate, acceptor_instances, features):
+    """
+    Check candidate against all acceptors.
+
+    Returns:
+    ========
+    The first acceptor rejecting the candidate or None if it was accepted.
+    """
+    logger = get_log('generate')
+    for acceptor in acceptor_instances:
+        if not acceptor.accept_cached(candidate, features):
+            logger.info('REJ %s on %s(%s)', candidate, acceptor.__class__.__name__, acceptor.reason)
+            return acceptor
+    return None
+
+
+def _sample_candidate(input_region, allowed_space, acceptor_instances, prng,
+        max_attempts=None, max_time=None, pool=None, cross_chrom=False, spent=(0, 0.),
+        cancelled=None):
+    """
+    Draw candidates until one is accepted or the budget runs out.
+
+    Candidates from the pool (if given) are tried first, rejected fresh
+    candidates are added to it. spent is the (attempts, seconds) of the
+    budget already used up by earlier calls for the same template.
+    Drawing also stops once the cancelled event (if given) is set.
+
+    Returns:
+    ========
+    Tuple (candidate, (attempts, seconds)), candidate is None if the budget
+    was exhausted, sampling was cancelled or no candidate could be generated
+    (no space left). The budget used includes spent.
+    """
+    logger = get_log('generate')
+    attempts, elapsed = spent
+    started = time.time()
+    if max_time is not None:
+        deadline = started + max_time - elapsed
+    def used():
+        return attempts, elapsed + time.time() - started
+    def exhausted():
+        return (cancelled is not None and cancelled.is_set()) or \
+            (max_attempts is not None and attempts >= max_attempts) or \
+            (max_time is not None and time.time() > deadline)
+    if pool is not None:
+        length = input_region.stop - input_region.start
+        for candidate, features in pool.candidates(input_region.chrom, length):
+            if exhausted():
+                return None, used()
+            if not allowed_space.contains(candidate):
+                pool.discard(candidate)
+                continue
+            attempts += 1
+            if _accept_candidate(candidate, acceptor_instances, features) is None:
+                pool.discard(candidate)
+                return candidate._replace(name='rnd_' + input_region.name), used()
+    while True:
+        if exhausted():
+            return None, used()
+        try:
+            candidate = generate(input_region, allowed_space, prng=prng,
+                    cross_chrom=cross_chrom)
+        except RuntimeError as e:
+            logger.warning('Cannot generate a region for %s: %s', input_region, e)
+            return None, used()
+        attempts += 1
+        features = {}
+        rejected_by = _accept_candidate(candidate, acceptor_instances, features)
+        if rejected_by is None:
+            return candidate, used()
+        if pool is not None and rejected_by.depends_on_template:
+            pool.add(candidate, features)
+
+
+def _sample_levels(input_region, allowed_space, levels, fasta, prng, start_level=0,
+        attempts=0, spent=(0, 0.), cancelled=None, **kwargs):
+    """
+    Sample a candidate for the template, relaxing the acceptors level by
+    level (starting at start_level) while the budgets run out.
+
+    spent is the (attempts, seconds) of the budget of start_level already
+    used up, attempts the total number of attempts so far. No further
+    levels are tried once the cancelled event (if given) is set. Remaining
+    arguments are passed to _sample_candidate.
+
+    Returns:
+    ========
+    Tuple (candidate, stats, spent), candidate is None if all levels were
+    exhausted, spent is the budget used at the last level (stats.level).
+    """
+    logger = get_log('generate')
+    for level in range(start_level, len(levels)):
+        acceptor_instances = _instantiate_acceptors(levels[level], input_region, fasta)
+        candidate, used = _sample_candidate(input_region, allowed_space,
+                acceptor_instances, prng, spent=spent, cancelled=cancelled, **kwargs)
+        attempts += used[0] - spent[0]
+        if candidate is not None or (cancelled is not None and cancelled.is_set()):
+            break
+        logger.warning('Budget exhausted for %s at relaxation level %d (%d attempts).',
+                input_region, level, used[0])
+        spent = (0, 0.)
+    return candidate, SamplingStats(attempts=attempts, level=level), used
+
+
+def sample_regions(regions, allowed_space, acceptors, fasta, prng=None,
+        max_attempts=None, max_time=None, relaxations=None,
+        on_exhausted='raise', with_stats=False, pool=None, cross_chrom=False,
+        cancelled=None):
     """
     Generator providing random regions that match input regions.
 
@@ -149,6 +415,11 @@ def sample_regions(regions, allowed_space, acceptors, fasta, prng=None):
     2. check whether the generated region is inside the allowed space
     3. check whether it fulfils all the acceptors
 
+    If a budget (max_attempts and/or max_time) is given and runs out for a
+    template, the acceptors of the next relaxation level are used instead.
+    When all levels are exhausted, the template is either skipped or an
+    error is raised (see on_exhausted).
+
     Parameters:
     ===========
     regions: iterable of regions
@@ -160,34 +431,60 @@ def sample_regions(regions, allowed_space, acceptors, fasta, prng=None):
         - Provides access to sequences in regions_file or allowed_space.
     prng: NumPy RandomState object
         - pseudo-random number generator
+    max_attempts: int
+        - Maximum number of candidates drawn per template and relaxation level.
+    max_time: float
+        - Maximum time (in seconds) spent per template and relaxation level.
+    relaxations: list of lists of Acceptor objects
+        - Acceptors used (in order) once the budget of the previous level is
+          exhausted. Level 0 corresponds to acceptors.
+    on_exhausted: 'raise' or 'skip'
+        - Raise RuntimeError, or yield None as the random region, when all
+          levels are exhausted.
+    with_stats: bool
+        - Yield also SamplingStats (attempts, relaxation level) per region.
+    pool: CandidatePool object
+        - Candidates rejected for previous templates that are tried first.
+    cross_chrom: bool
+        - Place random regions on any chromosome (chosen with probability
+          proportional to its remaining placements), not only on the
+          chromosome of the input region.
+    cancelled: threading.Event object
+        - Stop sampling (without yielding the pending template) once set,
+          checked before every candidate.
 
     Returns:
     ========
     Yields tuples of input and sampled regions:
     (input_region, matching_random_region)
+    or, if with_stats is True:
+    (input_region, matching_random_region, stats)
     """
     logger = get_log('generate')
+    if on_exhausted not in ('raise', 'skip'):
+        raise ValueError('Unknown on_exhausted value %s.' % on_exhausted)
     if prng is None:
         prng = np.random.RandomState()
+    levels = [acceptors]
+    if relaxations is not None:
+        levels += list(relaxations)
     for input_region in regions:
-        acceptor_instances = []
-        for acceptor in acceptors:
-            acceptor_instances += [acceptor[0](
-                    template=input_region,
-                    fasta=fasta,
-                    **acceptor[1])]
-        accepted = False
-        while not accepted:
-            candidate = generate(input_region, allowed_space, prng=prng)
-            accepted = True
-            for acceptor in acceptor_instances:
-                if not acceptor.accept(candidate):
-                    accepted = False
-                    logger.info('REJ %s on %s(%s)', candidate, acceptor.__class__.__name__, acceptor.reason)
-                    break
-        if accepted:
+        candidate, stats, _ = _sample_levels(input_region, allowed_space, levels, fasta, prng,
+                max_attempts=max_attempts, max_time=max_time, pool=pool,
+                cross_chrom=cross_chrom, cancelled=cancelled)
+        if cancelled is not None and cancelled.is_set():
+            return
+        if candidate is None:
+            if on_exhausted == 'raise':
+                raise RuntimeError('Failed to sample a region matching %s (%d attempts).' %
+                        (input_region, stats.attempts))
+            logger.warning('SKIP %s', input_region)
+        else:
             logger.info('ACC %s', candidate)
             allowed_space.remove(candidate)
+        if with_stats:
+            yield input_region, candidate, stats
+        else:
             yield input_region, candidate
 
 
@@ -195,6 +492,11 @@ if __name__ == '__main__':
     import argparse
     import textwrap
 
+    if sys.argv[1:3] == ['index', 'build']:
+        from build_index import main
+        main(sys.argv[3:], prog='smpregs.py index build')
+        sys.exit(0)
+
     parser = argparse.ArgumentParser(
             description='Sample random regions one-by-one matching given input regions.',
             formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -204,20 +506,43 @@ if __name__ == '__main__':
                   in which the random regions have to be similar to their matching
                   regions.
 
-                  Allowed filters are: GC, GAPos, GAHist, and KMer.
+                  Allowed filters are: GC, GCProfile, GAPos, GAHist, KMer, Motif, FeatCount, and Dist.
 
-                  GC:threshold=10 allows at most 10 more/less of GC nucleotides (use floats between 0 and 1 for relative thresholds).
+                  GC:threshold=10 allows at most 10 more/less of GC nucleotides.
+                  GCProfile:bins=10,threshold=3 allows at most 3 more/less GC nucleotides in each of 10 bins along the region.
                   GAPos:pos=101 enforces equal genomic annotation at position 101 in the sequence.
                   GAHist:threshold=150 allows at most 150 errors when matching histograms of genomic annotations.
                   KMer:k=2,threshold=50 analog. to GAHist but for k-mer sequence content.
+                  Motif:motif=TGASTCA,threshold=2 allows at most 2 more/less hits of the motif on both strands
+                    (IUPAC consensus or PWM file; score=0.8 sets the minimum relative score of a hit
+                    in [0, 1], abs_score=6.5 the minimum score in the units of the PWM instead).
+                  FeatCount:file=enhancers.bed,threshold=2 allows at most 2 more/less overlapping features from the BED file.
+                  Dist:file=tss.bed,threshold=500 allows the distance to the nearest feature (midpoints) to differ by at most 500 bp.
+
+                  Thresholds up to 1 (eg. 0.1 or 1) are relative to the template (its length, bin length,
+                  count or distance) for all filters.
 
                   All filters have to be fulfilled at once (logical AND). Multiple filters of the
                   same kind are allowed.
+
+                Budgets
+                  --max-attempts and --max-time bound the work spent on a single input region.
+                  Once exhausted, the filters from the next --relax option are used, e.g.:
+
+                    --max-attempts 10000 --relax "GC:threshold=15 GAHist:threshold=150" --relax "GC:threshold=15"
+
+                  If all levels are exhausted, smpregs fails unless --skip-exhausted is given.
                 '''))
     parser.add_argument('-r', '--regions', dest='regions', required=True,
             action='store', default=None, help='Regions BED file')
     parser.add_argument('-o', '--output', dest='output', required=False,
-            action='store', default=None, help='Output BED file')
+            action='store', default=None, help='Output BED file (BGZF \
+            compressed when ending with .gz, tabix indexed as well with \
+            --sort-output)')
+    parser.add_argument('--sort-output', dest='sort_output', required=False,
+            action='store_true', default=False, help='Write the random regions \
+            sorted by chromosome and position (spilled to temporary files \
+            until sampling finishes) instead of in the input order.')
     parser.add_argument('-i', '--include', dest='include', required=False,
             action='store', default=None, help='Include BED file. Generated  \
             random regions will be fully contained inside one of the regions \
@@ -227,35 +552,236 @@ if __name__ == '__main__':
             action='store', default=None, help='Exclude BED file. Generated \
             random regions will _NOT_ overlap any of the regions from this  \
             file.')
+    parser.add_argument('--intersect', dest='intersect', required=False,
+            action='append', default=[], help='BED file of a track (eg. \
+            mappability) the allowed space is intersected with. Can be given \
+            multiple times.')
+    parser.add_argument('--subtract', dest='subtract', required=False,
+            action='append', default=[], help='BED file of a track (eg. \
+            blacklist, repeats) subtracted from the allowed space in bulk. \
+            Can be given multiple times.')
+    parser.add_argument('--bitmap', dest='bitmap', required=False,
+            action='store_true', default=False, help='Keep the allowed space \
+            as run-container bitmaps: fast --intersect/--subtract with large \
+            tracks and random starts drawn from the valid ones only (random \
+            regions differ from the default mode for the same seed).')
     parser.add_argument('-g', '--genome-assembly', dest='genome_assembly',
             required=False, action='store', default='dm3', help='Assembly of \
             the genome [Default: dm3]')
+    parser.add_argument('-x', '--index', dest='index', required=False,
+            action='store_true', default=False, help='Use the prebuilt index \
+            of the genome assembly (see smpregs.py index build).')
+    parser.add_argument('--store', dest='store', required=False,
+            action='store', default=None, help='Attach to the shared genome \
+            store of this name (see smpregs.py index build --store) instead of opening \
+            the genome assembly.')
+    parser.add_argument('--base-space', dest='base_space', required=False,
+            action='store', default=None, help='File with the saved base \
+            allowed space (the include regions or the whole genome). Created \
+            on the first use and loaded by the following jobs instead of being \
+            rebuilt; input and exclude regions are removed from a cheap fork.')
     parser.add_argument('-n', '--genomic-annotations', dest='genomic_annotations',
             required=False, action='store', default=None, help='Genomic \
             annotations FASTA file. Use encode_genomic_annotations.py to create \
             it.')
+    parser.add_argument('--max-attempts', dest='max_attempts', required=False,
+            action='store', type=int, default=None, help='Maximum number of \
+            candidates drawn per input region (and relaxation level).')
+    parser.add_argument('--max-time', dest='max_time', required=False,
+            action='store', type=float, default=None, help='Maximum time in \
+            seconds spent per input region (and relaxation level).')
+    parser.add_argument('--relax', dest='relax', required=False,
+            action='append', default=[], help='Filters (separated by spaces) \
+            used once the budget of the previous level is exhausted. Can be \
+            given multiple times, one per relaxation level.')
+    parser.add_argument('--skip-exhausted', dest='skip_exhausted',
+            required=False, action='store_true', default=False, help='Skip \
+            input regions for which all budgets were exhausted instead of \
+            failing.')
+    parser.add_argument('--skipped', dest='skipped', required=False,
+            action='store', default=None, help='BED file to report skipped \
+            input regions to.')
+    parser.add_argument('--stats', dest='stats', required=False,
+            action='store_true', default=False, help='Output also the number \
+            of attempts and the relaxation level as extra columns.')
+    parser.add_argument('--pool-size', dest='pool_size', required=False,
+            action='store', type=int, default=0, help='Number of rejected \
+            candidates kept for reuse by the following input regions \
+            [Default: 0, no reuse].')
+    parser.add_argument('-s', '--seed', dest='seed', required=False,
+            action='store', type=int, default=None, help='Seed of the \
+            pseudo-random number generator.')
+    parser.add_argument('--checkpoint', dest='checkpoint', required=False,
+            action='store', default=None, help='Checkpoint file to record \
+            the progress to (requires --output).')
+    parser.add_argument('--checkpoint-every', dest='checkpoint_every',
+            required=False, action='store', type=int, default=1000,
+            help='Number of input regions between checkpoints \
+            [Default: 1000].')
+    parser.add_argument('--resume', dest='resume', required=False,
+            action='store_true', default=False, help='Continue from the last \
+            checkpoint. Use the same inputs, options and seed as in the \
+            interrupted run (results are not reproducible with --max-time).')
+    parser.add_argument('--cross-chrom', dest='cross_chrom', required=False,
+            action='store_true', default=False, help='Place random regions \
+            on any chromosome, chosen with probability proportional to its \
+            remaining space for the region length (default: the chromosome \
+            of the input region).')
+    parser.add_argument('--threads', dest='threads', required=False,
+            action='store', type=int, default=0, help='Number of threads \
+            drawing and checking candidates concurrently. Results are \
+            deterministic for a given seed regardless of the number of \
+            threads, but differ from the default (0, serial) mode.')
+    parser.add_argument('--block-size', dest='block_size', required=False,
+            action='store', type=int, default=256, help='Number of input \
+            regions sampled against the same snapshot of the allowed space \
+            with --threads (results depend on it) [Default: 256].')
+    parser.add_argument('--low-memory', dest='low_memory', required=False,
+            action='store_true', default=False, help='Sample chromosome by \
+            chromosome, spilling the input regions to temporary files and keeping \
+            the allowed space of a chromosome in a run bitmap. Results equal \
+            the --bitmap mode if the input is grouped by chromosome (eg. \
+            sorted).')
+    parser.add_argument('--chunk-size', dest='chunk_size', required=False,
+            action='store', type=int, default=100000, help='Maximum number \
+            of input regions held in memory with --low-memory \
+            [Default: 100000].')
+    parser.add_argument('--temp-dir', dest='temp_dir', required=False,
+            action='store', default=None, help='Directory for the temporary \
+            files of --low-memory and --sort-output [Default: system temp \
+            directory].')
     parser.add_argument('filters', action='store', nargs='*', help='Filters. \
             See below.')
     parser.add_argument('-v', '--verbose', action='count', default=0)
     opts = parser.parse_args()
+    if opts.checkpoint is not None and opts.output is None:
+        parser.error('--checkpoint requires --output.')
+    if opts.resume and opts.checkpoint is None:
+        parser.error('--resume requires --checkpoint.')
+    if opts.checkpoint is not None and opts.output.endswith('.gz'):
+        parser.error('--checkpoint requires uncompressed --output.')
+    if opts.sort_output and opts.checkpoint is not None:
+        parser.error('--sort-output cannot be combined with --checkpoint.')
+    if opts.low_memory and opts.cross_chrom:
+        parser.error('--low-memory cannot be combined with --cross-chrom.')
+    if opts.low_memory and opts.checkpoint is not None:
+        parser.error('--low-memory cannot be combined with --checkpoint.')
+    if opts.low_memory and opts.base_space is not None:
+        parser.error('--low-memory cannot be combined with --base-space.')
+    if opts.low_memory and (opts.intersect or opts.subtract):
+        parser.error('--low-memory cannot be combined with --intersect or --subtract.')
+    if opts.threads > 0 and (opts.low_memory or opts.checkpoint is not None or opts.pool_size > 0):
+        parser.error('--threads cannot be combined with --low-memory, --checkpoint or --pool-size.')
 
     loglevel = max(logging.DEBUG, logging.WARNING - opts.verbose*10)
     _setup_log(level=loglevel)
     logger = get_log('main')
     logger.debug('Logging started at level %d', loglevel)
 
-    genome_fasta = get_assembly(opts.genome_assembly)
+    genome_fasta = get_assembly(opts.genome_assembly, index=opts.index, store=opts.store)
     acceptors = parse_filters(opts.filters, genome_fasta, opts.genomic_annotations)
     acceptors = [(RegionAcceptorNoNs, {})] + acceptors
+    relaxations = []
+    for relax in opts.relax:
+        relaxations += [[(RegionAcceptorNoNs, {})] + parse_filters(
+            relax.split(), genome_fasta, opts.genomic_annotations)]
     allowed_space_opts = {}
     if opts.include is not None:
         allowed_space_opts['include'] = regions_reader(opts.include)
-    if opts.exclude is None:
-        allowed_space_opts['exclude'] = regions_reader(opts.regions)
+    if opts.low_memory:
+        allowed_space = None
+        if opts.exclude is not None:
+            allowed_space_opts['exclude'] = regions_reader(opts.exclude)
     else:
-        allowed_space_opts['exclude'] = regions_reader([opts.regions, opts.exclude])
-    allowed_space = AllowedSpace(fasta=genome_fasta, **allowed_space_opts)
-    with output_file_wrapper(opts.output) as fw:
-        for _, region in sample_regions(
-                regions_reader(opts.regions), allowed_space, acceptors, genome_fasta):
-            output_region(fw, region)
+        if opts.exclude is None:
+            allowed_space_opts['exclude'] = regions_reader(opts.regions)
+        else:
+            allowed_space_opts['exclude'] = regions_reader(opts.regions, opts.exclude)
+        if opts.base_space is None:
+            # persistent spaces make the snapshots of --threads cheap
+            allowed_space = AllowedSpace(fasta=genome_fasta, bitmap=opts.bitmap,
+                    persistent=opts.threads > 0, **allowed_space_opts)
+        else:
+            allowed_space = base_space(opts.base_space, genome_fasta,
+                    allowed_space_opts.get('include'), bitmap=opts.bitmap).fork()
+            for region in allowed_space_opts['exclude']:
+                allowed_space.remove(region)
+        for track in opts.intersect:
+            allowed_space.intersect(regions_reader(track))
+        if opts.subtract:
+            allowed_space.subtract(regions_reader(*opts.subtract))
+    prng = np.random.RandomState(opts.seed)
+    pool = None
+    if opts.pool_size > 0:
+        pool = CandidatePool(max_size=opts.pool_size)
+    state = None
+    if opts.resume:
+        if os.path.exists(opts.checkpoint):
+            state = load_checkpoint(opts.checkpoint)
+        if state is None:
+            logger.warning('No checkpoint found in %s, starting from scratch.', opts.checkpoint)
+    start_index = 0
+    output_offset, skipped_offset = None, None
+    if state is not None:
+        if len(state['offsets']) != (1 if opts.skipped is None else 2):
+            parser.error('--skipped has to be given on --resume if and only if it was given '
+                    'in the checkpointed run.')
+        for filename, offset in zip([opts.output, opts.skipped], state['offsets']):
+            if not os.path.exists(filename) or os.path.getsize(filename) < offset:
+                parser.error('Output %s is shorter than recorded in the checkpoint.' % filename)
+        start_index = restore(state, allowed_space, prng)
+        pool = state['pool']
+        output_offset = state['offsets'][0]
+        if opts.skipped is not None:
+            skipped_offset = state['offsets'][1]
+        logger.info('Resuming after %d input regions.', start_index)
+    checkpoint = None
+    if opts.checkpoint is not None:
+        checkpoint = Checkpoint(opts.checkpoint, every=opts.checkpoint_every,
+                resume_at=None if state is None else state['position'])
+    # rows are written out at least as often as checkpoints are recorded
+    block_size = 10000 if checkpoint is None else min(10000, opts.checkpoint_every)
+    skipped = None
+    if opts.skipped is not None:
+        skipped = open_output(opts.skipped, resume_at=skipped_offset, block_size=block_size)
+    # on SIGTERM, write out the buffered rows as on any other failure
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        with output_file_wrapper(opts.output, resume_at=output_offset, block_size=block_size,
+                sort=opts.sort_output, temp_dir=opts.temp_dir) as fw:
+            streams = [fw] if skipped is None else [fw, skipped]
+            sampling_opts = dict(prng=prng,
+                    max_attempts=opts.max_attempts, max_time=opts.max_time,
+                    relaxations=relaxations,
+                    on_exhausted='skip' if opts.skip_exhausted else 'raise',
+                    with_stats=True, pool=pool, cross_chrom=opts.cross_chrom)
+            if opts.threads > 0:
+                from threaded import sample_regions_threaded
+                del sampling_opts['prng'], sampling_opts['pool']
+                samples = sample_regions_threaded(regions_reader(opts.regions),
+                        allowed_space, acceptors, genome_fasta, seed=opts.seed,
+                        threads=opts.threads, block_size=opts.block_size, **sampling_opts)
+            elif opts.low_memory:
+                from spill import sample_regions_bounded
+                samples = sample_regions_bounded(regions_reader(opts.regions),
+                        genome_fasta, acceptors, directory=opts.temp_dir,
+                        chunk_size=opts.chunk_size, **dict(allowed_space_opts, **sampling_opts))
+            else:
+                samples = sample_regions(
+                        itertools.islice(regions_reader(opts.regions), start_index, None),
+                        allowed_space, acceptors, genome_fasta, **sampling_opts)
+            for index, (input_region, region, stats) in enumerate(samples, start_index + 1):
+                if region is None:
+                    if skipped is not None:
+                        skipped.write_region(input_region)
+                elif opts.stats:
+                    fw.write_region(region, extra=stats)
+                else:
+                    fw.write_region(region)
+                if checkpoint is not None:
+                    checkpoint.step(index, region, prng, pool, streams)
+            if checkpoint is not None:
+                checkpoint.close()
+    finally:
+        if skipped is not None:
+            skipped.close()
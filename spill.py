@@ -0,0 +1,219 @@
+"""
+Memory-bounded sampling of very large inputs.
+
+Input (and include/exclude) regions are read once and partitioned by
+chromosome into temporary BED files, at most chunk_size regions being
+buffered in memory at a time. Chromosomes are then sampled one after
+another, each with an allowed space of its own chromosome only, reading its
+regions back from the spill files. The allowed space of a chromosome is a
+RunBitmap (a pair of numpy arrays), built by set operations with chunks of
+at most chunk_size regions. Neither the input regions nor the allowed space
+of the whole genome are ever held in memory as Python objects per region.
+
+The random regions equal those of the in-memory mode with bitmap allowed
+spaces (same seed) as long as the input is grouped by chromosome (eg.
+sorted), otherwise they are output grouped by chromosome and differ.
+"""
+
+import itertools
+import os
+import shutil
+import tempfile
+from region_utils import AllowedSpace, regions_reader, get_log
+from smpregs import sample_regions, output_region
+
+
+class RegionSpill(object):
+    """
+    Regions partitioned by chromosome into temporary BED files.
+
+    The order of regions within a chromosome is kept. Chromosomes are listed
+    in the order of their first region.
+    """
+
+    def __init__(self, regions, directory=None, chunk_size=100000):
+        """
+        regions: iterable of Region-s
+        directory: string
+            Where to create the temporary files [Default: system temp dir]
+        chunk_size: int
+            Maximum number of regions buffered in memory.
+        """
+        self.directory = tempfile.mkdtemp(prefix='smpregs-', dir=directory)
+        self.chunk_size = chunk_size
+        self.chroms = []
+        self.counts = {}
+        # False if regions of a chromosome are interleaved with other chromosomes
+        self.grouped = True
+        self._buffer = {}
+        self._buffered = 0
+        last_chrom = None
+        for region in regions:
+            if region.chrom != last_chrom:
+                if region.chrom in self.counts:
+                    self.grouped = False
+                else:
+                    self.chroms += [region.chrom]
+                    self.counts[region.chrom] = 0
+                last_chrom = region.chrom
+            self.counts[region.chrom] += 1
+            self._buffer.setdefault(region.chrom, []).append(region)
+            self._buffered += 1
+            if self._buffered >= chunk_size:
+                self._flush()
+        self._flush()
+
+    def _filename(self, chrom):
+        return os.path.join(self.directory, '%d.bed' % self.chroms.index(chrom))
+
+    def _flush(self):
+        for chrom, regions in self._buffer.items():
+            with open(self._filename(chrom), 'a') as fw:
+                for region in regions:
+                    output_region(fw, region)
+        self._buffer = {}
+        self._buffered = 0
+
+    def regions(self, chrom):
+        """
+        Return generator of the regions on the chromosome.
+        """
+        if chrom not in self.counts:
+            return iter([])
+        return regions_reader(self._filename(chrom))
+
+    def chunks(self, chrom):
+        """
+        Return generator of lists of at most chunk_size regions on the
+        chromosome.
+        """
+        regions = self.regions(chrom)
+        while True:
+            chunk = list(itertools.islice(regions, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def chrom_space(fasta, chrom, inputs, included=None, excluded=None):
+    """
+    Return bitmap AllowedSpace of the chromosome built chunk by chunk from
+    the RegionSpill-s.
+    """
+    if included is None:
+        allowed_space = AllowedSpace(fasta=fasta, chroms=[chrom], bitmap=True)
+    else:
+        allowed_space = AllowedSpace(fasta=fasta, include=[], bitmap=True)
+        for chunk in included.chunks(chrom):
+            allowed_space.union(chunk)
+    for spill in [inputs, excluded]:
+        if spill is not None:
+            for chunk in spill.chunks(chrom):
+                allowed_space.subtract(chunk)
+    return allowed_space
+
+
+def sample_regions_bounded(regions, fasta, acceptors, include=None, exclude=None,
+        directory=None, chunk_size=100000, **kwargs):
+    """
+    Sample regions chromosome by chromosome with bounded memory.
+
+    Parameters:
+    ===========
+    regions: iterable of Region-s
+        Input regions, excluded from the allowed space as well.
+    include, exclude: iterable of Region-s
+        Allowed space (see AllowedSpace).
+    directory: string
+        Where to spill the regions [Default: system temp dir]
+    chunk_size: int
+        Maximum number of regions buffered in memory.
+
+    Remaining arguments are passed to sample_regions.
+
+    Returns:
+    ========
+    Generator of the tuples from sample_regions, grouped by chromosome.
+    """
+    logger = get_log('spill')
+    spills = []
+    try:
+        spills += [RegionSpill(regions, directory, chunk_size)]
+        inputs = spills[0]
+        if not inputs.grouped:
+            logger.warning('Input regions are not grouped by chromosome, '
+                    'random regions are output grouped by chromosome.')
+        excluded = None
+        if exclude is not None:
+            spills += [RegionSpill(exclude, directory, chunk_size)]
+            excluded = spills[-1]
+        included = None
+        if include is not None:
+            spills += [RegionSpill(include, directory, chunk_size)]
+            included = spills[-1]
+        for chrom in inputs.chroms:
+            logger.info('Sampling %d regions on %s', inputs.counts[chrom], chrom)
+            allowed_space = chrom_space(fasta, chrom, inputs, included, excluded)
+            for item in sample_regions(inputs.regions(chrom), allowed_space, acceptors,
+                    fasta, **kwargs):
+                yield item
+            del allowed_space
+    finally:
+        for spill in spills:
+            spill.close()
+
+
+def test_sample_regions_bounded():
+    import numpy as np
+    from region_utils import Region
+    fasta = {'chr1': 'ACGT' * 500, 'chr2': 'ACGT' * 300, 'chr3': 'ACGT' * 200}
+    regions = [Region(chrom, i * 50, i * 50 + 20, '%s_%d' % (chrom, i))
+            for chrom in ['chr2', 'chr1', 'chr3'] for i in range(10)]
+    exclude = [Region('chr1', 1000, 1500, None), Region('chr3', 0, 400, None)]
+    expected = list(sample_regions(regions, AllowedSpace(fasta, exclude=regions + exclude,
+        bitmap=True), [], fasta, prng=np.random.RandomState(1)))
+    result = list(sample_regions_bounded(iter(regions), fasta, [], exclude=iter(exclude),
+        chunk_size=7, prng=np.random.RandomState(1)))
+    assert result == expected
+    spill = RegionSpill(regions[:3] + regions[-2:] + regions[3:5], chunk_size=3)
+    assert not spill.grouped
+    assert spill.chroms == ['chr2', 'chr3']
+    assert list(spill.regions('chr2')) == regions[:5]
+    assert list(spill.regions('chrX')) == []
+    spill.close()
+    assert not os.path.exists(spill.directory)
+
+
+def test_sample_regions_bounded_include():
+    import numpy as np
+    from region_utils import Region
+    fasta = {'chr1': 'ACGT' * 500}
+    regions = [Region('chr1', i * 100, i * 100 + 20, 'r%d' % i) for i in range(10)]
+    include = [Region('chr1', 0, 700, None), Region('chr1', 500, 1500, None)]
+    expected = list(sample_regions(regions, AllowedSpace(fasta, include=include,
+        exclude=regions, bitmap=True), [], fasta, prng=np.random.RandomState(1)))
+    result = list(sample_regions_bounded(iter(regions), fasta, [], include=iter(include),
+        chunk_size=3, prng=np.random.RandomState(1)))
+    assert result == expected
+
+
+def test_sample_regions_bounded_memory():
+    import gc
+    import numpy as np
+    from region_utils import Region
+    fasta = {'chr1': 'ACGT' * 250000}
+    def live_objects(count):
+        regions = (Region('chr1', i * 100, i * 100 + 20, 'r%d' % i) for i in range(count))
+        samples = sample_regions_bounded(regions, fasta, [], chunk_size=100,
+                prng=np.random.RandomState(1))
+        next(samples)
+        gc.collect()
+        live = len(gc.get_objects())
+        for _ in samples:
+            pass
+        return live
+    # the live objects while sampling do not depend on the number of regions
+    assert abs(live_objects(5000) - live_objects(500)) < 100
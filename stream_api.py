@@ -0,0 +1,300 @@
+"""
+Non-blocking streaming access to sampling.
+
+Sampling runs in a background thread and passes the (input, control) pairs
+through a bounded queue, so a slow consumer throttles the sampling
+(backpressure). Input regions can be fed incrementally from another thread
+through RegionFeed. The number of concurrently sampling streams is limited
+(see set_max_concurrency).
+
+Event loops can poll SamplingStream.get with a zero timeout or run it in an
+executor.
+"""
+
+import Queue
+import sys
+import threading
+from region_utils import get_log
+from smpregs import sample_regions
+
+_POLL_INTERVAL = 0.05
+
+
+class _Limiter(object):
+    """
+    Counting semaphore whose limit can be changed while it is held.
+    """
+
+    def __init__(self, n):
+        self._condition = threading.Condition(threading.Lock())
+        self._max = n
+        self._running = 0
+
+    def acquire(self, timeout):
+        """
+        Return True if acquired within timeout (seconds).
+        """
+        with self._condition:
+            if self._running >= self._max:
+                self._condition.wait(timeout)
+            if self._running >= self._max:
+                return False
+            self._running += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self._running -= 1
+            self._condition.notify_all()
+
+    def resize(self, n):
+        with self._condition:
+            self._max = n
+            self._condition.notify_all()
+
+_limiter = _Limiter(4)
+
+
+def set_max_concurrency(n):
+    """
+    Set the maximum number of streams sampling at the same time.
+
+    Streams already sampling are counted against the new limit (none of them
+    is stopped, waiting streams start once the number drops below it).
+    """
+    _limiter.resize(n)
+
+
+class RegionFeed(object):
+    """
+    Iterable of input regions fed incrementally (e.g. from another thread).
+    """
+
+    def __init__(self, maxsize=0):
+        self._queue = Queue.Queue(maxsize)
+        self._closed = threading.Event()
+
+    def put(self, region):
+        """
+        Add an input region, blocks while the feed is full.
+
+        Regions put after close are ignored.
+        """
+        while not self._closed.is_set():
+            try:
+                self._queue.put(region, timeout=_POLL_INTERVAL)
+                return
+            except Queue.Full:
+                pass
+
+    def close(self):
+        """
+        Mark the end of the input regions, never blocks.
+
+        Regions already in the feed are still iterated over.
+        """
+        self._closed.set()
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self._queue.get(timeout=_POLL_INTERVAL)
+            except Queue.Empty:
+                if self._closed.is_set() and self._queue.empty():
+                    return
+
+
+class SamplingStream(object):
+    """
+    Sampling running in a background thread.
+
+    Iterate over the stream (blocking) or call get to obtain the
+    (input_region, random_region) tuples in the order of input regions.
+    """
+
+    _DONE = object()
+    _ERROR = object()
+
+    def __init__(self, regions, allowed_space, acceptors, fasta, max_pending=100,
+            **kwargs):
+        """
+        regions: iterable of regions or RegionFeed
+            Input regions, consumed lazily.
+        max_pending: int
+            Maximum number of sampled pairs not yet taken by the consumer.
+
+        Remaining arguments are passed to smpregs.sample_regions.
+        """
+        self._regions = regions
+        self._args = (allowed_space, acceptors, fasta)
+        self._kwargs = kwargs
+        self._queue = Queue.Queue(max_pending)
+        self._cancelled = threading.Event()
+        self._finished = False
+        self._limiter = _limiter
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _input(self):
+        for region in self._regions:
+            if self._cancelled.is_set():
+                return
+            yield region
+
+    def _put(self, item):
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        logger = get_log('stream')
+        while not self._limiter.acquire(_POLL_INTERVAL):
+            if self._cancelled.is_set():
+                return
+        try:
+            for pair in sample_regions(self._input(), *self._args,
+                    cancelled=self._cancelled, **self._kwargs):
+                if not self._put(pair):
+                    return
+            self._put((self._DONE, None))
+        except Exception:
+            logger.exception('Sampling failed')
+            self._put((self._ERROR, sys.exc_info()))
+        finally:
+            self._limiter.release()
+
+    def get(self, timeout=None):
+        """
+        Return the next (input_region, random_region) tuple.
+
+        Raises Queue.Empty if nothing is available within timeout (seconds),
+        StopIteration once all input regions were processed, and re-raises
+        errors from sampling.
+        """
+        if self._finished:
+            raise StopIteration
+        item = self._queue.get(timeout=timeout)
+        if item[0] is self._DONE:
+            self._finished = True
+            raise StopIteration
+        if item[0] is self._ERROR:
+            self._finished = True
+            raise item[1][0], item[1][1], item[1][2]
+        return item
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except StopIteration:
+                return
+
+    def cancel(self):
+        """
+        Stop sampling. Pairs not yet taken are dropped.
+
+        Sampling stops before the next candidate is drawn, also within a
+        template still being sampled.
+        """
+        self._cancelled.set()
+        self._finished = True
+        if isinstance(self._regions, RegionFeed):
+            self._regions.close()
+
+    def join(self, timeout=None):
+        """
+        Wait for the background thread to finish.
+        """
+        self._thread.join(timeout)
+
+
+def test_stream():
+    import numpy as np
+    from region_utils import Region, AllowedSpace
+    fasta = {'chr1': 'ACGT' * 1000}
+    regions = [Region('chr1', i * 100, i * 100 + 10, 'r%d' % i) for i in range(30)]
+    expected = list(sample_regions(regions, AllowedSpace(fasta), [], fasta,
+        prng=np.random.RandomState(1)))
+    feed = RegionFeed()
+    stream = SamplingStream(feed, AllowedSpace(fasta), [], fasta, max_pending=2,
+            prng=np.random.RandomState(1))
+    for region in regions:
+        feed.put(region)
+    feed.close()
+    assert list(stream) == expected
+    stream.join()
+    stream = SamplingStream(iter(regions), AllowedSpace(fasta), [], fasta,
+            max_pending=2, prng=np.random.RandomState(1))
+    assert stream.get() == expected[0]
+    stream.cancel()
+    stream.join(1.)
+    assert not stream._thread.is_alive()
+
+
+def test_stream_cancel_sampling():
+    import time
+    from region_utils import Region, AllowedSpace, RegionAcceptorNoNs
+    # every candidate is rejected, the template is sampled without a budget
+    fasta = {'chr1': 'N' * 1000}
+    stream = SamplingStream([Region('chr1', 0, 10, 'r')], AllowedSpace(fasta),
+            [(RegionAcceptorNoNs, {})], fasta)
+    time.sleep(0.05)
+    assert stream._thread.is_alive()
+    stream.cancel()
+    stream.join(1.)
+    assert not stream._thread.is_alive()
+
+
+def test_stream_cancel_full_feed():
+    from region_utils import Region, AllowedSpace
+    fasta = {'chr1': 'ACGT' * 1000}
+    feed = RegionFeed(maxsize=1)
+    set_max_concurrency(0)
+    try:
+        # the stream waits for the limiter, the feed fills up
+        stream = SamplingStream(feed, AllowedSpace(fasta), [], fasta)
+        feed.put(Region('chr1', 0, 10, 'r'))
+        producer = threading.Thread(target=feed.put, args=(Region('chr1', 20, 30, 'r'),))
+        producer.start()
+        stream.cancel()
+        stream.join(1.)
+        producer.join(1.)
+        assert not stream._thread.is_alive() and not producer.is_alive()
+    finally:
+        set_max_concurrency(4)
+
+
+def test_max_concurrency():
+    import time
+    limiter = _Limiter(2)
+    assert limiter.acquire(0) and limiter.acquire(0)
+    assert not limiter.acquire(0)
+    # running holders count against a lowered limit
+    limiter.resize(1)
+    limiter.release()
+    assert not limiter.acquire(0)
+    limiter.release()
+    assert limiter.acquire(0)
+    waiter = threading.Thread(target=lambda: results.append(limiter.acquire(1.)))
+    results = []
+    waiter.start()
+    time.sleep(0.05)
+    limiter.resize(2)
+    waiter.join()
+    assert results == [True]
+
+
+def test_stream_error():
+    from region_utils import Region, AllowedSpace
+    fasta = {'chr1': 'ACGT' * 10}
+    stream = SamplingStream([Region('chr2', 0, 10, 'r')], AllowedSpace(fasta), [], fasta)
+    try:
+        stream.get()
+        assert False
+    except KeyError:
+        pass
@@ -1,9 +1,10 @@
 import numpy as np
 import os
 from pyfasta import Fasta
-from region_utils import Region, AllowedSpace, RegionAcceptorApproxGC, count_g_and_c, RegionAcceptorApproxHistogram, histogram_intersection, KmerHistogram
+from region_utils import Region, AllowedSpace, RegionAcceptor, CandidatePool, RegionAcceptorApproxGC, count_g_and_c, RegionAcceptorApproxHistogram, histogram_intersection, KmerHistogram, FeatureIndex, RegionAcceptorGCProfile, RegionAcceptorFeatureDistance
 from smpregs import sample_regions #, _setup_log
 from kmers import count_kmers, all_kmers
+import kmers_np
 
 def get_genome(assembly):
     return Fasta(os.path.expanduser('~kazmar/data/genomes/%s.fa' % assembly))
@@ -104,3 +105,467 @@ def test_sample_regions_kmers():
         errors = 2*(input_region.stop - input_region.start) - histogram_intersection(dict(zip(kmer_keys, input_kmers)), dict(zip(kmer_keys, random_kmers)))
         print errors
         assert errors < 20
+
+
+class RegionAcceptorNever(RegionAcceptor):
+    def accept(self, region):
+        self._reason_args = ('never', )
+        return False
+
+
+def test_sample_regions_budget():
+    prng = np.random.RandomState(1234L)
+    genome_fasta = get_genome('dm3')
+    regions = create_regions(301, 10, genome_fasta, prng=prng)
+    for input_region, random_region, stats in sample_regions(
+            regions, AllowedSpace(genome_fasta),
+            [(RegionAcceptorNever, {})], genome_fasta,
+            prng=prng, max_attempts=5, relaxations=[[]], with_stats=True):
+        assert region_length(input_region) == region_length(random_region)
+        assert stats.level == 1
+        assert stats.attempts == 6
+    for input_region, random_region in sample_regions(
+            regions, AllowedSpace(genome_fasta),
+            [(RegionAcceptorNever, {})], genome_fasta,
+            prng=prng, max_attempts=5, on_exhausted='skip'):
+        assert random_region is None
+
+
+def test_sample_regions_no_space_skip():
+    from threaded import sample_regions_threaded
+    fasta = {'chr1': 'ACGT' * 100}
+    regions = [Region('chr1', 0, 250, 'r1'), Region('chr1', 100, 350, 'r2')]
+    for sample in [sample_regions, sample_regions_threaded]:
+        # one of the templates fits, the other one does not
+        results = list(sample(regions, AllowedSpace(fasta), [], fasta,
+            max_attempts=5, on_exhausted='skip'))
+        assert [input_region for input_region, _ in results] == regions
+        assert sorted(region is None for _, region in results) == [False, True]
+
+
+def test_sample_regions_threaded():
+    from threaded import sample_regions_threaded
+    prng = np.random.RandomState(0)
+    fasta = {'chr1': ''.join(prng.choice(list('ACGT'), 20000)),
+            'chr2': ''.join(prng.choice(list('ACGT'), 20000))}
+    regions = [Region(chrom, int(s), int(s) + 200, 'r%d' % i)
+            for i, (chrom, s) in enumerate(zip(prng.choice(['chr1', 'chr2'], 60),
+                prng.randint(0, 19800, 60)))]
+    acceptors = [(RegionAcceptorApproxGC, dict(threshold=20))]
+    results = []
+    for threads in [1, 4]:
+        allowed_space = AllowedSpace(fasta, exclude=regions, persistent=True)
+        results += [list(sample_regions_threaded(regions, allowed_space, acceptors, fasta,
+            seed=42, threads=threads, block_size=16, with_stats=True))]
+    assert results[0] == results[1]
+    random_regions = sorted(region for _, region, _ in results[0])
+    assert len(random_regions) == len(regions)
+    for r1, r2 in zip(random_regions[:-1], random_regions[1:]):
+        assert r1.chrom != r2.chrom or r1.stop <= r2.start
+    for region in random_regions:
+        assert not allowed_space.contains(region)
+
+
+def test_sample_regions_threaded_redraw_budget():
+    from threaded import sample_regions_threaded
+    fasta = {'chr1': 'ACGT' * 500}
+    regions = [Region('chr1', 0, 100, 'r%d' % i) for i in range(16)]
+    results = list(sample_regions_threaded(regions, AllowedSpace(fasta), [], fasta,
+        seed=1, block_size=16, max_attempts=1, on_exhausted='skip', with_stats=True))
+    # candidates taken by earlier regions are not redrawn with a fresh budget
+    assert any(region is None for _, region, _ in results)
+    assert all(stats.attempts <= 1 for _, _, stats in results)
+
+def test_sample_regions_gc_pool():
+    prng = np.random.RandomState(1234L)
+    genome_fasta = get_genome('dm3')
+    regions = create_regions(301, 100, genome_fasta, no_ns=True, prng=prng)
+    pool = CandidatePool(max_size=1000)
+    random_regions = []
+    for input_region, random_region in sample_regions(
+            regions, AllowedSpace(genome_fasta),
+            [(RegionAcceptorApproxGC, dict(threshold=5))], genome_fasta,
+            prng=prng, pool=pool):
+        assert region_length(input_region) == region_length(random_region)
+        assert input_region.chrom == random_region.chrom
+        input_gc = region_gc(genome_fasta, input_region)
+        random_gc = region_gc(genome_fasta, random_region)
+        assert abs(input_gc - random_gc) <= 5
+        random_regions += [random_region]
+    random_regions.sort()
+    for r1, r2 in zip(random_regions[:-1], random_regions[1:]):
+        assert r1.chrom != r2.chrom or r1.stop <= r2.start
+
+
+def test_count_kmers_numpy():
+    prng = np.random.RandomState(1234L)
+    seq = ''.join(prng.choice(list('ACGT'), 301))
+    for k in [1, 2, 3, 4]:
+        assert kmers_np.all_kmers(k) == all_kmers(k)
+        assert (kmers_np.count_kmers(k, seq) == count_kmers(k, seq)).all()
+
+
+def test_feature_index_count():
+    prng = np.random.RandomState(1234L)
+    features = []
+    for i in range(200):
+        start = prng.randint(0, 10000)
+        features += [Region(prng.choice(['chr1', 'chr2']), start, start + prng.randint(1, 500), 'f%d' % i)]
+    index = FeatureIndex(features)
+    assert len(index) == 200
+    starts = prng.randint(0, 10000, 50)
+    for chrom in ['chr1', 'chr2', 'chrX']:
+        counts = index.count(chrom, starts, starts + 301)
+        for start, count in zip(starts, counts):
+            expected = sum(1 for f in features
+                    if f.chrom == chrom and f.start < start + 301 and f.stop > start)
+            assert count == expected
+            assert index.count(chrom, start, start + 301) == expected
+
+
+def test_feature_index_distance():
+    prng = np.random.RandomState(1234L)
+    starts = prng.randint(0, 10000, 100)
+    features = [Region('chr1', s, s + 100, 'f%d' % i) for i, s in enumerate(starts)]
+    index = FeatureIndex(features)
+    windows = prng.randint(0, 10000, 50)
+    distances = index.distance('chr1', windows, windows + 301)
+    for start, distance in zip(windows, distances):
+        expected = min(abs(start + 150.5 - (s + 50)) for s in starts)
+        assert distance == expected
+        assert index.distance('chr1', start, start + 301) == expected
+    assert index.distance('chr2', 0, 301) == np.inf
+
+
+def test_sample_regions_cross_chrom():
+    prng = np.random.RandomState(1234L)
+    genome_fasta = get_genome('dm3')
+    regions = create_regions(301, 100, genome_fasta, prng=prng)
+    allowed_space = AllowedSpace(genome_fasta)
+    random_regions = []
+    for input_region, random_region in sample_regions(
+            regions, allowed_space, [], genome_fasta, prng=prng, cross_chrom=True):
+        assert region_length(input_region) == region_length(random_region)
+        random_regions += [random_region]
+    assert len(set(r.chrom for r in random_regions)) > 1
+    random_regions.sort()
+    for r1, r2 in zip(random_regions[:-1], random_regions[1:]):
+        assert r1.chrom != r2.chrom or r1.stop <= r2.start
+    # weights kept by remove equal the ones computed from scratch
+    weights = allowed_space.placement_weights(301)
+    fresh = allowed_space.fork()
+    fresh._weights.clear()
+    expected = fresh.placement_weights(301)
+    assert [weights[i] for i in range(len(weights))] == \
+            [expected[i] for i in range(len(expected))]
+
+
+def test_sample_regions_distance_cross_chrom():
+    import tempfile
+    prng = np.random.RandomState(1234L)
+    genome_fasta = get_genome('dm3')
+    chrom = sorted(genome_fasta.keys())[0]
+    # features on a single chromosome, the others are at infinite distance
+    filename = tempfile.mktemp(suffix='.bed')
+    try:
+        with open(filename, 'w') as fw:
+            for start in range(0, len(genome_fasta[chrom]) - 1000, 5000):
+                fw.write('%s\t%d\t%d\tf%d\n' % (chrom, start, start + 100, start))
+        regions = [r._replace(chrom=chrom) for r in create_regions(301, 20, genome_fasta, prng=prng)
+                if r.stop < len(genome_fasta[chrom])]
+        for input_region, random_region in sample_regions(
+                regions, AllowedSpace(genome_fasta, exclude=regions),
+                [(RegionAcceptorFeatureDistance, dict(filename=filename, threshold=1000))],
+                genome_fasta, prng=prng, cross_chrom=True):
+            assert random_region.chrom == chrom
+        acceptor = RegionAcceptorFeatureDistance(filename=filename, threshold=1000,
+                template=regions[0], fasta=genome_fasta)
+        other = [c for c in genome_fasta.keys() if c != chrom][0]
+        assert not acceptor.accept(Region(other, 0, 301, None))
+        assert 'inf' in acceptor.reason
+    finally:
+        os.unlink(filename)
+
+
+def test_sample_regions_persistent():
+    import tempfile
+    genome_fasta = get_genome('dm3')
+    regions = create_regions(301, 100, genome_fasta, prng=np.random.RandomState(1234L))
+    expected = list(sample_regions(regions, AllowedSpace(genome_fasta, exclude=regions),
+        [], genome_fasta, prng=np.random.RandomState(1), cross_chrom=True))
+    base = AllowedSpace(genome_fasta, persistent=True)
+    intervals = dict((chrom, base.intervals(chrom)) for chrom in base.chromosomes())
+    for _ in range(2):
+        allowed_space = base.fork()
+        for region in regions:
+            allowed_space.remove(region)
+        assert list(sample_regions(regions, allowed_space, [], genome_fasta,
+            prng=np.random.RandomState(1), cross_chrom=True)) == expected
+    # the base space is never modified by its forks
+    assert dict((chrom, base.intervals(chrom)) for chrom in base.chromosomes()) == intervals
+    filename = tempfile.mktemp(suffix='.space')
+    try:
+        allowed_space.save(filename)
+        loaded = AllowedSpace.load(filename)
+        for chrom in allowed_space.chromosomes():
+            assert loaded.intervals(chrom) == allowed_space.intervals(chrom)
+            assert loaded.range(chrom) == allowed_space.range(chrom)
+    finally:
+        os.unlink(filename)
+
+
+def test_sample_regions_gc_profile():
+    prng = np.random.RandomState(1234L)
+    genome_fasta = get_genome('dm3')
+    regions = create_regions(300, 20, genome_fasta, no_ns=True, prng=prng)
+    for input_region, random_region in sample_regions(
+            regions, AllowedSpace(genome_fasta),
+            [(RegionAcceptorGCProfile, dict(bins=3, threshold=10))], genome_fasta,
+            prng=prng):
+        for i in range(3):
+            input_gc = region_gc(genome_fasta, input_region._replace(
+                start=input_region.start + i * 100, stop=input_region.start + (i + 1) * 100))
+            random_gc = region_gc(genome_fasta, random_region._replace(
+                start=random_region.start + i * 100, stop=random_region.start + (i + 1) * 100))
+            assert abs(input_gc - random_gc) <= 10
+    acceptor = RegionAcceptorGCProfile(bins=3, threshold=10, template=regions[0],
+            fasta=genome_fasta)
+    starts = np.arange(0, len(genome_fasta[regions[0].chrom]) - 300, 997)
+    assert list(acceptor.accept_batch(regions[0].chrom, starts, starts + 300)) == \
+            [acceptor.accept(Region(regions[0].chrom, s, s + 300, None)) for s in starts]
+
+
+def test_relative_thresholds():
+    import tempfile
+    from motifs import MotifIndex
+    from region_utils import RegionAcceptorMotifCount, RegionAcceptorFeatureCount
+    fasta = {'chr1': 'TGACTCA' * 100}
+    template = Region('chr1', 0, 140, 't')
+    index = MotifIndex(fasta)
+    key = index.add('TGASTCA')
+    features = tempfile.mktemp(suffix='.bed')
+    try:
+        with open(features, 'w') as f:
+            f.write('chr1\t10\t20\nchr1\t30\t40\nchr1\t500\t510\n')
+        for threshold in [1, 1.]:
+            acceptors = [
+                RegionAcceptorApproxGC(template=template, fasta=fasta, threshold=threshold),
+                RegionAcceptorGCProfile(template=template, fasta=fasta, bins=4,
+                    threshold=threshold),
+                RegionAcceptorMotifCount(template=template, fasta=fasta, index=index, key=key,
+                    threshold=threshold),
+                RegionAcceptorFeatureCount(template=template, fasta=fasta, filename=features,
+                    threshold=threshold),
+                RegionAcceptorFeatureDistance(template=template, fasta=fasta,
+                    filename=features, threshold=threshold)]
+            assert [np.all(a.threshold == reference) for a, reference in zip(acceptors,
+                [140, [35, 35, 35, 35], 20, 2, 35])] == [True] * 5
+        assert RegionAcceptorMotifCount(template=template, fasta=fasta, index=index,
+                key=key, threshold=2).threshold == 2
+    finally:
+        os.unlink(features)
+
+
+def test_allowed_space_lazy():
+    fasta = dict(('scaffold%d' % i, 'ACGT' * 100) for i in range(1000))
+    exclude = [Region('scaffold%d' % i, 100, 200, None) for i in range(1000)]
+    allowed_space = AllowedSpace(fasta, exclude=exclude)
+    assert len(allowed_space.chromosomes()) == 1000
+    assert not allowed_space._space
+    assert allowed_space.range('scaffold7') == (0, 400)
+    assert not allowed_space.contains(Region('scaffold8', 150, 160, None))
+    allowed_space.remove(Region('scaffold9', 0, 10, None))
+    assert sorted(allowed_space._space.keys()) == ['scaffold7', 'scaffold8', 'scaffold9']
+    assert allowed_space.intervals('scaffold9') == [(10, 100), (200, 400)]
+    fork = allowed_space.fork()
+    # the forks build the pending chromosomes only once, on the first use
+    assert len(allowed_space._space) == 3 and len(fork._pending) == 997
+    fork.remove(Region('scaffold1', 0, 10, None))
+    assert allowed_space.intervals('scaffold1') == [(0, 100), (200, 400)]
+    assert fork.intervals('scaffold1') == [(10, 100), (200, 400)]
+    assert fork._pending['scaffold2'].build('scaffold2') is \
+            allowed_space._chrom_space('scaffold2')
+    fork.remove(Region('scaffold9', 300, 310, None))
+    assert allowed_space.intervals('scaffold9') == [(10, 100), (200, 400)]
+
+
+def test_allowed_space_fork():
+    prng = np.random.RandomState(0)
+    fasta = dict(('chr%d' % i, 'ACGT' * 100) for i in range(20))
+    for opts in [{}, dict(persistent=True), dict(bitmap=True)]:
+        base = AllowedSpace(fasta, exclude=[Region('chr0', 0, 100, None)], **opts)
+        base.placement_weights(10)
+        spaces = [base]
+        removed = [set([('chr0', 0, 100)])]
+        for _ in range(200):
+            i = prng.randint(len(spaces))
+            if prng.rand() < 0.3:
+                spaces += [spaces[i].fork()]
+                removed += [set(removed[i])]
+            else:
+                chrom, start = 'chr%d' % prng.randint(20), 10 * prng.randint(39)
+                spaces[i].remove(Region(chrom, start, start + 10, None))
+                removed[i].add((chrom, start, start + 10))
+        for space, space_removed in zip(spaces, removed):
+            for chrom in fasta:
+                expected = [(start, start + 10) for start in range(0, 400, 10)
+                        if not any(c == chrom and s <= start < e for c, s, e in space_removed)]
+                assert [(s, s + 10) for a, b in space.intervals(chrom)
+                        for s in range(a, b, 10)] == expected
+            weights = space.placement_weights(10)
+            assert [weights[i] for i in range(20)] == \
+                    [space.intervals(chrom) and sum(b - a - 9 for a, b in
+                        space.intervals(chrom)) or 0 for chrom in space.chromosomes()]
+            # the forks share the frozen layers, which stay few
+            assert len(space._space._layers) <= 10
+
+
+def test_allowed_space_load_empty_chrom():
+    import tempfile
+    fasta = {'chr1': 'ACGT' * 100, 'chr2': 'ACGT' * 100}
+    allowed_space = AllowedSpace(fasta, exclude=[Region('chr2', 0, 400, None)])
+    filename = tempfile.mktemp(suffix='.space')
+    try:
+        allowed_space.save(filename)
+        for bitmap in [False, True]:
+            loaded = AllowedSpace.load(filename, bitmap=bitmap)
+            assert loaded.intervals('chr2') == []
+            assert loaded.range('chr2') == (0, 0)
+            weights = loaded.placement_weights(10)
+            assert [weights[i] for i in range(2)] == [391, 0]
+            fork = loaded.fork()
+            fork.remove(Region('chr1', 0, 10, None))
+            assert fork.intervals('chr1') == [(10, 400)]
+    finally:
+        os.unlink(filename)
+
+
+def test_sample_regions_bitmap():
+    prng = np.random.RandomState(1234L)
+    genome_fasta = get_genome('dm3')
+    regions = create_regions(301, 50, genome_fasta, prng=prng)
+    track = [Region(chrom, start, start + 5000, None) for chrom in genome_fasta.keys()
+            for start in range(0, len(genome_fasta[chrom]) - 5000, 20000)]
+    allowed_space = AllowedSpace(genome_fasta, exclude=regions, bitmap=True)
+    allowed_space.intersect(track)
+    reference = AllowedSpace(genome_fasta, exclude=regions)
+    reference.intersect(track)
+    for chrom in genome_fasta.keys():
+        assert allowed_space.intervals(chrom) == reference.intervals(chrom)
+    random_regions = []
+    for input_region, random_region in sample_regions(
+            regions, allowed_space, [], genome_fasta, prng=prng):
+        assert region_length(input_region) == region_length(random_region)
+        assert any(t.chrom == random_region.chrom and t.start <= random_region.start
+                and random_region.stop <= t.stop for t in track)
+        random_regions += [random_region]
+    random_regions.sort()
+    for r1, r2 in zip(random_regions[:-1], random_regions[1:]):
+        assert r1.chrom != r2.chrom or r1.stop <= r2.start
+
+
+def start_unix_server(service, directory):
+    """
+    Serve the service on a Unix socket in the directory, return the server
+    and function posting a request to it.
+    """
+    import httplib
+    import json
+    import socket
+    import threading
+    from server import create_server
+    socket_path = os.path.join(directory, 'socket')
+    server = create_server(service, socket_path=socket_path)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    class UnixConnection(httplib.HTTPConnection):
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(socket_path)
+    def post(request):
+        connection = UnixConnection('localhost')
+        try:
+            connection.request('POST', '/sample', json.dumps(request))
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+    return server, post
+
+
+def test_server_matches_cli():
+    import shutil
+    import subprocess
+    import sys
+    import tempfile
+    import threading
+    from server import SamplingService
+    prng = np.random.RandomState(1234L)
+    genome_fasta = get_genome('dm3')
+    regions = create_regions(301, 20, genome_fasta, no_ns=True, prng=prng)
+    bed = ''.join('%s\t%d\t%d\t%s\n' % r for r in regions)
+    filters = ['GC:threshold=20']
+    directory = tempfile.mkdtemp()
+    try:
+        server, post = start_unix_server(SamplingService(), directory)
+        responses = {}
+        def request(seed):
+            responses[seed] = post(dict(regions=bed, seed=seed, filters=filters))
+        clients = [threading.Thread(target=request, args=(seed,)) for seed in [1, 2]]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        server.shutdown()
+        server.server_close()
+        regions_file = os.path.join(directory, 'regions.bed')
+        with open(regions_file, 'w') as f:
+            f.write(bed)
+        smpregs = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'smpregs.py')
+        for seed in [1, 2]:
+            output = os.path.join(directory, 'out%d.bed' % seed)
+            subprocess.check_call([sys.executable, smpregs, '-r', regions_file,
+                '-o', output, '-s', str(seed)] + filters)
+            with open(output) as f:
+                assert responses[seed] == (200, f.read())
+            assert len(responses[seed][1].splitlines()) == len(regions)
+        assert responses[1] != responses[2]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_server_exhausted():
+    import httplib
+    import shutil
+    import tempfile
+    from server import SamplingService
+    prng = np.random.RandomState(1234L)
+    genome_fasta = get_genome('dm3')
+    regions = create_regions(301, 5, genome_fasta, no_ns=True, prng=prng)
+    request = dict(regions=''.join('%s\t%d\t%d\t%s\n' % r for r in regions), seed=1,
+            filters=['GC:threshold=0'], max_attempts=1)
+    directory = tempfile.mkdtemp()
+    try:
+        server, post = start_unix_server(SamplingService(), directory)
+        try:
+            post(request)
+            assert False, 'incomplete response expected'
+        except httplib.IncompleteRead:
+            pass
+        status, body = post(dict(request, relaxations=[[]]))
+        assert status == 200 and len(body.splitlines()) == len(regions)
+        status, body = post(dict(request, on_exhausted='skip'))
+        assert status == 200 and len(body.splitlines()) < len(regions)
+        assert post(dict(request, on_exhausted='ignore'))[0] == 400
+        for assembly in ['../../genomes/dm3', '.dm3', 'dm3/', 3]:
+            assert post(dict(request, assembly=assembly))[0] == 400
+        try:
+            SamplingService(assemblies=['dm6']).sample(request)
+            assert False, 'unknown assembly accepted'
+        except ValueError:
+            pass
+        server.shutdown()
+        server.server_close()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,205 @@
+"""
+Thread-pool sampling within one process.
+
+Worker threads draw and check candidates concurrently, so acceptors running
+in code releasing the GIL (NumPy, Cython) scale with the number of threads
+without the pickling and duplicated memory of process pools.
+
+Output is deterministic for a given seed, independently of the number of
+threads:
+- input region i draws from its own PRNG stream seeded with (seed, i),
+- candidates are proposed against a snapshot (fork) of the allowed space
+  taken at the start of each block of block_size input regions,
+- proposals are committed in input order by an atomic check-and-remove
+  (ConcurrentAllowedSpace.take); a candidate already taken by an earlier
+  region is redrawn from the same stream against the current space.
+
+The random regions differ from the serial sample_regions for the same seed.
+"""
+
+import itertools
+import threading
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from region_utils import get_log
+from smpregs import _sample_levels
+
+
+class ConcurrentAllowedSpace(object):
+    """
+    Thread-safe view of an AllowedSpace with lock striping.
+
+    Operations on a chromosome hold the lock of its stripe, operations on
+    all chromosomes (cross-chromosome placement weights, fork) hold all the
+    stripes, taken in order.
+    """
+
+    def __init__(self, allowed_space, stripes=16, _stripes=None):
+        """
+        allowed_space: AllowedSpace object
+            Must not be used directly while the view is used by threads.
+        stripes: int
+            Number of locks the chromosomes are distributed to.
+        """
+        self.allowed_space = allowed_space
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        # chrom -> index of its lock, shared by the forks
+        if _stripes is None:
+            _stripes = dict((chrom, i % stripes)
+                    for i, chrom in enumerate(allowed_space.chromosomes()))
+        self._stripes = _stripes
+        # guards the placement weights shared by all chromosomes
+        self._weights_lock = threading.Lock()
+
+    def _lock(self, chrom):
+        return self._locks[self._stripes.get(chrom, 0)]
+
+    def range(self, chrom):
+        with self._lock(chrom):
+            return self.allowed_space.range(chrom)
+
+    def contains(self, region):
+        with self._lock(region.chrom):
+            return self.allowed_space.contains(region)
+
+    def random_start(self, chrom, length, prng):
+        with self._lock(chrom):
+            return self.allowed_space.random_start(chrom, length, prng)
+
+    def remove(self, region):
+        with self._lock(region.chrom):
+            with self._weights_lock:
+                self.allowed_space.remove(region)
+
+    def take(self, region):
+        """
+        Remove the region if it is still inside the space.
+
+        Returns:
+        ========
+        True if the region was removed, False if it was not available.
+        """
+        with self._lock(region.chrom):
+            if not self.allowed_space.contains(region):
+                return False
+            with self._weights_lock:
+                self.allowed_space.remove(region)
+            return True
+
+    def _all_locks(self):
+        for lock in self._locks:
+            lock.acquire()
+        self._weights_lock.acquire()
+
+    def _release_all_locks(self):
+        self._weights_lock.release()
+        for lock in reversed(self._locks):
+            lock.release()
+
+    def random_chrom(self, length, prng):
+        self._all_locks()
+        try:
+            return self.allowed_space.random_chrom(length, prng)
+        finally:
+            self._release_all_locks()
+
+    def chromosomes(self):
+        return self.allowed_space.chromosomes()
+
+    def fork(self):
+        """
+        Return ConcurrentAllowedSpace of a fork of the space.
+        """
+        self._all_locks()
+        try:
+            return ConcurrentAllowedSpace(self.allowed_space.fork(), len(self._locks),
+                    self._stripes)
+        finally:
+            self._release_all_locks()
+
+
+def sample_regions_threaded(regions, allowed_space, acceptors, fasta, seed=None,
+        threads=4, block_size=256, max_attempts=None, max_time=None,
+        relaxations=None, on_exhausted='raise', with_stats=False, cross_chrom=False):
+    """
+    Threaded variant of sample_regions.
+
+    Parameters:
+    ===========
+    regions: iterable of regions
+    allowed_space: AllowedSpace object
+        Persistent spaces (see AllowedSpace) make the per-block snapshots
+        cheapest.
+    seed: int
+        Seed of the per-region PRNG streams [Default: random].
+    threads: int
+        Number of worker threads.
+    block_size: int
+        Number of input regions proposed against the same snapshot of the
+        allowed space. Larger blocks keep threads busier, smaller ones cause
+        fewer candidates to be redrawn. Results depend on it.
+
+    Remaining arguments are as for sample_regions (candidate pools are not
+    supported).
+
+    Returns:
+    ========
+    Yields the tuples of sample_regions, in input order.
+    """
+    if on_exhausted not in ('raise', 'skip'):
+        raise ValueError('Unknown on_exhausted value %s.' % on_exhausted)
+    if seed is None:
+        seed = np.random.RandomState().randint(1 << 31)
+    levels = [acceptors]
+    if relaxations is not None:
+        levels += list(relaxations)
+    budget = dict(max_attempts=max_attempts, max_time=max_time, cross_chrom=cross_chrom)
+    space = ConcurrentAllowedSpace(allowed_space)
+    pool = ThreadPool(threads)
+    try:
+        block = []
+        for index, input_region in enumerate(regions):
+            block += [(index, input_region)]
+            if len(block) >= block_size:
+                for item in _sample_block(block, space, levels, fasta, seed, pool, budget,
+                        on_exhausted, with_stats):
+                    yield item
+                block = []
+        for item in _sample_block(block, space, levels, fasta, seed, pool, budget,
+                on_exhausted, with_stats):
+            yield item
+    finally:
+        pool.terminate()
+
+
+def _sample_block(block, space, levels, fasta, seed, pool, budget, on_exhausted,
+        with_stats):
+    """
+    Propose candidates for the block in the pool, commit them in order.
+    """
+    logger = get_log('generate')
+    snapshot = space.fork()
+    def propose((index, input_region)):
+        prng = np.random.RandomState([seed, index])
+        return _sample_levels(input_region, snapshot, levels, fasta, prng,
+                **budget) + (prng,)
+    for (index, input_region), (candidate, stats, spent, prng) in itertools.izip(block,
+            pool.imap(propose, block, chunksize=4)):
+        while candidate is not None and not space.take(candidate):
+            logger.info('TAKEN %s', candidate)
+            # continue with the budget left at the level of the taken candidate
+            candidate, stats, spent = _sample_levels(input_region, space, levels, fasta,
+                    prng, start_level=stats.level, attempts=stats.attempts, spent=spent,
+                    **budget)
+        if candidate is None:
+            if on_exhausted == 'raise':
+                raise RuntimeError('Failed to sample a region matching %s (%d attempts).' %
+                        (input_region, stats.attempts))
+            logger.warning('SKIP %s', input_region)
+        else:
+            logger.info('ACC %s', candidate)
+        if with_stats:
+            yield input_region, candidate, stats
+        else:
+            yield input_region, candidate
+